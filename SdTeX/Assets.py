@@ -0,0 +1,112 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import Graph
+import Profile
+from Errors import *
+
+
+DEFAULT_GRAPH_WORKERS = os.cpu_count() or 1
+DEFAULT_IMAGE_WORKERS = 8
+
+
+class AssetPrefetcher:
+    def __init__(self, sdtex, graph_workers=DEFAULT_GRAPH_WORKERS, image_workers=DEFAULT_IMAGE_WORKERS):
+        self.sdtex = sdtex
+        self.graph_workers = max(graph_workers, 1)
+        self.image_workers = max(image_workers, 1)
+
+    def collect(self, attributes):
+        graphs = {}
+        images = {}
+        pending = list(attributes)
+        while pending:
+            attribute = pending.pop()
+            # Vector graphs have nothing to render ahead; they are drawn into the page
+            if attribute["type"] == "sdgraph" and self.sdtex.graph_mode(attribute)[0] == "raster":
+                settings = self.sdtex.graph_settings(attribute)
+                graphs.setdefault(settings, attribute)
+            elif attribute["type"] == "sdimage":
+                images.setdefault(attribute["content"], attribute)
+            pending.extend(attribute.get("children") or ())
+        return graphs, images
+
+    def prefetch(self, attributes):
+        graphs, images = self.collect(attributes)
+        assets = {}
+
+        # Images mostly wait on the network (and PIL releases the GIL while
+        # resizing), so their thread pool runs while graphs use the process pool.
+        with self.executor(ThreadPoolExecutor, self.image_workers, len(images)) as image_pool:
+            image_futures = {
+                src: image_pool.submit(self.sdtex.prepare_image, src)
+                for src in images
+            }
+            assets.update(self.render_graphs(graphs))
+
+            for src, future in image_futures.items():
+                try:
+                    assets[("sdimage", src)] = future.result()
+                except SdTeXError as e:
+                    raise SdTeXSrcError(
+                        f"Error fetching image on line {images[src]['line_number']}: {e}"
+                    )
+
+        return assets
+
+    def render_graphs(self, graphs):
+        assets = {}
+        jobs = {}
+        for settings in graphs:
+            cached_path, key, graph_file_path = self.sdtex.graph_target(settings)
+            if cached_path:
+                assets[("sdgraph", settings)] = cached_path
+            else:
+                jobs[settings] = (key, graph_file_path)
+
+        with self.executor(ProcessPoolExecutor, self.graph_workers, len(jobs)) as graph_pool:
+            futures = {
+                settings: graph_pool.submit(Graph.save_as_graph, settings, graph_file_path)
+                for settings, (key, graph_file_path) in jobs.items()
+            }
+            for settings, future in futures.items():
+                key, graph_file_path = jobs[settings]
+                try:
+                    # Graphs may render in another process, so this span is
+                    # the time spent waiting for each one here
+                    with Profile.span("save_as_graph", "asset", function=settings.label, quality=settings.quality):
+                        data = future.result()
+                except Exception as e:
+                    for _, path in jobs.values():
+                        self.sdtex.discard_graph(path)
+                    raise SdTeXProcessingError(
+                        f"Error rendering graph on line {graphs[settings]['line_number']}: {e}"
+                    )
+                assets[("sdgraph", settings)] = self.sdtex.finish_graph(key, graph_file_path, data)
+
+        return assets
+
+    def executor(self, executor_class, workers, jobs):
+        # Spinning up a pool costs more than it saves for a single asset
+        if workers <= 1 or jobs <= 1:
+            return InlineExecutor()
+        return executor_class(max_workers=min(workers, jobs))
+
+
+class InlineFuture:
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def result(self):
+        return self.function(*self.args)
+
+
+class InlineExecutor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, function, *args):
+        return InlineFuture(function, args)
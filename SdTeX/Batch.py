@@ -0,0 +1,100 @@
+import os
+import glob
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Options import OUTPUT_EXTENSIONS
+from Errors import *
+
+
+SOURCE_EXTENSION = ".sdtex"
+
+worker_options = None
+
+
+def find_sources(pattern):
+    if os.path.isdir(pattern):
+        return sorted(glob.glob(os.path.join(pattern, f"*{SOURCE_EXTENSION}")))
+    if glob.has_magic(pattern):
+        return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+    return [pattern]
+
+
+def output_path(source, output_dir, output_format="pdf"):
+    name = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(output_dir, f"{name}{OUTPUT_EXTENSIONS[output_format]}")
+
+
+def start_worker(options):
+    global worker_options
+    worker_options = options
+
+    # Pay for the heavy imports once per worker rather than once per document
+    import SdTeX
+    import fpdf
+    import Graph
+
+    Graph.load_figure()
+
+
+def compile_document(source, output_file, options=None):
+    options = options if options is not None else worker_options
+    started = time.perf_counter()
+    try:
+        # Batch workers already run in parallel, so graphs render inline
+        options.create(source, output_file, graph_workers=1).run()
+        error = None
+    except SdTeXError as e:
+        error = e.message
+    except Exception as e:
+        error = f"Unexpected error: {e}"
+    return source, output_file, time.perf_counter() - started, error
+
+
+class BatchCompiler:
+    def __init__(self, options, output_dir, workers=os.cpu_count() or 1):
+        self.options = options
+        self.output_dir = output_dir
+        self.workers = max(workers, 1)
+
+    def run(self, sources):
+        os.makedirs(self.output_dir, exist_ok=True)
+        jobs = [
+            (source, output_path(source, self.output_dir, self.options.output_format))
+            for source in sources
+        ]
+
+        outputs = {}
+        for source, output_file in jobs:
+            if output_file in outputs:
+                raise SdTeXProcessingError(
+                    f"Error: {outputs[output_file]} and {source} would both be written to {output_file}"
+                )
+            outputs[output_file] = source
+
+        started = time.perf_counter()
+        if self.workers == 1 or len(jobs) <= 1:
+            start_worker(self.options)
+            results = [compile_document(source, output_file) for source, output_file in jobs]
+        else:
+            with ProcessPoolExecutor(
+                max_workers=min(self.workers, len(jobs)),
+                initializer=start_worker,
+                initargs=(self.options,),
+            ) as pool:
+                futures = [pool.submit(compile_document, *job) for job in jobs]
+                results = [future.result() for future in futures]
+
+        self.print_summary(results, time.perf_counter() - started)
+        return results
+
+    def print_summary(self, results, elapsed):
+        width = max((len(os.path.basename(source)) for source, _, _, _ in results), default=0)
+        print()
+        for source, output_file, seconds, error in results:
+            status = f"failed: {error}" if error else os.path.basename(output_file)
+            print(f"  {os.path.basename(source):<{width}}  {seconds:7.2f}s  {status}")
+
+        failures = sum(1 for result in results if result[3])
+        print(
+            f"Compiled {len(results) - failures} of {len(results)} documents in {elapsed:.2f}s"
+        )
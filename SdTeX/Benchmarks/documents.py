@@ -0,0 +1,113 @@
+import random
+import argparse
+
+
+TEXT_TAGS = ("sdtitle", "sdquote", "sdbullet", "sdauthor", "sdlink", "sdcode")
+GRAPH_FUNCTIONS = ("sin(x)", "x^2 - 3*x", "tan(x)", "exp(x / 5)", "sqrt(abs(x)) * cos(x)", "1 / x")
+WORDS = (
+    "layout", "glyph", "kerning", "margin", "paragraph", "ligature", "baseline",
+    "column", "figure", "caption", "footnote", "heading", "serif", "leading",
+)
+
+
+def generate_text(rng, length, variables):
+    words = []
+    size = 0
+    while size < length:
+        if variables and rng.random() < 0.1:
+            word = f"$var{rng.randrange(variables)}"
+        else:
+            word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def generate_graph(index, quality):
+    span = 5 + index % 10
+    return (
+        "(sdgraph attributes={\n"
+        f'    function: "{GRAPH_FUNCTIONS[index % len(GRAPH_FUNCTIONS)]}",\n'
+        f"    first_point: {-span},\n"
+        f"    last_point: {span},\n"
+        f"    quality: {quality},\n"
+        f'    graph_color: "#{(index * 2654435761) % 0xFFFFFF:06X}"\n'
+        "})(!sdgraph)"
+    )
+
+
+def generate_document(
+    nodes=100,
+    variables=0,
+    graphs=0,
+    quality=10,
+    images=0,
+    text_length=80,
+    image_url=None,
+    seed=0,
+):
+    """
+    Build a synthetic .sdtex document.
+
+    nodes text tags cycle through every text tag type, each about text_length
+    characters long; graphs and images are spread evenly between them. Every
+    graph has distinct settings so none are de-duplicated. Images point at
+    image_url/image_<n>.jpg, which Benchmarks/server.py serves.
+    """
+    rng = random.Random(seed)
+    lines = [f'var{index}: "value {index}"' for index in range(variables)]
+
+    body = [
+        f"({tag})" + generate_text(rng, text_length, variables) + f"(!{tag})"
+        for tag in (TEXT_TAGS[index % len(TEXT_TAGS)] for index in range(nodes))
+    ]
+    extras = [generate_graph(index, quality) for index in range(graphs)]
+    if images:
+        if image_url is None:
+            raise ValueError("image_url is required for documents with images")
+        extras += [f'(sdimage src="{image_url}/image_{index}.jpg")(!sdimage)' for index in range(images)]
+    rng.shuffle(extras)
+
+    step = max(len(body) // (len(extras) + 1), 1)
+    for count, extra in enumerate(extras, start=1):
+        body.insert(min(count * step + count - 1, len(body)), extra)
+
+    return "\n".join(lines + [""] + body) + "\n"
+
+
+def main():
+    """
+    Write a synthetic .sdtex document, for profiling or trying out the suite.
+
+    Usage example:
+    python Benchmarks/documents.py report.sdtex --nodes 5000 --graphs 10 --variables 50
+    """
+    parser = argparse.ArgumentParser(description="Generate a synthetic SdTeX document")
+    parser.add_argument("output_file", help="Where to write the .sdtex document")
+    parser.add_argument("--nodes", type=int, default=100, help="Number of text tags")
+    parser.add_argument("--variables", type=int, default=0, help="Number of variables defined and referenced")
+    parser.add_argument("--graphs", type=int, default=0, help="Number of graphs")
+    parser.add_argument("--quality", type=int, default=10, help="Quality attribute of every graph")
+    parser.add_argument("--images", type=int, default=0, help="Number of images")
+    parser.add_argument("--image-url", help="Base URL the images are fetched from")
+    parser.add_argument("--text-length", type=int, default=80, help="Approximate characters per text tag")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    with open(args.output_file, "w") as f:
+        f.write(
+            generate_document(
+                nodes=args.nodes,
+                variables=args.variables,
+                graphs=args.graphs,
+                quality=args.quality,
+                images=args.images,
+                text_length=args.text_length,
+                image_url=args.image_url,
+                seed=args.seed,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
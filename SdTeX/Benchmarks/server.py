@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+
+DEFAULT_IMAGE_SIZE = (1600, 1200)
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def write_image(path, size, seed):
+    from PIL import Image
+
+    # Noise over gradients compresses about as badly as a photograph
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40 + seed % 20)
+    Image.merge("RGB", (gradient, noise, gradient.rotate(90))).save(path, quality=90)
+
+
+class ImageServer:
+    """
+    Serves image_0.jpg ... image_<count - 1>.jpg from a temporary directory on a
+    free local port, standing in for a real image host during benchmarks.
+    """
+
+    def __init__(self, count, size=DEFAULT_IMAGE_SIZE):
+        self.count = count
+        self.size = size
+        self.directory = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="sdtex-bench-")
+        for index in range(self.count):
+            write_image(os.path.join(self.directory, f"image_{index}.jpg"), self.size, index)
+
+        handler = partial(QuietHandler, directory=self.directory)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return False
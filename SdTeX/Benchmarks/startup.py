@@ -0,0 +1,80 @@
+import os
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+
+
+SDTEX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+# Backends that must stay out of a cold start; they load when a node needs them
+HEAVY_MODULES = ("numpy", "matplotlib", "fpdf", "PIL", "requests")
+
+DEFAULT_RUNS = 10
+DEFAULT_MAX_MS = 250.0
+
+
+def measure_import(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SDTEX_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    total = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        loaded.add(match.group(3).split(".")[0])
+        if match.group(3) == module:
+            total = int(match.group(2))
+    return total / 1000, loaded
+
+
+def main():
+    """
+    Cold-start benchmark for the SdTeX command line.
+
+    Imports main.py in fresh interpreters with -X importtime, reports the
+    median cumulative import time and fails when it exceeds --max-ms or when
+    any heavy backend is imported at startup.
+
+    Usage example:
+    python Benchmarks/startup.py --runs 20 --max-ms 200
+    """
+    parser = argparse.ArgumentParser(description="Measure SdTeX cold-start import time")
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="Number of fresh interpreters to time")
+    parser.add_argument("--max-ms", type=float, default=DEFAULT_MAX_MS, help="Fail when the median import time exceeds this")
+    args = parser.parse_args()
+
+    timings = []
+    heavy = set()
+    for _ in range(args.runs):
+        milliseconds, loaded = measure_import(args.module)
+        timings.append(milliseconds)
+        heavy.update(module for module in HEAVY_MODULES if module in loaded)
+
+    median = statistics.median(timings)
+    print(f"import {args.module}: median {median:.1f}ms, min {min(timings):.1f}ms, max {max(timings):.1f}ms over {args.runs} runs")
+
+    failed = False
+    if heavy:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(sorted(heavy))}")
+        failed = True
+    if median > args.max_ms:
+        print(f"FAIL: median import time {median:.1f}ms exceeds {args.max_ms:.1f}ms")
+        failed = True
+    if not failed:
+        print("OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+SDTEX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SDTEX_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from documents import generate_document
+from server import ImageServer
+
+
+DEFAULT_RUNS = 3
+DEFAULT_THRESHOLD = 0.2
+# Stages faster than this are too noisy to call a regression on
+MIN_DELTA_MS = 5.0
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+STAGES = ("parse", "graph_eval", "assets", "layout", "pdf_write", "total")
+
+SCENARIOS = {
+    "text": dict(nodes=2000, text_length=200),
+    "long-text": dict(nodes=100, text_length=8000),
+    "variables": dict(nodes=1000, variables=300, text_length=200),
+    "graphs": dict(nodes=50, graphs=8, quality=50),
+    "dense-graphs": dict(nodes=10, graphs=2, quality=2000),
+    "images": dict(nodes=50, images=6),
+}
+
+
+def walk(nodes):
+    pending = list(nodes)
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(node.get("children") or ())
+
+
+def run_once(source, workdir):
+    from SdTeX import SdTeX
+    from Writer import DocumentFPDF
+    from Cache import RenderCache
+    from Assets import AssetPrefetcher
+    from Expression import compile_expression
+    import Graph
+
+    # A fresh cache every run, so assets are really rendered and downloaded
+    cache_dir = tempfile.mkdtemp(dir=workdir)
+    output_file = os.path.join(workdir, "output.pdf")
+    sdtex = SdTeX(source, output_file=output_file, cache=RenderCache(cache_dir), graph_workers=1, incremental=False)
+    timings = {}
+
+    started = time.perf_counter()
+    nodes = sdtex.process_sdtex_file()
+    timings["parse"] = time.perf_counter() - started
+
+    stage = time.perf_counter()
+    compile_expression.cache_clear()
+    for node in walk(nodes):
+        if node["type"] == "sdgraph":
+            Graph.sample_plot(sdtex.graph_settings(node))
+    timings["graph_eval"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    sdtex.assets = AssetPrefetcher(sdtex, 1, sdtex.image_workers).prefetch(nodes)
+    timings["assets"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    # The writer save_as_pdf uses, so font files are laid out the same way
+    pdf = DocumentFPDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    for node in nodes:
+        sdtex.add_attribute_to_pdf(pdf, node)
+    timings["layout"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    pdf.output(output_file)
+    timings["pdf_write"] = time.perf_counter() - stage
+
+    timings["total"] = time.perf_counter() - started
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return {name: seconds * 1000 for name, seconds in timings.items()}
+
+
+def run_scenario(name, settings, runs, workdir):
+    with ImageServer(settings.get("images", 0)) as server:
+        source = os.path.join(workdir, f"{name}.sdtex")
+        with open(source, "w") as f:
+            f.write(generate_document(image_url=server.url, **settings))
+
+        # Console output from the build would bury the results
+        samples = []
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                for _ in range(runs):
+                    samples.append(run_once(source, workdir))
+            finally:
+                sys.stdout = stdout
+
+    return {stage: statistics.median(sample[stage] for sample in samples) for stage in STAGES}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for scenario, stages in results.items():
+        previous = baseline.get("results", {}).get(scenario, {})
+        for stage, milliseconds in stages.items():
+            before = previous.get(stage)
+            if before is None:
+                continue
+            if milliseconds > before * (1 + threshold) and milliseconds - before > MIN_DELTA_MS:
+                regressions.append((scenario, stage, before, milliseconds))
+    return regressions
+
+
+def print_results(results, baseline):
+    previous = baseline.get("results", {}) if baseline else {}
+    print(f"  {'scenario':<14}" + "".join(f"{stage:>12}" for stage in STAGES))
+    for scenario, stages in results.items():
+        print(f"  {scenario:<14}" + "".join(f"{stages[stage]:>10.1f}ms" for stage in STAGES))
+        before = previous.get(scenario)
+        if before:
+            changes = [
+                f"{(stages[stage] / before[stage] - 1) * 100:>+11.0f}%" if before.get(stage) else f"{'':>12}"
+                for stage in STAGES
+            ]
+            print(f"  {'  vs baseline':<14}" + "".join(changes))
+
+
+def load_baseline(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    """
+    Benchmark suite for the SdTeX pipeline.
+
+    Generates synthetic documents (see documents.py) and times the parser,
+    graph evaluation, asset rendering and downloads, layout and the PDF writer
+    separately, taking the median of --runs builds. Images are served by a
+    local HTTP server. Results are compared against a stored baseline and the
+    run fails when any stage is more than --threshold slower.
+
+    Usage example:
+    python Benchmarks/suite.py --save-baseline
+    python Benchmarks/suite.py --scenario text --scenario graphs --runs 5
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the SdTeX pipeline stage by stage")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (repeatable, default all)")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="Builds per scenario; the median is reported")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Allowed slowdown per stage before failing, as a fraction")
+    parser.add_argument("--json-output", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="sdtex-bench-")
+    try:
+        results = {}
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}...", flush=True)
+            results[name] = run_scenario(name, SCENARIOS[name], args.runs, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    record = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "runs": args.runs,
+        "results": results,
+    }
+    baseline = load_baseline(args.baseline)
+    print()
+    print_results(results, baseline)
+
+    if args.json_output:
+        with open(args.json_output, "w") as f:
+            json.dump(record, f, indent=2)
+
+    failed = False
+    if baseline and not args.save_baseline:
+        regressions = compare(results, baseline, args.threshold)
+        for scenario, stage, before, after in regressions:
+            print(f"FAIL: {scenario} {stage} took {after:.1f}ms, baseline {before:.1f}ms")
+        failed = bool(regressions)
+        if not failed:
+            print("OK")
+
+    if args.save_baseline:
+        if baseline:
+            # Keep scenarios that were not run this time
+            baseline["results"].update(results)
+            record["results"] = baseline["results"]
+        with open(args.baseline, "w") as f:
+            json.dump(record, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from Errors import *
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+class RenderCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        payload = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key, extension):
+        return os.path.join(self.directory, f"{key}{extension}")
+
+    def get(self, key, extension):
+        path = self.path(key, extension)
+        try:
+            # Touching the entry on every hit is what makes eviction least-recently-used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def temporary_path(self, extension):
+        handle, path = tempfile.mkstemp(suffix=extension, prefix=".tmp-", dir=self.directory)
+        os.close(handle)
+        return path
+
+    def put(self, key, extension, source_path):
+        path = self.path(key, extension)
+        os.chmod(source_path, 0o644)
+        try:
+            os.replace(source_path, path)
+        except OSError:
+            shutil.copyfile(source_path, path)
+        self.evict()
+        return path
+
+    def get_metadata(self, key):
+        try:
+            with open(self.path(key, ".json"), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def put_metadata(self, key, metadata):
+        temporary_path = self.temporary_path(".json")
+        with open(temporary_path, "w") as f:
+            json.dump(metadata, f)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, self.path(key, ".json"))
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(".tmp-"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        try:
+            shutil.rmtree(self.directory)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            raise SdTeXProcessingError(f"Error clearing cache at {self.directory}: {e}")
+        os.makedirs(self.directory, exist_ok=True)
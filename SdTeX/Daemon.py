@@ -0,0 +1,379 @@
+import os
+import json
+import math
+import stat
+import time
+import errno
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from Batch import start_worker, compile_document
+from Errors import *
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_SERVER_WORKERS = os.cpu_count() or 1
+# Jobs allowed to wait for a worker before new ones are turned away
+DEFAULT_MAX_QUEUE = 16
+DEFAULT_JOB_TIMEOUT = 60.0
+# Largest source accepted in a request body
+MAX_SOURCE_SIZE = 64 * 1024 * 1024
+# Latencies kept for percentiles, and the span throughput is averaged over
+STATS_WINDOW = 1000
+THROUGHPUT_SECONDS = 60
+CHUNK_SIZE = 64 * 1024
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def serve_jobs(connection, options):
+    # Runs in each worker process: warm up once, then compile until told to
+    # stop. Ctrl+C reaches the whole process group; the server shuts us down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    start_worker(options)
+    connection.send("ready")
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        connection.send(compile_document(*job))
+
+
+class Worker:
+    def __init__(self, options):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_jobs, args=(child_connection, options), daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+        self.ready = False
+
+    def run(self, source, output_file, timeout):
+        try:
+            # A fresh worker is still importing; that is not the job's time
+            if not self.ready:
+                self.connection.recv()
+                self.ready = True
+            self.connection.send((source, output_file))
+            if not self.connection.poll(timeout):
+                raise JobTimeout(f"Error: Rendering took longer than {timeout:g}s")
+            return self.connection.recv()
+        except (EOFError, OSError):
+            raise WorkerCrashed("Error: The worker rendering this document exited")
+
+    def stop(self, wait=1.0):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(wait)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+
+class WorkerPool:
+    """
+    Worker processes started up front, each with SdTeX, fpdf and matplotlib
+    already imported. A job that runs past its timeout, or takes its worker
+    down with it, costs that worker, which is replaced by a fresh one.
+    """
+
+    def __init__(self, options, size=DEFAULT_SERVER_WORKERS):
+        self.options = options
+        self.size = max(size, 1)
+        self.idle = queue.Queue()
+        for _ in range(self.size):
+            self.idle.put(Worker(options))
+
+    def run(self, source, output_file, timeout):
+        worker = self.idle.get()
+        try:
+            return worker.run(source, output_file, timeout)
+        except (JobTimeout, WorkerCrashed):
+            worker.kill()
+            worker = Worker(self.options)
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for _ in range(self.size):
+            self.idle.get().stop()
+
+
+class RenderStats:
+    def __init__(self, window=STATS_WINDOW):
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.counts = {"completed": 0, "failed": 0, "timed_out": 0, "rejected": 0}
+        self.in_flight = 0
+        # (finished at, seconds) of the most recent jobs
+        self.latencies = deque(maxlen=window)
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def finish(self, outcome, seconds):
+        with self.lock:
+            self.in_flight -= 1
+            self.counts[outcome] += 1
+            self.latencies.append((time.monotonic(), seconds))
+
+    def reject(self):
+        with self.lock:
+            self.counts["rejected"] += 1
+
+    def snapshot(self, pool_size, capacity):
+        with self.lock:
+            now = time.monotonic()
+            latencies = sorted(seconds for _, seconds in self.latencies)
+            recent = sum(1 for finished, _ in self.latencies if finished > now - THROUGHPUT_SECONDS)
+            uptime = now - self.started
+            return {
+                "uptime_s": round(uptime, 3),
+                "workers": pool_size,
+                "capacity": capacity,
+                "in_flight": self.in_flight,
+                **self.counts,
+                "throughput_per_s": round(recent / max(min(uptime, THROUGHPUT_SECONDS), 1e-9), 3),
+                "latency_ms": {
+                    name: round(percentile(latencies, fraction) * 1000, 2) if latencies else None
+                    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))
+                },
+            }
+
+
+def percentile(values, fraction):
+    # Nearest rank over sorted values
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/stats":
+            return self.send_text(404, "Not found")
+        self.send_json(200, self.server.renderer.stats_snapshot())
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            return self.send_text(404, "Not found")
+
+        renderer = self.server.renderer
+        if not renderer.admit():
+            # The body is left unread, so the connection cannot be reused
+            self.close_connection = True
+            return self.send_text(503, "Busy, try again shortly", {"Retry-After": "1"})
+
+        job_dir = tempfile.mkdtemp(prefix="sdtex-job-")
+        try:
+            source = self.job_source(parse_qs(url.query), job_dir)
+            if source is None:
+                return
+            output_file = os.path.join(job_dir, "output.pdf")
+            status, message = renderer.render(source, output_file)
+            if status != 200:
+                return self.send_text(status, message)
+            self.send_pdf(output_file)
+        finally:
+            renderer.release()
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    def job_source(self, query, job_dir):
+        # Either a file on disk, which keeps its includes working, or the
+        # source itself as the request body
+        if "path" in query:
+            path = os.path.abspath(query["path"][0])
+            if not os.path.isfile(path):
+                self.send_text(400, f"Error: {path} does not exist")
+                return None
+            return path
+
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.send_text(411, "Error: Send the source with a Content-Length, or pass ?path=")
+            return None
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body's end is unknown, so the connection cannot be reused
+            self.close_connection = True
+            self.send_text(400, "Error: Content-Length must be a whole number of bytes")
+            return None
+        if length > MAX_SOURCE_SIZE:
+            self.close_connection = True
+            self.send_text(413, f"Error: Sources are limited to {MAX_SOURCE_SIZE} bytes")
+            return None
+
+        path = os.path.join(job_dir, "document.sdtex")
+        with open(path, "wb") as f:
+            remaining = length
+            while remaining:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        return path
+
+    def send_pdf(self, output_file):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(os.path.getsize(output_file)))
+        self.end_headers()
+        with open(output_file, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+
+    def send_text(self, status, message, headers=None):
+        self.send_body(status, "text/plain; charset=utf-8", f"{message}\n".encode("utf-8"), headers)
+
+    def send_json(self, status, payload):
+        self.send_body(status, "application/json", json.dumps(payload).encode("utf-8"))
+
+    def send_body(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # A socket left behind by an earlier daemon is replaced; any other
+        # file at the path is not ours to delete
+        try:
+            mode = os.lstat(self.server_address).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(errno.EEXIST, "A file that is not a socket is in the way", self.server_address)
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = "localhost", 0
+
+
+class RenderServer:
+    """
+    Compiles documents sent over localhost HTTP or a Unix socket on a pool of
+    warm workers and streams the PDFs back.
+
+    At most workers + max_queue jobs are admitted at once; anything beyond
+    that is answered 503 straight away rather than piling up. A job running
+    past job_timeout seconds is answered 504 and its worker replaced.
+    """
+
+    def __init__(
+        self,
+        options,
+        host=DEFAULT_HOST,
+        port=DEFAULT_PORT,
+        socket_path=None,
+        workers=DEFAULT_SERVER_WORKERS,
+        max_queue=DEFAULT_MAX_QUEUE,
+        job_timeout=DEFAULT_JOB_TIMEOUT,
+    ):
+        self.options = options
+        self.job_timeout = job_timeout
+        self.capacity = max(workers, 1) + max(max_queue, 0)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+        self.stats = RenderStats()
+        self.pool = WorkerPool(options, workers)
+        try:
+            if socket_path:
+                self.httpd = UnixHTTPServer(socket_path, RenderHandler)
+            else:
+                self.httpd = ThreadingHTTPServer((host, port), RenderHandler)
+        except OSError as e:
+            self.pool.close()
+            raise SdTeXProcessingError(f"Error: Could not listen on {socket_path or f'{host}:{port}'}: {e}")
+        self.httpd.renderer = self
+
+    @property
+    def address(self):
+        if isinstance(self.httpd.server_address, str):
+            return f"unix:{self.httpd.server_address}"
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def admit(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        self.stats.reject()
+        return False
+
+    def release(self):
+        self.slots.release()
+
+    def render(self, source, output_file):
+        started = time.perf_counter()
+        self.stats.start()
+        outcome = "failed"
+        try:
+            _, _, _, error = self.pool.run(source, output_file, self.job_timeout)
+            if error:
+                return 422, error
+            outcome = "completed"
+            return 200, None
+        except JobTimeout as e:
+            outcome = "timed_out"
+            return 504, e.args[0]
+        except WorkerCrashed as e:
+            return 500, e.args[0]
+        finally:
+            self.stats.finish(outcome, time.perf_counter() - started)
+
+    def stats_snapshot(self):
+        return self.stats.snapshot(self.pool.size, self.capacity)
+
+    def serve_forever(self):
+        print(f"Serving on {self.address} with {self.pool.size} worker(s). Press Ctrl+C to stop.")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            print("Stopped serving.")
+        finally:
+            self.close()
+
+    def close(self):
+        self.httpd.server_close()
+        if isinstance(self.httpd.server_address, str) and os.path.exists(self.httpd.server_address):
+            os.remove(self.httpd.server_address)
+        self.pool.close()
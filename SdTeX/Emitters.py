@@ -0,0 +1,354 @@
+import os
+import re
+import html
+import shutil
+import tempfile
+from urllib.parse import quote, urlsplit
+import Fonts
+from Renderers import *
+from Errors import *
+
+
+# The method each tag is written by, in every format
+TAG_METHODS = {
+    "text": "text",
+    "sdtitle": "title",
+    "sdquote": "quote",
+    "sdauthor": "author",
+    "sdbullet": "bullet",
+    "sdcode": "code",
+    "sdlink": "link",
+    "sdnline": "newline",
+    "sdfooter": "footer",
+    "attribution": "attribution",
+    "sdimage": "image",
+    "sdgraph": "graph",
+}
+
+# CSS for the core fonts; anything else is passed through as a family name
+CORE_FONT_FAMILIES = {
+    "arial": "Arial, Helvetica, sans-serif",
+    "helvetica": "Arial, Helvetica, sans-serif",
+    "times": '"Times New Roman", Times, serif',
+    "courier": '"Courier New", Courier, monospace',
+}
+
+# Schemes a link may use; anything else, javascript: above all, is shown as text
+LINK_SCHEMES = ("http", "https", "mailto")
+# Body text kept in memory before it spills to a temporary file
+BODY_SPOOL_SIZE = 1 << 20
+
+MARKDOWN_SPECIAL = re.compile(r"([\\`*_\[\]<>|])")
+# Text at the start of a line that would begin a heading, quote or list
+MARKDOWN_LINE_START = re.compile(r"^(\s*)([#>+-])", re.MULTILINE)
+MARKDOWN_NUMBERED = re.compile(r"^(\s*\d+)\.", re.MULTILINE)
+# What would end a <...> link destination early, or let text after it out
+MARKDOWN_URL_UNSAFE = re.compile(r"[<>\\\s]")
+
+
+class Emitter:
+    """
+    Writes a document's nodes as text, one node at a time, without laying
+    out any pages. Graphs are rendered into the render cache as for a PDF
+    and referenced by URL, as are images, which are not downloaded at all.
+
+    Asset URLs are relative to the output file unless asset_url is given, in
+    which case they are asset_url followed by the file name, for a server
+    that publishes the cache directory.
+    """
+
+    name = None
+    extension = None
+
+    def __init__(self, sdtex, output, directory, asset_url=None):
+        self.sdtex = sdtex
+        self.output = output
+        self.directory = directory
+        self.asset_url = asset_url
+        self.in_list = False
+
+    def emit(self, attributes):
+        self.start()
+        # Containers are walked with a stack, so deep nesting does not hit
+        # the recursion limit
+        pending = [iter(attributes)]
+        while pending:
+            attribute = next(pending[-1], None)
+            if attribute is None:
+                pending.pop()
+            elif attribute["type"] == "sdtex":
+                pending.append(iter(attribute["children"]))
+            else:
+                self.node(attribute)
+        self.close_list()
+        self.finish()
+
+    def node(self, attribute):
+        method = TAG_METHODS.get(attribute["type"])
+        if method is None:
+            raise SdTeXTagNotFoundError(f"Error: Tag {attribute['type']} has no {self.name} output")
+        if method != "bullet":
+            self.close_list()
+        getattr(self, method)(attribute)
+
+    def close_list(self):
+        if self.in_list:
+            self.in_list = False
+            self.end_list()
+
+    def graph_path(self, attribute):
+        settings = self.sdtex.graph_settings(attribute)
+        path = self.sdtex.assets.get(("sdgraph", settings))
+        if path is None:
+            path = self.sdtex.render_graph(settings)
+        return path, settings.label
+
+    def url(self, path):
+        if self.asset_url:
+            return f"{self.asset_url.rstrip('/')}/{quote(os.path.basename(path))}"
+        try:
+            return quote(os.path.relpath(path, self.directory).replace(os.sep, "/"))
+        except ValueError:
+            # Another drive on Windows has no relative path
+            from pathlib import Path
+
+            return Path(path).as_uri()
+
+    def start(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def end_list(self):
+        pass
+
+
+class HtmlEmitter(Emitter):
+    name = "HTML"
+    extension = ".html"
+
+    # Element and default style of each tag, so the page looks like the PDF
+    ELEMENTS = {
+        "sdtitle": ("h1", TITLE_STYLE),
+        "sdquote": ("blockquote", QUOTE_STYLE),
+        "sdauthor": ("p", AUTHOR_STYLE),
+        "sdbullet": ("li", BULLET_STYLE),
+        "sdcode": ("pre", CODE_STYLE),
+        "sdlink": ("p", LINK_STYLE),
+        "sdfooter": ("footer", FOOTER_STYLE),
+        "attribution": ("p", COPYRIGHT_STYLE),
+    }
+
+    def __init__(self, sdtex, output, directory, asset_url=None):
+        super().__init__(sdtex, output, directory, asset_url)
+        # Font files declared so far, by path
+        self.font_faces = {}
+
+    def start(self):
+        # The body is written aside first, so the @font-face rules for every
+        # font file it uses can go in the head
+        self.document = self.output
+        self.output = tempfile.SpooledTemporaryFile(BODY_SPOOL_SIZE, "w+", encoding="utf-8")
+
+    def finish(self):
+        body, self.output = self.output, self.document
+        title = html.escape(os.path.basename(self.sdtex.input_file))
+        rules = "\n".join(
+            f"    .{tag} {{ {css(defaults, self.font_family(defaults.family))} }}"
+            for tag, (_, defaults) in self.ELEMENTS.items()
+        )
+        faces = "".join(
+            f'    @font-face {{ font-family: "{name}"; src: url("{css_string(self.url(path))}"); }}\n'
+            for path, name in self.font_faces.items()
+        )
+        self.output.write(
+            "<!DOCTYPE html>\n"
+            '<html>\n<head>\n<meta charset="utf-8">\n'
+            f"<title>{title}</title>\n"
+            "<style>\n"
+            "    body { margin: 15mm auto; max-width: 180mm; font: 12pt Arial, Helvetica, sans-serif; }\n"
+            "    h1, p, blockquote, pre, ul, footer { margin: 0 0 0.5em; }\n"
+            "    blockquote { padding: 0; }\n"
+            "    ul { padding-left: 0; list-style: none; }\n"
+            "    li::before { content: \"- \"; }\n"
+            "    img { display: block; width: 180mm; max-width: 100%; }\n"
+            "    a { color: inherit; }\n"
+            "    .sdfooter, .attribution { text-align: right; }\n"
+            f"{rules}\n"
+            f"{faces}"
+            "</style>\n"
+            "</head>\n<body>\n"
+        )
+        body.seek(0)
+        shutil.copyfileobj(body, self.output)
+        body.close()
+        self.output.write("</body>\n</html>\n")
+
+    def end_list(self):
+        self.output.write("</ul>\n")
+
+    def element(self, attribute, body):
+        element, defaults = self.ELEMENTS[attribute["type"]]
+        style = ""
+        if attribute["style"]:
+            resolved = self.sdtex.styles.resolve(attribute["style"], defaults)
+            style = f' style="{html.escape(css(resolved, self.font_family(resolved.family)))}"'
+        self.output.write(f'<{element} class="{attribute["type"]}"{style}>{body}</{element}>\n')
+
+    def font_family(self, family):
+        if not Fonts.is_font_file(family):
+            return CORE_FONT_FAMILIES.get(family.lower(), f'"{family}"')
+        path = self.sdtex.font_path(family)
+        name = self.font_faces.get(path)
+        if name is None:
+            name = self.font_faces[path] = f"sdtex-font-{len(self.font_faces) + 1}"
+        return f'"{name}"'
+
+    def text(self, attribute):
+        self.output.write(f"<p>{lines(attribute['content'])}</p>\n")
+
+    def title(self, attribute):
+        self.element(attribute, lines(attribute["content"]))
+
+    def quote(self, attribute):
+        self.element(attribute, lines(attribute["content"]))
+
+    def author(self, attribute):
+        self.element(attribute, lines(attribute["content"]))
+
+    def footer(self, attribute):
+        self.element(attribute, lines(attribute["content"]))
+
+    def attribution(self, attribute):
+        self.element(attribute, lines(attribute["content"]))
+
+    def bullet(self, attribute):
+        if not self.in_list:
+            self.in_list = True
+            self.output.write("<ul>\n")
+        self.element(attribute, lines(attribute["content"]))
+
+    def code(self, attribute):
+        self.element(attribute, f"<code>{html.escape(attribute['content'], quote=False)}</code>")
+
+    def link(self, attribute):
+        content = attribute["content"]
+        url = attribute.get("url", content)
+        if not is_safe_url(url):
+            self.element(attribute, lines(content))
+            return
+        self.element(attribute, f'<a href="{html.escape(url)}">{lines(content)}</a>')
+
+    def newline(self, attribute):
+        height = int(attribute["attributes"].get("line_height", 0))
+        self.output.write(f'<div class="sdnline" style="height: {height}mm"></div>\n' if height else "<br>\n")
+
+    def image(self, attribute):
+        src = html.escape(attribute["content"])
+        self.output.write(f'<img class="sdimage" src="{src}" alt="">\n')
+
+    def graph(self, attribute):
+        path, label = self.graph_path(attribute)
+        self.output.write(
+            f'<img class="sdgraph" src="{html.escape(self.url(path))}" alt="{html.escape(label)}">\n'
+        )
+
+
+class MarkdownEmitter(Emitter):
+    name = "Markdown"
+    extension = ".md"
+
+    def block(self, text):
+        self.output.write(f"{text}\n\n")
+
+    def end_list(self):
+        self.output.write("\n")
+
+    def text(self, attribute):
+        self.block(escape_markdown(attribute["content"]))
+
+    def title(self, attribute):
+        self.block(f"# {escape_markdown(attribute['content'].replace(chr(10), ' '))}")
+
+    def quote(self, attribute):
+        self.block("\n".join(f"> {line}" for line in escape_markdown(attribute["content"]).split("\n")))
+
+    def author(self, attribute):
+        self.block(f"*{escape_markdown(attribute['content'])}*")
+
+    def footer(self, attribute):
+        self.block(f"---\n\n{escape_markdown(attribute['content'])}")
+
+    def attribution(self, attribute):
+        self.block(f"<small>{html.escape(attribute['content'], quote=False)}</small>")
+
+    def bullet(self, attribute):
+        self.in_list = True
+        self.output.write(f"- {escape_markdown(attribute['content'].replace(chr(10), ' '))}\n")
+
+    def code(self, attribute):
+        content = attribute["content"]
+        # The fence is longer than any run of backticks inside the code
+        fence = "`" * max(3, max(map(len, re.findall("`+", content)), default=0) + 1)
+        self.block(f"{fence}\n{content}\n{fence}")
+
+    def link(self, attribute):
+        content = attribute["content"]
+        url = attribute.get("url", content)
+        if not is_safe_url(url):
+            self.block(escape_markdown(content))
+            return
+        self.block(f"[{escape_markdown(content)}](<{markdown_url(url)}>)")
+
+    def newline(self, attribute):
+        self.block("<br>")
+
+    def image(self, attribute):
+        self.block(f"![](<{markdown_url(attribute['content'])}>)")
+
+    def graph(self, attribute):
+        path, label = self.graph_path(attribute)
+        self.block(f"![{escape_markdown(label)}](<{markdown_url(self.url(path))}>)")
+
+
+EMITTERS = {"html": HtmlEmitter, "md": MarkdownEmitter}
+
+
+def lines(text):
+    return "<br>\n".join(html.escape(line, quote=False) for line in text.split("\n"))
+
+
+def is_safe_url(url):
+    # Relative URLs have no scheme
+    try:
+        scheme = urlsplit(url).scheme
+    except ValueError:
+        return False
+    return not scheme or scheme.lower() in LINK_SCHEMES
+
+
+def markdown_url(url):
+    return MARKDOWN_URL_UNSAFE.sub(lambda match: quote(match.group()), url)
+
+
+def css_string(text):
+    # For text inside a quoted CSS string in a <style> element, where HTML
+    # escapes are not decoded
+    return text.replace("\\", "\\\\").replace('"', '\\"').replace("<", "\\3c ")
+
+
+def css(style, family):
+    # style is StyleDefaults or ResolvedStyle; sizes are in points, as in the PDF
+    color = style.color if isinstance(style.color, str) else "#%02x%02x%02x" % style.color
+    rules = [f"font-family: {family}", f"font-size: {int(str(style.size).replace('dp', ''))}pt", f"color: {color}"]
+    rules.append(f"font-weight: {'bold' if 'B' in style.style else 'normal'}")
+    rules.append(f"font-style: {'italic' if 'I' in style.style else 'normal'}")
+    rules.append(f"text-decoration: {'underline' if 'U' in style.style else 'none'}")
+    return "; ".join(rules)
+
+
+def escape_markdown(text):
+    text = MARKDOWN_SPECIAL.sub(r"\\\1", text)
+    text = MARKDOWN_LINE_START.sub(r"\1\\\2", text)
+    return MARKDOWN_NUMBERED.sub(r"\1\\.", text)
@@ -27,3 +27,5 @@ class SdTeXAttributeError(SdTeXError):
 class SdTeXSrcError(SdTeXError):
     pass
 
+class SdTeXIncludeError(SdTeXError):
+    pass
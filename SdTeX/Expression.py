@@ -0,0 +1,237 @@
+import ast
+import operator
+from functools import lru_cache
+import numpy as np
+from Errors import *
+
+
+FUNCTIONS = {
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "asin": np.arcsin,
+    "acos": np.arccos,
+    "atan": np.arctan,
+    "arcsin": np.arcsin,
+    "arccos": np.arccos,
+    "arctan": np.arctan,
+    "sinh": np.sinh,
+    "cosh": np.cosh,
+    "tanh": np.tanh,
+    "exp": np.exp,
+    "log": np.log,
+    "ln": np.log,
+    "log2": np.log2,
+    "log10": np.log10,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+    "floor": np.floor,
+    "ceil": np.ceil,
+    "sign": np.sign,
+    "min": np.minimum,
+    "max": np.maximum,
+    "pow": np.power,
+}
+
+# Functions of two arguments; every other function takes one. Extra arguments
+# would reach the ufunc as its out= array.
+BINARY_FUNCTIONS = frozenset(("min", "max", "pow"))
+
+CONSTANTS = {
+    "pi": np.pi,
+    "e": np.e,
+    "tau": 2 * np.pi,
+}
+
+BINARY_OPERATORS = (
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+)
+
+UNARY_OPERATORS = (ast.UAdd, ast.USub)
+
+# Largest constant exponent a graph function may raise to. Constants are
+# Python ints, so 9**9**9 would otherwise be computed digit by digit.
+MAX_EXPONENT = 1000
+
+CONSTANT_OPERATIONS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+class Expression:
+    def __init__(self, source, variable="x"):
+        self.source = source.strip().strip('"').strip("'").strip()
+        self.variable = variable
+        self.code = self.compile()
+
+    def compile(self):
+        if not self.source:
+            raise SdTeXAttributeError("Error: Graph function is empty")
+
+        # "x^2" is what people write in a graph function. Rewriting it before
+        # parsing gives it the precedence of **, above * and unary minus,
+        # where Python's xor would bind below them.
+        try:
+            tree = ast.parse(self.source.replace("^", "**"), mode="eval")
+        except SyntaxError as e:
+            raise SdTeXAttributeError(
+                f"Error: Invalid graph function '{self.source}': {e.msg}"
+            )
+
+        for node in ast.walk(tree):
+            self.validate(node)
+
+        return compile(tree, "<sdgraph>", "eval")
+
+    def validate(self, node):
+        if isinstance(node, (ast.Expression, ast.Load)):
+            return
+        if isinstance(node, ast.BinOp):
+            if not isinstance(node.op, BINARY_OPERATORS):
+                raise SdTeXAttributeError(
+                    f"Error: Operator {type(node.op).__name__} is not allowed in graph function '{self.source}'"
+                )
+            if isinstance(node.op, ast.Pow):
+                exponent = constant_value(node.right)
+                value = constant_value(node)
+                # Negative exponents give floats, which cannot take long
+                if exponent is not None and not exponent <= MAX_EXPONENT:
+                    raise SdTeXAttributeError(
+                        f"Error: Exponents above {MAX_EXPONENT} are not allowed in graph function '{self.source}'"
+                    )
+                if value is not None and np.isinf(value):
+                    raise SdTeXAttributeError(
+                        f"Error: Power is too large in graph function '{self.source}'"
+                    )
+            return
+        if isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, UNARY_OPERATORS):
+                raise SdTeXAttributeError(
+                    f"Error: Operator {type(node.op).__name__} is not allowed in graph function '{self.source}'"
+                )
+            return
+        if isinstance(node, (ast.operator, ast.unaryop)):
+            return
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise SdTeXAttributeError(
+                    f"Error: Constant {node.value!r} is not allowed in graph function '{self.source}'"
+                )
+            return
+        if isinstance(node, ast.Name):
+            if node.id != self.variable and node.id not in CONSTANTS and node.id not in FUNCTIONS:
+                raise SdTeXAttributeError(
+                    f"Error: Unknown name '{node.id}' in graph function '{self.source}'"
+                )
+            return
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                raise SdTeXAttributeError(
+                    f"Error: Unknown function in graph function '{self.source}'"
+                )
+            if node.keywords:
+                raise SdTeXAttributeError(
+                    f"Error: Keyword arguments are not allowed in graph function '{self.source}'"
+                )
+            arity = 2 if node.func.id in BINARY_FUNCTIONS else 1
+            if len(node.args) != arity:
+                raise SdTeXAttributeError(
+                    f"Error: {node.func.id} takes {arity} argument{'s' if arity > 1 else ''}, "
+                    f"not {len(node.args)}, in graph function '{self.source}'"
+                )
+            return
+        raise SdTeXAttributeError(
+            f"Error: {type(node).__name__} is not allowed in graph function '{self.source}'"
+        )
+
+    def evaluate(self, x_values, mask=True):
+        x_values = np.asarray(x_values, dtype=float)
+        namespace = {**FUNCTIONS, **CONSTANTS, self.variable: x_values}
+
+        with np.errstate(all="ignore"):
+            try:
+                y_values = np.asarray(eval(self.code, {"__builtins__": {}}, namespace))
+                if np.iscomplexobj(y_values):
+                    # A negative number to a fractional power; not on the real plot
+                    y_values = np.where(y_values.imag == 0, y_values.real, np.nan)
+                y_values = np.broadcast_to(y_values.astype(float), x_values.shape).copy()
+            except (TypeError, ValueError, ArithmeticError) as e:
+                raise SdTeXAttributeError(
+                    f"Error: Could not evaluate graph function '{self.source}': {e}"
+                )
+
+        y_values[~np.isfinite(y_values)] = np.nan
+        return mask_discontinuities(y_values) if mask else y_values
+
+
+def constant_value(node):
+    """
+    The value of an expression made only of numbers and named constants, as
+    a float, or None if it depends on the variable or a function. Folding in
+    floats keeps huge powers from being computed; they overflow to inf.
+    """
+    if isinstance(node, ast.Constant):
+        try:
+            return float(node.value)
+        except OverflowError:
+            return float("inf")
+    if isinstance(node, ast.Name):
+        return CONSTANTS.get(node.id)
+    if isinstance(node, ast.UnaryOp):
+        operand = constant_value(node.operand)
+        return None if operand is None else CONSTANT_OPERATIONS[type(node.op)](operand)
+    if isinstance(node, ast.BinOp):
+        left, right = constant_value(node.left), constant_value(node.right)
+        if left is None or right is None:
+            return None
+        try:
+            value = CONSTANT_OPERATIONS[type(node.op)](left, right)
+        except OverflowError:
+            return float("inf")
+        except ArithmeticError:
+            return None
+        # A negative number to a fractional power is complex
+        return value if isinstance(value, float) else None
+    return None
+
+
+def mask_discontinuities(y_values, jump_factor=4.0):
+    # Poles (tan, 1/x, ...) show up as a sign flip with a jump far larger than the
+    # typical magnitude of the curve; breaking the line there keeps matplotlib from
+    # drawing a vertical stroke across the plot.
+    if y_values.size < 3:
+        return y_values
+
+    finite = np.isfinite(y_values)
+    if not finite.any():
+        return y_values
+
+    scale = np.percentile(np.abs(y_values[finite]), 90)
+    if scale == 0:
+        return y_values
+
+    jumps = np.abs(np.diff(y_values))
+    flips = np.signbit(y_values[:-1]) != np.signbit(y_values[1:])
+    breaks = np.flatnonzero(flips & (jumps > jump_factor * scale))
+    if breaks.size:
+        y_values[breaks] = np.nan
+    return y_values
+
+
+@lru_cache(maxsize=128)
+def compile_expression(source, variable="x"):
+    return Expression(source, variable)
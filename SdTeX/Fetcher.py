@@ -0,0 +1,124 @@
+import os
+import threading
+from Errors import *
+
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CONNECTIONS_PER_HOST = 4
+CHUNK_SIZE = 64 * 1024
+
+DOWNLOADED = "downloaded"
+NOT_MODIFIED = "not_modified"
+FAILED = "failed"
+
+
+class FetchResult:
+    def __init__(self, status, status_code=None, etag=None, last_modified=None):
+        self.status = status
+        self.status_code = status_code
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class ImageFetcher:
+    def __init__(
+        self,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.connections_per_host = connections_per_host
+        self.session = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # requests is only imported once a document actually has an image
+        with self.lock:
+            if self.session is None:
+                self.session = self.create_session()
+            return self.session
+
+    def create_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        session = requests.Session()
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            raise_on_status=False,
+        )
+        # pool_block caps the open connections to any one host; extra
+        # downloads for that host wait for a free connection instead of
+        # opening more.
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=self.connections_per_host,
+            pool_block=True,
+            max_retries=retry,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def fetch(self, url, output_path, etag=None, last_modified=None):
+        partial_path = f"{output_path}.part"
+        try:
+            with open(partial_path, "wb") as f:
+                result = self.download(url, f, etag, last_modified)
+            if result.status == DOWNLOADED:
+                os.replace(partial_path, output_path)
+            return result
+        except OSError as e:
+            raise SdTeXSrcError(f"Error saving image from {url} to {output_path}: {e}")
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def download(self, url, output, etag=None, last_modified=None):
+        # Writes the body to output, any writable binary file object
+        import requests
+
+        session = self.connect()
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        try:
+            with session.get(
+                url, headers=headers, stream=True, timeout=self.timeout
+            ) as response:
+                if response.status_code == 304:
+                    return FetchResult(NOT_MODIFIED, 304, etag, last_modified)
+                if response.status_code != 200:
+                    return FetchResult(FAILED, response.status_code)
+
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    output.write(chunk)
+
+                return FetchResult(
+                    DOWNLOADED,
+                    200,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+        except requests.exceptions.RequestException as e:
+            raise SdTeXSrcError(f"Error downloading image from {url}: {e}")
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
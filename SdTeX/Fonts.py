@@ -0,0 +1,243 @@
+import io
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from Errors import *
+
+
+FONT_EXTENSIONS = (".ttf", ".otf")
+# fpdf writes text as 16-bit codes, so only the Basic Multilingual Plane is drawn
+MAX_CODE = 0xFFFF
+# Subsets kept per process, so a document rebuilt in watch mode or by the
+# daemon does not subset its fonts again
+MAX_SUBSETS = 64
+# Largest distance, in font units, between a CFF curve and the quadratic
+# curves that replace it
+CURVE_TOLERANCE = 1.0
+
+
+def is_font_file(family):
+    return family.lower().endswith(FONT_EXTENSIONS)
+
+
+def load_fonttools():
+    # fontTools comes with matplotlib, but is only needed once a document
+    # uses a font file
+    try:
+        from fontTools import ttLib, subset
+    except ImportError:
+        raise SdTeXStyleError("Error: Font files need the fontTools package (pip install fonttools)")
+    # The subsetter warns about every table it drops without knowing it
+    logging.getLogger("fontTools.subset").setLevel(logging.ERROR)
+    return ttLib, subset
+
+
+class FontFace:
+    """
+    A font file parsed once per process: the metrics fpdf describes a font
+    with, in thousandths of the font size, and the file's bytes, which every
+    subset is cut from.
+    """
+
+    def __init__(self, path, stamp, data, name, desc, underline_position, underline_thickness, widths):
+        self.path = path
+        self.stamp = stamp
+        self.data = data
+        self.name = name
+        self.desc = desc
+        self.underline_position = underline_position
+        self.underline_thickness = underline_thickness
+        # Advance widths indexed by code point, the missing glyph's width
+        # for characters the font does not have
+        self.widths = widths
+
+
+def parse_face(path, stamp, data):
+    ttLib, _ = load_fonttools()
+    try:
+        font = ttLib.TTFont(io.BytesIO(data), lazy=True)
+        if "glyf" not in font and "CFF " not in font:
+            raise SdTeXStyleError(f"Error: Font {path} has neither TrueType nor CFF outlines")
+
+        head, hhea, post, hmtx = font["head"], font["hhea"], font["post"], font["hmtx"]
+        os2 = font["OS/2"] if "OS/2" in font else None
+        scale = 1000 / head.unitsPerEm
+
+        ascent, descent = hhea.ascent, hhea.descent
+        if os2 is not None and os2.sTypoAscender:
+            ascent, descent = os2.sTypoAscender, os2.sTypoDescender
+        cap_height = getattr(os2, "sCapHeight", 0) or ascent
+        weight = os2.usWeightClass if os2 is not None else 400
+
+        # Symbolic, as fonts with their own encoding are, plus fixed pitch,
+        # italic and bold
+        flags = 4
+        if post.isFixedPitch:
+            flags |= 1
+        if post.italicAngle:
+            flags |= 64
+        if weight >= 600:
+            flags |= 262144
+
+        missing = round(hmtx[font.getGlyphOrder()[0]][0] * scale)
+        widths = [missing] * (MAX_CODE + 1)
+        for code, glyph in (font.getBestCmap() or {}).items():
+            if code <= MAX_CODE:
+                widths[code] = round(hmtx[glyph][0] * scale)
+
+        name = font["name"].getDebugName(6) or os.path.splitext(os.path.basename(path))[0]
+        desc = {
+            "Ascent": round(ascent * scale),
+            "Descent": round(descent * scale),
+            "CapHeight": round(cap_height * scale),
+            "Flags": flags,
+            "FontBBox": "[%d %d %d %d]" % tuple(
+                round(value * scale) for value in (head.xMin, head.yMin, head.xMax, head.yMax)
+            ),
+            "ItalicAngle": int(post.italicAngle),
+            "StemV": 50 + int((weight / 65) ** 2),
+            "MissingWidth": missing,
+        }
+        return FontFace(
+            path,
+            stamp,
+            data,
+            re.sub(r"[^A-Za-z0-9_-]", "", name),
+            desc,
+            round(post.underlinePosition * scale),
+            round(post.underlineThickness * scale),
+            widths,
+        )
+    except SdTeXStyleError:
+        raise
+    except Exception as e:
+        raise SdTeXStyleError(f"Error: Could not read font {path}: {e}")
+
+
+def make_subset(face, codes):
+    """
+    A font holding only the glyphs for codes, as TrueType, and the glyph each
+    code is drawn with in it.
+    """
+    ttLib, subset = load_fonttools()
+    font = ttLib.TTFont(io.BytesIO(face.data))
+
+    options = subset.Options()
+    # Text is drawn one glyph per character, so shaping and hinting tables
+    # would only add bytes
+    options.layout_features = []
+    options.drop_tables += ["GSUB", "GPOS", "GDEF", "kern"]
+    options.hinting = False
+    options.notdef_outline = True
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codes)
+    subsetter.subset(font)
+
+    if "glyf" not in font:
+        to_truetype(font)
+
+    glyphs = {
+        code: font.getGlyphID(name) for code, name in (font.getBestCmap() or {}).items() if code in codes
+    }
+    output = io.BytesIO()
+    font.save(output)
+    return output.getvalue(), glyphs
+
+
+def to_truetype(font):
+    # PDF embeds TrueType outlines as a CIDFontType2 font, mapped from the
+    # document's character codes; CFF outlines would need glyph-indexed text
+    # instead, so they are converted to quadratic curves.
+    from fontTools.ttLib import newTable
+    from fontTools.pens.cu2quPen import Cu2QuPen
+    from fontTools.pens.ttGlyphPen import TTGlyphPen
+
+    glyph_order = font.getGlyphOrder()
+    glyph_set = font.getGlyphSet()
+    glyf = newTable("glyf")
+    glyf.glyphOrder = glyph_order
+    glyf.glyphs = {}
+    for name in glyph_order:
+        pen = TTGlyphPen(glyph_set)
+        # CFF contours run counter-clockwise, TrueType ones clockwise
+        glyph_set[name].draw(Cu2QuPen(pen, CURVE_TOLERANCE, reverse_direction=True))
+        glyf.glyphs[name] = pen.glyph()
+
+    for table in ("CFF ", "CFF2", "VORG"):
+        if table in font:
+            del font[table]
+    font["loca"] = newTable("loca")
+    font["glyf"] = glyf
+    glyf.compile(font)
+
+    hmtx = font["hmtx"]
+    for name, glyph in glyf.glyphs.items():
+        if hasattr(glyph, "xMin"):
+            hmtx[name] = (hmtx[name][0], glyph.xMin)
+
+    maxp = font["maxp"] = newTable("maxp")
+    maxp.tableVersion = 0x00010000
+    maxp.maxZones = 1
+    for field in (
+        "maxTwilightPoints", "maxStorage", "maxFunctionDefs", "maxInstructionDefs",
+        "maxStackElements", "maxSizeOfInstructions", "maxComponentElements",
+    ):
+        setattr(maxp, field, 0)
+
+    # Glyph names are not needed to draw anything
+    font["post"].formatType = 3.0
+    font.sfntVersion = "\x00\x01\x00\x00"
+
+
+class FontCache:
+    """
+    Parsed font files, checked against their mtime and size on every load,
+    and the subsets cut from them, keyed by the characters they cover.
+    """
+
+    def __init__(self, max_subsets=MAX_SUBSETS):
+        self.faces = {}
+        self.subsets = OrderedDict()
+        self.max_subsets = max_subsets
+        self.lock = threading.Lock()
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise SdTeXStyleError(f"Error: Font file {path} does not exist")
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            face = self.faces.get(path)
+        if face is None or face.stamp != stamp:
+            with open(path, "rb") as f:
+                face = parse_face(path, stamp, f.read())
+            with self.lock:
+                self.faces[path] = face
+        return face
+
+    def subset(self, face, codes):
+        key = (face, frozenset(codes))
+        with self.lock:
+            cached = self.subsets.get(key)
+            if cached is not None:
+                self.subsets.move_to_end(key)
+                return cached
+
+        try:
+            cached = make_subset(face, key[1])
+        except Exception as e:
+            raise SdTeXStyleError(f"Error: Could not subset font {face.path}: {e}")
+        with self.lock:
+            self.subsets[key] = cached
+            while len(self.subsets) > self.max_subsets:
+                self.subsets.popitem(last=False)
+        return cached
+
+
+# Shared by every document built in the process
+FONTS = FontCache()
@@ -0,0 +1,550 @@
+import io
+import os
+import mmap
+import itertools
+from collections import namedtuple
+from Errors import *
+
+
+# Bumped when sampling changes, so cached renders of the old curves are not reused
+GRAPH_VERSION = 2
+
+DEFAULT_MAX_POINTS = 4000
+INITIAL_POINTS = 256
+MIN_INITIAL_POINTS = 33
+# Largest allowed distance between the curve and its drawn line, as a fraction
+# of the plot height
+TOLERANCE = 1e-3
+MAX_LEVELS = 16
+# Room left above and below the bulk of the curve when poles are cut off
+WINDOW_MARGIN = 0.1
+
+# The first series keeps the green single graphs have always had; the rest
+# follow matplotlib's default cycle
+SERIES_COLORS = ("#00ff00", "#1f77b4", "#ff7f0e", "#d62728", "#9467bd", "#8c564b", "#e377c2", "#17becf")
+# Parametric curves run over a full turn unless told otherwise
+DEFAULT_FIRST_T = 0.0
+DEFAULT_LAST_T = "tau"
+
+# "raster" renders graphs to PNG with matplotlib, "vector" draws them into the
+# page as PDF paths
+GRAPH_OUTPUTS = ("raster", "vector")
+DEFAULT_GRAPH_OUTPUT = "raster"
+
+# Vector graphs, in millimetres unless noted
+DEFAULT_SIMPLIFY = 0.05
+# Axes box as (left, bottom, right, top) fractions of the figure, and the
+# padding around the data, as matplotlib lays out a default figure
+AXES_BOX = (0.125, 0.11, 0.9, 0.88)
+AXIS_MARGIN = 0.05
+MAX_TICKS = 8
+TICK_LENGTH = 1.2
+LINE_WIDTH = 0.5
+LABEL_FONT_SIZE = 9
+# Figure height as a fraction of its width, matching a 6.4 x 4.8 inch figure
+GRAPH_ASPECT = 0.75
+
+
+def load_figure():
+    # Figures are built directly rather than through pyplot, whose current
+    # figure is shared by every thread; saving them needs only Agg, with no
+    # GUI toolkit probing
+    from matplotlib.figure import Figure
+    import matplotlib.backends.backend_agg
+
+    return Figure
+
+
+class GraphSettings(
+    namedtuple(
+        "GraphSettings",
+        "functions parametric data first_point last_point first_t last_t quality colors",
+    )
+):
+    """
+    Everything a chart is drawn from. functions are sources of x, parametric
+    holds (x(t), y(t)) source pairs and data holds (path, mtime_ns, size) for
+    each data file, so a changed file gets a new cache key.
+    """
+
+    __slots__ = ()
+
+    @property
+    def label(self):
+        series = list(self.functions)
+        series += [f"({x_source}, {y_source})" for x_source, y_source in self.parametric]
+        series += [os.path.basename(path) for path, _, _ in self.data]
+        return "; ".join(series)
+
+
+Plot = namedtuple("Plot", "curves x_limits y_limits")
+
+
+def split_list(value):
+    value = value.strip().strip('"').strip("'")
+    return [entry.strip() for entry in value.split(";") if entry.strip()]
+
+
+def parse_pair(source):
+    # "(x(t), y(t))", split at the comma outside any call
+    inner = source.strip()
+    if inner.startswith("(") and inner.endswith(")"):
+        inner = inner[1:-1]
+        depth = 0
+        for index, character in enumerate(inner):
+            if character == "(":
+                depth += 1
+            elif character == ")":
+                depth -= 1
+            elif character == "," and depth == 0:
+                return inner[:index].strip(), inner[index + 1:].strip()
+    raise SdTeXAttributeError(f"Error: Parametric curve '{source}' must look like (x(t), y(t))")
+
+
+def constant_value(source):
+    # Range ends may be written as expressions such as 2*pi
+    from Expression import compile_expression
+
+    value = float(compile_expression(str(source), "t").evaluate(0.0, mask=False))
+    if value != value:
+        raise SdTeXAttributeError(f"Error: Invalid range value {source}")
+    return value
+
+
+def sample_graph(function, first_point, last_point, quality, max_points=DEFAULT_MAX_POINTS):
+    x_values, series, windows = sample_functions((function,), first_point, last_point, quality, max_points)
+    return x_values, series[0], windows[0]
+
+
+def sample_functions(functions, first_point, last_point, quality, max_points=DEFAULT_MAX_POINTS):
+    """
+    Sample every function over [first_point, last_point] for plotting, on one
+    shared x array.
+
+    quality sets the density of the starting grid, as points per unit of x,
+    capped at INITIAL_POINTS. Intervals where any curve is not straight enough
+    to draw as a line are then halved, a whole refinement level per vectorized
+    evaluation, until every segment is within TOLERANCE of the plot height or
+    max_points is reached.
+
+    Returns the x values, one row of y values per function and the (low, high)
+    y range worth showing for each.
+    """
+    from Expression import compile_expression, mask_discontinuities
+
+    expressions = [compile_expression(function) for function in functions]
+
+    def evaluate(x_values):
+        return [expression.evaluate(x_values, mask=False) for expression in expressions]
+
+    x_values, series, windows = refine(evaluate, first_point, last_point, quality, max_points)
+    return x_values, [mask_discontinuities(y_values) for y_values in series], windows
+
+
+def sample_parametric(pairs, first_t, last_t, quality, max_points=DEFAULT_MAX_POINTS):
+    """
+    Sample (x(t), y(t)) curves over [first_t, last_t] on one shared t array.
+    A segment is refined when either coordinate is not straight in t, which
+    also keeps the curve itself straight between samples.
+
+    Returns x and y rows with the (low, high) range worth showing for each.
+    """
+    import numpy as np
+    from Expression import compile_expression, mask_discontinuities
+
+    expressions = [compile_expression(source, "t") for pair in pairs for source in pair]
+
+    def evaluate(t_values):
+        return [expression.evaluate(t_values, mask=False) for expression in expressions]
+
+    _, series, windows = refine(evaluate, first_t, last_t, quality, max_points)
+    series = [mask_discontinuities(values) for values in series]
+    x_rows, y_rows = series[0::2], series[1::2]
+    for x_values, y_values in zip(x_rows, y_rows):
+        # A gap in either coordinate is a gap in the curve
+        gaps = np.isnan(x_values) | np.isnan(y_values)
+        x_values[gaps] = y_values[gaps] = np.nan
+    return x_rows, y_rows, windows[0::2], windows[1::2]
+
+
+def refine(evaluate, first_point, last_point, quality, max_points):
+    import numpy as np
+
+    max_points = max(max_points, MIN_INITIAL_POINTS)
+    initial = int((last_point - first_point) * quality)
+    initial = min(max(initial, MIN_INITIAL_POINTS), INITIAL_POINTS, max_points)
+
+    points = np.linspace(first_point, last_point, initial)
+    series = evaluate(points)
+    windows = [plot_window(values) for values in series]
+
+    for _ in range(MAX_LEVELS):
+        remaining = max_points - points.size
+        if remaining <= 0:
+            break
+
+        error = segment_error(points, series[0], windows[0])
+        for values, window in zip(series[1:], windows[1:]):
+            error = np.maximum(error, segment_error(points, values, window))
+        refine = np.flatnonzero(error > TOLERANCE)
+        if not refine.size:
+            break
+        if refine.size > remaining:
+            # Spend what is left of the budget on the worst segments
+            refine = np.sort(refine[np.argsort(error[refine])[-remaining:]])
+
+        midpoints = (points[refine] + points[refine + 1]) / 2
+        points = np.insert(points, refine + 1, midpoints)
+        series = [
+            np.insert(values, refine + 1, new_values)
+            for values, new_values in zip(series, evaluate(midpoints))
+        ]
+
+    return points, series, windows
+
+
+def load_data(path):
+    """
+    Read a CSV or NPY file as (x, rows): the first column is x and every other
+    column a series. A single column is plotted against its index. NPY files
+    are memory-mapped and CSV files are parsed from a memory map, so neither
+    is read into memory as a whole.
+    """
+    import numpy as np
+
+    try:
+        if path.lower().endswith(".npy"):
+            table = np.load(path, mmap_mode="r")
+        else:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # A first line that is not numbers is a header
+                first_line = mapped.readline()
+                lines = iter(mapped.readline, b"")
+                if is_numeric_row(first_line):
+                    lines = itertools.chain((first_line,), lines)
+                table = np.loadtxt(lines, delimiter=",", ndmin=2)
+    except (OSError, ValueError) as e:
+        raise SdTeXAttributeError(f"Error: Could not read graph data {path}: {e}")
+
+    if table.ndim == 1:
+        table = table.reshape(-1, 1)
+    if table.ndim != 2 or not table.shape[0]:
+        raise SdTeXAttributeError(f"Error: Graph data {path} must be a table of numbers")
+    if table.shape[1] == 1:
+        return np.arange(table.shape[0], dtype=float), [table[:, 0]]
+    return table[:, 0], [table[:, column] for column in range(1, table.shape[1])]
+
+
+def is_numeric_row(line):
+    try:
+        [float(field) for field in line.split(b",")]
+    except ValueError:
+        return False
+    return True
+
+
+def sample_plot(settings, max_points=DEFAULT_MAX_POINTS):
+    """
+    Every curve of a chart as (x, y, color), with the x and y limits to show
+    when poles would otherwise stretch the axes, or None to fit the data.
+    """
+    curves = []
+    x_windows, y_windows = [], []
+
+    if settings.functions:
+        x_values, series, windows = sample_functions(
+            settings.functions, settings.first_point, settings.last_point, settings.quality, max_points
+        )
+        curves += [(x_values, y_values) for y_values in series]
+        x_windows.append((settings.first_point, settings.last_point))
+        y_windows += windows
+
+    if settings.parametric:
+        x_rows, y_rows, x_row_windows, y_row_windows = sample_parametric(
+            settings.parametric, settings.first_t, settings.last_t, settings.quality, max_points
+        )
+        curves += list(zip(x_rows, y_rows))
+        x_windows += x_row_windows
+        y_windows += y_row_windows
+
+    for path, _, _ in settings.data:
+        x_values, series = load_data(path)
+        curves += [(x_values, y_values) for y_values in series]
+        x_windows.append(plot_window(x_values))
+        y_windows += [plot_window(y_values) for y_values in series]
+
+    x_window = min(low for low, _ in x_windows), max(high for _, high in x_windows)
+    y_window = min(low for low, _ in y_windows), max(high for _, high in y_windows)
+    colors = series_colors(settings.colors, len(curves))
+    return Plot(
+        [(x_values, y_values, color) for (x_values, y_values), color in zip(curves, colors)],
+        clipped_limits([x_values for x_values, _ in curves], x_window),
+        clipped_limits([y_values for _, y_values in curves], y_window),
+    )
+
+
+def series_colors(colors, count):
+    # Series without a color of their own take the next palette entry
+    colors = list(colors[:count])
+    while len(colors) < count:
+        colors.append(SERIES_COLORS[len(colors) % len(SERIES_COLORS)])
+    return colors
+
+
+def plot_window(y_values):
+    import numpy as np
+
+    # Taken from the evenly spaced starting grid, so it reflects how much of
+    # the range the curve covers; percentiles keep poles from flattening it
+    finite = y_values[np.isfinite(y_values)]
+    if not finite.size:
+        return -1.0, 1.0
+    low, high = np.percentile(finite, [1, 99])
+    if high - low <= 1e-9 * np.abs(finite).max():
+        # A narrow feature on a flat line; the feature sets the height
+        low, high = finite.min(), finite.max()
+    if high == low:
+        return low - 1.0, high + 1.0
+    margin = (high - low) * WINDOW_MARGIN
+    return low - margin, high + margin
+
+
+def segment_error(x_values, y_values, window):
+    import numpy as np
+
+    low, high = window
+    scale = high - low
+    # What happens far off the plot is never drawn, so it is not refined
+    y_values = np.clip(y_values, low - scale, high + scale)
+
+    # How far each interior point sits from the chord between its neighbours,
+    # as a fraction of the plot height; a segment is as bad as its worst end.
+    x_left, x_middle, x_right = x_values[:-2], x_values[1:-1], x_values[2:]
+    y_left, y_middle, y_right = y_values[:-2], y_values[1:-1], y_values[2:]
+    with np.errstate(all="ignore"):
+        chord = y_left + (y_right - y_left) * (x_middle - x_left) / (x_right - x_left)
+        deviation = np.abs(y_middle - chord) / scale
+    deviation[~np.isfinite(deviation)] = 0.0
+
+    error = np.zeros(x_values.size - 1)
+    error[:-1] = deviation
+    error[1:] = np.maximum(error[1:], deviation)
+
+    # Segments running into a gap in the domain (log, sqrt, ...) are refined
+    # to find where the curve starts or stops
+    missing = np.isnan(y_values)
+    error[missing[:-1] != missing[1:]] = np.inf
+    return error
+
+
+def clipped_limits(arrays, window):
+    import numpy as np
+
+    # Only poles reach more than a whole window beyond it; a curve that merely
+    # ends a little outside (exp near its right edge) keeps its full range
+    low, high = window
+    reach = high - low
+    for values in arrays:
+        if np.nanmin(values, initial=low) < low - reach or np.nanmax(values, initial=high) > high + reach:
+            return low, high
+    return None
+
+
+def save_as_graph(settings, graph_file_path=None):
+    # With no path the PNG is returned as bytes instead of written
+    import matplotlib.colors
+
+    figure = load_figure()()
+    plot = sample_plot(settings)
+
+    axes = figure.add_subplot()
+    for x_values, y_values, color in plot.curves:
+        axes.plot(x_values, y_values, color=matplotlib.colors.to_rgb(color))
+    if plot.x_limits:
+        axes.set_xlim(*plot.x_limits)
+    if plot.y_limits:
+        axes.set_ylim(*plot.y_limits)
+    target = graph_file_path or io.BytesIO()
+    figure.savefig(target, format="png")
+    if graph_file_path is None:
+        return target.getvalue()
+
+
+def simplify(x_values, y_values, tolerance):
+    """
+    Ramer-Douglas-Peucker: drop points closer than tolerance to the line
+    between the points kept on either side of them.
+    """
+    import numpy as np
+
+    count = x_values.size
+    if count < 3 or tolerance <= 0:
+        return x_values, y_values
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    pending = [(0, count - 1)]
+    while pending:
+        start, end = pending.pop()
+        if end - start < 2:
+            continue
+        dx = x_values[end] - x_values[start]
+        dy = y_values[end] - y_values[start]
+        px = x_values[start + 1:end] - x_values[start]
+        py = y_values[start + 1:end] - y_values[start]
+        length = np.hypot(dx, dy)
+        if length:
+            distance = np.abs(dy * px - dx * py) / length
+        else:
+            distance = np.hypot(px, py)
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            pending.append((start, middle))
+            pending.append((middle, end))
+    return x_values[keep], y_values[keep]
+
+
+def nice_ticks(low, high, most=MAX_TICKS):
+    import math
+    import numpy as np
+
+    span = high - low
+    if span <= 0:
+        return np.array([low]), 0
+    magnitude = 10 ** math.floor(math.log10(span / most))
+    for multiple in (1, 2, 2.5, 5, 10):
+        step = multiple * magnitude
+        if span / step <= most:
+            break
+    first = math.ceil(low / step - 1e-9) * step
+    ticks = np.arange(first, high + step * 1e-9, step)
+    decimals = max(0, -math.floor(math.log10(step) + 1e-9)) + (1 if multiple == 2.5 else 0)
+    return ticks, decimals
+
+
+def format_tick(value, decimals):
+    label = f"{value:.{decimals}f}"
+    return "0" if float(label) == 0 else label
+
+
+def axis_limits(arrays):
+    import numpy as np
+
+    # Fits the data with a margin, as matplotlib autoscales
+    lows = [np.nanmin(values, initial=np.inf) for values in arrays]
+    highs = [np.nanmax(values, initial=-np.inf) for values in arrays]
+    low, high = min(lows, default=np.inf), max(highs, default=-np.inf)
+    if not np.isfinite(low) or not np.isfinite(high):
+        return -1.0, 1.0
+    if high == low:
+        return low - 1.0, high + 1.0
+    margin = (high - low) * AXIS_MARGIN
+    return low - margin, high + margin
+
+
+def draw_graph(pdf, settings, left, top, width, height, tolerance=DEFAULT_SIMPLIFY):
+    """
+    Draw the graph straight into the current page as PDF path operators,
+    with a frame, ticks and labels laid out like matplotlib's defaults.
+    """
+    import numpy as np
+    from PIL import ImageColor
+
+    plot = sample_plot(settings)
+    colors = []
+    for _, _, color in plot.curves:
+        try:
+            colors.append(ImageColor.getrgb(color)[:3])
+        except ValueError:
+            raise SdTeXAttributeError(f"Error: Invalid graph_color {color}")
+
+    x_low, x_high = plot.x_limits or axis_limits([x_values for x_values, _, _ in plot.curves])
+    y_low, y_high = plot.y_limits or axis_limits([y_values for _, y_values, _ in plot.curves])
+
+    # The axes box sits where matplotlib puts it inside a figure of this size
+    box_left = left + width * AXES_BOX[0]
+    box_right = left + width * AXES_BOX[2]
+    box_top = top + height * (1 - AXES_BOX[3])
+    box_bottom = top + height * (1 - AXES_BOX[1])
+    x_scale = (box_right - box_left) / (x_high - x_low)
+    y_scale = (box_bottom - box_top) / (y_high - y_low)
+
+    k = pdf.k
+    page_height = pdf.h
+    # PDF user space has its origin at the bottom left, in points
+    to_x = lambda x: (box_left + (x - x_low) * x_scale) * k
+    to_y = lambda y: (page_height - (box_bottom - (y - y_low) * y_scale)) * k
+
+    operators = ["q", "0.8 w", "0 G"]
+    operators.append(
+        "%.2f %.2f %.2f %.2f re S"
+        % (box_left * k, (page_height - box_bottom) * k, (box_right - box_left) * k, (box_bottom - box_top) * k)
+    )
+
+    x_ticks, x_decimals = nice_ticks(x_low, x_high)
+    y_ticks, y_decimals = nice_ticks(y_low, y_high)
+    tick = TICK_LENGTH * k
+    for value in x_ticks:
+        operators.append("%.2f %.2f m %.2f %.2f l S" % (to_x(value), to_y(y_low), to_x(value), to_y(y_low) - tick))
+    for value in y_ticks:
+        operators.append("%.2f %.2f m %.2f %.2f l S" % (to_x(x_low), to_y(value), to_x(x_low) - tick, to_y(value)))
+
+    # Curves are clipped to the axes box; values far beyond it are pulled
+    # in first so the paths stay within what viewers can handle
+    operators.append(
+        "%.2f %.2f %.2f %.2f re W n"
+        % (box_left * k, (page_height - box_bottom) * k, (box_right - box_left) * k, (box_bottom - box_top) * k)
+    )
+    operators.append("%.2f w 1 J 1 j" % (LINE_WIDTH * k))
+    x_reach, y_reach = x_high - x_low, y_high - y_low
+    for (x_values, y_values, _), (red, green, blue) in zip(plot.curves, colors):
+        points_x = to_x(np.clip(x_values, x_low - x_reach, x_high + x_reach))
+        points_y = to_y(np.clip(y_values, y_low - y_reach, y_high + y_reach))
+        operators.append("%.3f %.3f %.3f RG" % (red / 255, green / 255, blue / 255))
+        operators.extend(polyline(points_x, points_y, tolerance * k))
+    operators.append("Q")
+    pdf._out("\n".join(operators))
+
+    draw_tick_labels(pdf, x_ticks, x_decimals, y_ticks, y_decimals, to_x, to_y, x_low, y_low)
+
+
+def polyline(points_x, points_y, tolerance):
+    import numpy as np
+
+    # One path per unbroken run of points
+    finite = np.isfinite(points_x) & np.isfinite(points_y)
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], finite, [False])).astype(np.int8)))
+    for start, end in zip(edges[::2], edges[1::2]):
+        run_x, run_y = simplify(points_x[start:end], points_y[start:end], tolerance)
+        if run_x.size < 2:
+            continue
+        path = ["%.2f %.2f m" % (run_x[0], run_y[0])]
+        path.extend("%.2f %.2f l" % point for point in zip(run_x[1:], run_y[1:]))
+        path.append("S")
+        yield "\n".join(path)
+
+
+def draw_tick_labels(pdf, x_ticks, x_decimals, y_ticks, y_decimals, to_x, to_y, x_low, y_low):
+    family, style, size = pdf.font_family, pdf.font_style, pdf.font_size_pt
+    underline, text_color, color_flag = pdf.underline, pdf.text_color, pdf.color_flag
+
+    pdf.set_font("Arial", size=LABEL_FONT_SIZE)
+    pdf.set_text_color(0, 0, 0)
+    k = pdf.k
+    offset = TICK_LENGTH + 1
+    for value in x_ticks:
+        label = format_tick(value, x_decimals)
+        x = to_x(value) / k - pdf.get_string_width(label) / 2
+        y = pdf.h - to_y(y_low) / k + offset + pdf.font_size
+        pdf.text(x, y, label)
+    for value in y_ticks:
+        label = format_tick(value, y_decimals)
+        x = to_x(x_low) / k - offset - pdf.get_string_width(label)
+        y = pdf.h - to_y(value) / k + pdf.font_size * 0.35
+        pdf.text(x, y, label)
+
+    if family:
+        pdf.set_font(family, style + ("U" if underline else ""), size)
+    pdf.text_color, pdf.color_flag = text_color, color_flag
@@ -0,0 +1,177 @@
+import io
+import os
+import hashlib
+from Cache import RenderCache
+from Errors import *
+
+
+DEFAULT_IMAGE_DPI = 150
+DEFAULT_JPEG_QUALITY = 85
+DEFAULT_PALETTE_COLORS = 256
+MILLIMETERS_PER_INCH = 25.4
+# An empty cache entry saying the original image is the one to embed
+KEEP_ORIGINAL_EXTENSION = ".keep"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageBuffer:
+    """
+    An encoded image held in memory rather than in a file. Anything that
+    takes an image path also takes one of these; name stands in for the path,
+    so it must be unique to the image's contents.
+    """
+
+    __slots__ = ("name", "data")
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def open(self):
+        return io.BytesIO(self.data)
+
+
+def image_file(image):
+    # Something PIL can open, for a path or an ImageBuffer alike
+    return image.open() if isinstance(image, ImageBuffer) else image
+
+
+def image_hash(image):
+    if isinstance(image, ImageBuffer):
+        return hashlib.sha256(image.data).hexdigest()
+    return file_hash(image)
+
+
+def image_size(image):
+    if isinstance(image, ImageBuffer):
+        return len(image.data)
+    return os.path.getsize(image)
+
+
+def image_name(image):
+    return image.name if isinstance(image, ImageBuffer) else image
+
+
+class ImageOptimizer:
+    def __init__(
+        self,
+        output_dir,
+        cache=None,
+        dpi=DEFAULT_IMAGE_DPI,
+        jpeg_quality=DEFAULT_JPEG_QUALITY,
+        palette_colors=DEFAULT_PALETTE_COLORS,
+    ):
+        self.output_dir = output_dir
+        self.cache = cache
+        self.dpi = dpi
+        self.jpeg_quality = jpeg_quality
+        self.palette_colors = palette_colors
+
+    def optimize(self, source, placed_width):
+        # Without a cache, an ImageBuffer is optimized into another one and
+        # nothing is written to disk
+        from PIL import Image as PILImage
+
+        try:
+            source_hash = image_hash(source)
+            with PILImage.open(image_file(source)) as img:
+                source_format = img.format
+                extension = ".png" if self.keeps_alpha(img) else ".jpg"
+        except (OSError, ValueError) as e:
+            raise SdTeXSrcError(f"Error reading image {image_name(source)}: {e}")
+
+        key = RenderCache.key(
+            "optimized", source_hash, placed_width, self.dpi, self.jpeg_quality, self.palette_colors
+        )
+        in_memory = self.cache is None and isinstance(source, ImageBuffer)
+        if self.cache is not None:
+            if self.cache.get(key, KEEP_ORIGINAL_EXTENSION):
+                return source
+            cached_path = self.cache.get(key, extension)
+            if cached_path:
+                return cached_path
+            target = self.cache.temporary_path(extension)
+        elif in_memory:
+            target = io.BytesIO()
+        else:
+            target = os.path.join(self.output_dir, f"image_{key[:16]}{extension}")
+
+        try:
+            resized = self.write(source, target, placed_width, extension)
+        except (OSError, ValueError) as e:
+            if not in_memory and os.path.exists(target):
+                os.remove(target)
+            raise SdTeXSrcError(f"Error optimizing image {image_name(source)}: {e}")
+        if in_memory:
+            target = ImageBuffer(f"image_{key[:16]}{extension}", target.getvalue())
+
+        source_extension = os.path.splitext(image_name(source))[1].lower()
+        if (
+            not resized
+            and source_format in ("JPEG", "PNG")
+            and source_extension in (".jpg", ".jpeg", ".png")
+            and image_size(target) >= image_size(source)
+        ):
+            # Already at or under the target resolution and recompressing
+            # did not help, so the original is the better file to embed
+            if not in_memory:
+                os.remove(target)
+            if self.cache is not None:
+                self.cache.put(key, KEEP_ORIGINAL_EXTENSION, self.cache.temporary_path(KEEP_ORIGINAL_EXTENSION))
+            return source
+
+        if self.cache is not None:
+            return self.cache.put(key, extension, target)
+        return target
+
+    def keeps_alpha(self, img):
+        return img.mode in ("RGBA", "LA", "P", "PA") or "transparency" in img.info
+
+    def write(self, source, target, placed_width, extension):
+        from PIL import Image as PILImage
+        from PIL import ImageOps
+
+        with PILImage.open(image_file(source)) as img:
+            img = ImageOps.exif_transpose(img)
+
+            resized = False
+            if self.dpi:
+                target_width = round(placed_width / MILLIMETERS_PER_INCH * self.dpi)
+                if 0 < target_width < img.width:
+                    target_height = max(round(img.height * target_width / img.width), 1)
+                    img = img.resize((target_width, target_height), PILImage.LANCZOS)
+                    resized = True
+
+            if extension == ".jpg":
+                if img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                img.save(
+                    target,
+                    format="JPEG",
+                    quality=self.jpeg_quality,
+                    optimize=True,
+                    progressive=False,
+                )
+            else:
+                if img.mode != "RGBA":
+                    img = img.convert("RGBA")
+                if self.palette_colors:
+                    img = img.quantize(
+                        colors=self.palette_colors, method=PILImage.FASTOCTREE
+                    )
+                else:
+                    # FPDF cannot embed an alpha channel, so flatten onto the white page
+                    background = PILImage.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                img.save(target, format="PNG", optimize=True)
+
+        return resized
+
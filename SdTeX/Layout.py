@@ -0,0 +1,166 @@
+from Errors import *
+
+
+# Height in millimetres of one line of text, as SdTeX has always used
+LINE_HEIGHT = 10
+# Larger fonts get a line height proportional to their size instead
+LEADING = 1.2
+
+# Glyph width tables by font, shared by every document in the process
+WIDTH_TABLES = {}
+
+
+def width_table(font):
+    # fpdf keeps core font widths in a dict keyed by character and TrueType
+    # widths in a list indexed by code point; both become one array indexed
+    # by code point, in thousandths of the font size
+    import numpy as np
+
+    key = font.get("face") or font.get("ttffile") or font["name"]
+    table = WIDTH_TABLES.get(key)
+    if table is None:
+        widths = font["cw"]
+        if isinstance(widths, dict):
+            table = np.zeros(256, dtype=np.float64)
+            for char, width in widths.items():
+                if len(char) == 1 and ord(char) < 256:
+                    table[ord(char)] = width
+        else:
+            table = np.asarray(widths, dtype=np.float64)
+            missing = font.get("desc", {}).get("MissingWidth") or 500
+            table = np.append(table, missing)
+        WIDTH_TABLES[key] = table
+    return table
+
+
+def measure_words(words, font, font_size):
+    import numpy as np
+
+    if not words:
+        return np.zeros(0)
+
+    table = width_table(font)
+    # One lookup over the whole paragraph; characters past the end of the
+    # table take its last entry, which is 0 for core fonts and the missing
+    # glyph width for TrueType fonts
+    codes = np.frombuffer(" ".join(words).encode("utf-32-le"), dtype=np.uint32)
+    widths = table[np.minimum(codes, len(table) - 1)]
+    offsets = np.concatenate(([0.0], np.cumsum(widths)))
+
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    ends = np.cumsum(lengths + 1) - 1
+    starts = ends - lengths
+    return (offsets[ends] - offsets[starts]) * font_size / 1000.0
+
+
+def break_lines(widths, space, max_width):
+    """
+    Split words into lines no wider than max_width, keeping the right edge as
+    even as possible.
+
+    Minimizes the sum of squared leftover space over every line but the last,
+    which is what a reader sees as ragged. Returns (start, end) word indices.
+    A word wider than the line is given a line of its own.
+    """
+    count = len(widths)
+    if count == 0:
+        return []
+
+    prefix = [0.0]
+    for width in widths:
+        prefix.append(prefix[-1] + float(width))
+
+    best = [0.0] * (count + 1)
+    next_break = [count] * (count + 1)
+    for start in range(count - 1, -1, -1):
+        best[start] = float("inf")
+        for end in range(start + 1, count + 1):
+            line_width = prefix[end] - prefix[start] + space * (end - start - 1)
+            if line_width > max_width and end > start + 1:
+                break
+            slack = max_width - line_width
+            if end == count or slack < 0:
+                slack = 0.0
+            cost = slack * slack + best[end]
+            if cost < best[start]:
+                best[start] = cost
+                next_break[start] = end
+
+    lines = []
+    start = 0
+    while start < count:
+        end = next_break[start]
+        lines.append((start, end))
+        start = end
+    return lines
+
+
+class LayoutEngine:
+    # Every handler moves the page cursor through here, so pdf.y is the only
+    # record of where the next element goes
+
+    def line_height(self, pdf):
+        return max(LINE_HEIGHT, pdf.font_size * LEADING)
+
+    def available_width(self, pdf):
+        return pdf.w - pdf.r_margin - pdf.l_margin - 2 * pdf.c_margin
+
+    def wrap(self, pdf, paragraph):
+        words = paragraph.split()
+        if not words:
+            return [""]
+
+        widths = measure_words(words, pdf.current_font, pdf.font_size)
+        space = measure_words([" "], pdf.current_font, pdf.font_size)[0]
+        return [
+            " ".join(words[start:end])
+            for start, end in break_lines(widths, space, self.available_width(pdf))
+        ]
+
+    def paragraph(self, pdf, text, link="", wrap=True):
+        try:
+            height = self.line_height(pdf)
+            for paragraph in text.split("\n"):
+                lines = self.wrap(pdf, paragraph) if wrap else [paragraph]
+                for line in lines:
+                    pdf.set_x(pdf.l_margin)
+                    pdf.cell(0, height, line, ln=1, link=link)
+        except SdTeXError as e:
+            raise e
+        except Exception as e:
+            raise SdTeXProcessingError(f"Error laying out text: {e}")
+
+    def reserve(self, pdf, height):
+        # Starts a new page when the block does not fit, unless it would not
+        # fit on an empty page either; returns the top of the block
+        if pdf.y + height > pdf.page_break_trigger and pdf.y > pdf.t_margin:
+            pdf.add_page()
+
+        top = pdf.y
+        pdf.set_y(top + height)
+        return top
+
+    def place_image(self, pdf, image_file_path, width, height, link=""):
+        top = self.reserve(pdf, height)
+        pdf.image(image_file_path, x=pdf.l_margin, y=top, w=width, h=height, link=link)
+
+    def fixed(self, pdf):
+        # Footers and similar elements are positioned absolutely; the cursor is
+        # put back afterwards so the flow continues where it left off
+        return SavedCursor(pdf)
+
+
+class SavedCursor:
+    def __init__(self, pdf):
+        self.pdf = pdf
+
+    def __enter__(self):
+        self.x, self.y = self.pdf.x, self.pdf.y
+        self.auto_page_break = self.pdf.auto_page_break
+        self.pdf.set_auto_page_break(False, self.pdf.b_margin)
+        return self.pdf
+
+    def __exit__(self, *exc):
+        self.pdf.set_auto_page_break(self.auto_page_break, self.pdf.b_margin)
+        self.pdf.x, self.pdf.y = self.x, self.y
+        return False
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+
+
+MANIFEST_VERSION = 2
+
+
+def node_hash(node):
+    # Children are hashed before their parent off an explicit stack, so deep
+    # nesting does not hit the recursion limit
+    hashes = {}
+    stack = [(node, False)]
+    while stack:
+        current, children_done = stack.pop()
+        children = current.get("children") or ()
+        if not children_done:
+            stack.append((current, True))
+            stack.extend((child, False) for child in children)
+            continue
+        digest = hashlib.sha256()
+        digest.update(
+            json.dumps(
+                [
+                    current["type"],
+                    current["content"],
+                    sorted(current["style"].items()),
+                    sorted(current["attributes"].items()),
+                    [hashes[id(child)] for child in children],
+                ]
+            ).encode("utf-8")
+        )
+        hashes[id(current)] = digest.hexdigest()
+    return hashes[id(node)]
+
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_output(cls, output_file):
+        directory, name = os.path.split(os.path.abspath(output_file))
+        return cls(os.path.join(directory, f".{name}.manifest.json"))
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("version") != MANIFEST_VERSION:
+            return None
+        return record
+
+    def record(self, source, nodes, settings):
+        # Graphs follow from the nodes and the stamps of their data files in
+        # settings, so the record can be checked before anything is rendered
+        return {
+            "version": MANIFEST_VERSION,
+            "source": os.path.abspath(source),
+            "settings": settings,
+            "nodes": [node_hash(node) for node in nodes],
+        }
+
+    def output_stamp(self, output_file):
+        try:
+            stat = os.stat(output_file)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_current(self, record, output_file):
+        previous = self.load()
+        if previous is None:
+            return False
+
+        stamp = self.output_stamp(output_file)
+        if stamp is None or previous.get("output") != stamp:
+            return False
+
+        return all(previous.get(key) == record[key] for key in ("source", "settings", "nodes"))
+
+    def save(self, record, output_file):
+        record = dict(record, output=self.output_stamp(output_file))
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(record, f)
+        os.replace(temporary_path, self.path)
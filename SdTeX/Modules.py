@@ -0,0 +1,142 @@
+import os
+import re
+import threading
+from Errors import *
+from Source import Source
+from Parser import Parser
+
+
+# Finds the files a source pulls in without parsing it, for watch mode
+DIRECTIVE_PATTERN = re.compile(rb'\((?:sdinclude|sdimport)\s+src\s*=\s*"([^"]*)"')
+
+
+def resolve(directory, src):
+    return os.path.abspath(os.path.join(directory, src))
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def merge_styles(base, override):
+    merged = dict(base)
+    for name, style in override.items():
+        merged[name] = {**base.get(name, {}), **style}
+    return merged
+
+
+class Module:
+    """
+    A parsed document that others include or import. Its tree is kept as
+    parsed, with no variables substituted, so every document using it shares
+    one copy.
+
+    variables holds its own definitions with those of its imports filling in
+    the gaps. stylesheet is the styles its imports bring, applied to its own
+    tags; styles is what importing it brings: its own tag styles over that.
+    """
+
+    def __init__(self, path, stamp, source, document):
+        self.path = path
+        self.stamp = stamp
+        self.source = source
+        self.document = document
+        self.variables = document.variables
+        self.stylesheet = {}
+        self.styles = {}
+        # Every module imported, directly or not, with the stamp it had
+        self.imports = {}
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.path)
+
+    def is_current(self):
+        try:
+            return file_stamp(self.path) == self.stamp and all(
+                file_stamp(path) == stamp for path, stamp in self.imports.items()
+            )
+        except OSError:
+            return False
+
+
+class ModuleCache:
+    """
+    Parsed modules, keyed by path and checked against the file's mtime and
+    size on every load. One cache serves every document built in a process,
+    so modules shared across a batch are parsed once per worker.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.lock = threading.RLock()
+
+    def load(self, path, chain=()):
+        path = os.path.abspath(path)
+        if path in chain:
+            cycle = " -> ".join(os.path.basename(link) for link in chain + (path,))
+            raise SdTeXIncludeError(f"Error: {path} includes itself ({cycle})")
+
+        with self.lock:
+            module = self.modules.get(path)
+            if module is None or not module.is_current():
+                module = self.parse(path, chain + (path,))
+                self.modules[path] = module
+            return module
+
+    def parse(self, path, chain):
+        try:
+            stamp = file_stamp(path)
+            source = Source.read(path)
+        except OSError as e:
+            raise SdTeXIncludeError(f"Error: Could not read {path}: {e.strerror}")
+
+        parser = Parser(source)
+        module = Module(path, stamp, source, parser.parse())
+        module.stylesheet, module.imports = self.apply_imports(
+            parser.imports, source.scope, module.directory, chain
+        )
+        module.styles = merge_styles(module.stylesheet, parser.styles)
+        return module
+
+    def apply_imports(self, imports, scope, directory, chain):
+        # Imported variables only fill in names the importer leaves undefined;
+        # later imports override the styles of earlier ones
+        stylesheet = {}
+        stamps = {}
+        for src, line in imports:
+            try:
+                module = self.load(resolve(directory, scope.substitute(src)), chain)
+            except SdTeXIncludeError as e:
+                raise SdTeXIncludeError(f"{e.message}, imported on line {line} of {chain[-1]}")
+            for name, value in module.variables.items():
+                scope.variables.setdefault(name, value)
+            stylesheet = merge_styles(stylesheet, module.styles)
+            stamps[module.path] = module.stamp
+            stamps.update(module.imports)
+        return stylesheet, stamps
+
+
+def dependencies(path):
+    """
+    Every file path includes or imports, directly or through other modules.
+    Found by scanning for the directives rather than parsing, so it is cheap
+    enough to run whenever a file changes.
+    """
+    found = []
+    pending = [os.path.abspath(path)]
+    seen = set(pending)
+    while pending:
+        current = pending.pop()
+        try:
+            source = Source.read(current)
+        except OSError:
+            continue
+        for match in DIRECTIVE_PATTERN.finditer(source.buffer):
+            target = resolve(os.path.dirname(current), match.group(1).decode("utf-8"))
+            if target not in seen:
+                seen.add(target)
+                found.append(target)
+                pending.append(target)
+    return found
@@ -0,0 +1,101 @@
+import os
+from Cache import RenderCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+from Assets import DEFAULT_GRAPH_WORKERS, DEFAULT_IMAGE_WORKERS
+from Fetcher import ImageFetcher, DEFAULT_TIMEOUT, DEFAULT_RETRIES, DEFAULT_CONNECTIONS_PER_HOST
+from Images import ImageOptimizer, DEFAULT_IMAGE_DPI, DEFAULT_JPEG_QUALITY, DEFAULT_PALETTE_COLORS
+from Graph import DEFAULT_GRAPH_OUTPUT
+from Modules import ModuleCache
+
+
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Output")
+# Formats other than PDF are written by Emitters, which is imported only
+# when one is used
+OUTPUT_EXTENSIONS = {"pdf": ".pdf", "html": ".html", "md": ".md"}
+
+
+class BuildOptions:
+    def __init__(
+        self,
+        use_cache=True,
+        cache_dir=DEFAULT_CACHE_DIR,
+        cache_size=DEFAULT_MAX_SIZE,
+        graph_workers=DEFAULT_GRAPH_WORKERS,
+        image_workers=DEFAULT_IMAGE_WORKERS,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        connections_per_host=DEFAULT_CONNECTIONS_PER_HOST,
+        image_dpi=DEFAULT_IMAGE_DPI,
+        jpeg_quality=DEFAULT_JPEG_QUALITY,
+        palette_colors=DEFAULT_PALETTE_COLORS,
+        incremental=True,
+        stream=False,
+        graph_output=DEFAULT_GRAPH_OUTPUT,
+        output_format="pdf",
+        asset_url=None,
+    ):
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.graph_workers = graph_workers
+        self.image_workers = image_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.connections_per_host = connections_per_host
+        self.image_dpi = image_dpi
+        self.jpeg_quality = jpeg_quality
+        self.palette_colors = palette_colors
+        self.incremental = incremental
+        self.stream = stream
+        self.graph_output = graph_output
+        self.output_format = output_format
+        self.asset_url = asset_url
+        self.resources = None
+
+    def __getstate__(self):
+        # Sessions and caches are rebuilt in each worker process
+        state = self.__dict__.copy()
+        state["resources"] = None
+        return state
+
+    def shared_resources(self):
+        # One cache, HTTP session, optimizer and module cache per process,
+        # reused by every document built with these options
+        if self.resources is None:
+            cache = (
+                RenderCache(self.cache_dir, self.cache_size) if self.use_cache else None
+            )
+            fetcher = ImageFetcher(
+                timeout=self.timeout,
+                retries=self.retries,
+                connections_per_host=self.connections_per_host,
+            )
+            optimizer = ImageOptimizer(
+                OUTPUT_DIR,
+                cache,
+                dpi=self.image_dpi,
+                jpeg_quality=self.jpeg_quality,
+                palette_colors=self.palette_colors,
+            )
+            self.resources = (cache, fetcher, optimizer, ModuleCache())
+        return self.resources
+
+    def create(self, input_file, output_file=None, graph_workers=None, source=None):
+        from SdTeX import SdTeX
+
+        cache, fetcher, optimizer, modules = self.shared_resources()
+        return SdTeX(
+            input_file,
+            output_file=output_file,
+            cache=cache,
+            graph_workers=self.graph_workers if graph_workers is None else graph_workers,
+            image_workers=self.image_workers,
+            fetcher=fetcher,
+            optimizer=optimizer,
+            incremental=self.incremental,
+            stream=self.stream,
+            graph_output=self.graph_output,
+            modules=modules,
+            source=source,
+            output_format=self.output_format,
+            asset_url=self.asset_url,
+        )
@@ -0,0 +1,291 @@
+import re
+from Errors import *
+from Source import Source, Slice
+
+
+TEXT = "text"
+OPEN = "open"
+CLOSE = "close"
+EOF = "eof"
+
+# Cached trees are only reused by the same version; bump it whenever a change
+# to parsing or processing changes the nodes a source turns into
+PARSER_VERSION = 1
+
+# Imports apply to the whole document wherever they appear, so they are
+# collected while lexing, like variables
+IMPORT_TAG = "sdimport"
+INCLUDE_TAG = "sdinclude"
+
+# The lexer matches bytes, straight out of the source buffer. Bytes from 0x80
+# up belong to non-ASCII characters, which variable names may contain.
+TAG_START_PATTERN = re.compile(rb"\((?:!(\w+)\)|(\w+))")
+PARAMETER_PATTERN = re.compile(rb"\s+(style|attributes)\s*=\s*\{|\s+src\s*=\s*\"([^\"]*)\"")
+OPEN_END_PATTERN = re.compile(rb"\s*\)")
+BLOCK_PATTERN = re.compile(rb'([^}"]*(?:"[^"]*"[^}"]*)*)\}')
+ENTRY_PATTERN = re.compile(rb'\s*(?://[^\n]*|(\w+)\s*:[ \t]*("[^"]*"|[^,\n]*)|[^,\n]*)[,\n]?')
+VARIABLE_PATTERN = re.compile(rb'^((?:\w|[\x80-\xff])+)\s*:\s*"([^"]+)"$', re.MULTILINE)
+
+
+class Token:
+    __slots__ = ("kind", "start", "end", "line", "column", "name", "style", "attributes", "src")
+
+    def __init__(self, kind, start, end, line, column, name=None, style=None, attributes=None, src=None):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.line = line
+        self.column = column
+        self.name = name
+        self.style = style
+        self.attributes = attributes
+        self.src = src
+
+
+class Text:
+    # value is a Slice of the source
+    __slots__ = ("value", "line", "column")
+
+    def __init__(self, value, line, column):
+        self.value = value
+        self.line = line
+        self.column = column
+
+
+class Tag:
+    __slots__ = ("name", "style", "attributes", "src", "line", "column", "content", "children")
+
+    def __init__(self, name, style, attributes, src, line, column):
+        self.name = name
+        self.style = style
+        self.attributes = attributes
+        self.src = src
+        self.line = line
+        self.column = column
+        self.content = None
+        self.children = []
+
+
+class Document:
+    def __init__(self, children, variables, styles):
+        self.children = children
+        self.variables = variables
+        self.styles = styles
+
+
+class Lexer:
+    def __init__(self, source):
+        self.source = source
+        self.content = source.buffer
+        self.length = len(source)
+        self.line = 1
+        self.column = 1
+        self.counted = 0
+
+    def position(self, index):
+        # Lines and columns are counted incrementally so the whole scan stays
+        # linear; columns count characters, not bytes
+        line_start = self.content.rfind(b"\n", self.counted, index) + 1
+        if line_start:
+            self.line += self.source.count_newlines(self.counted, line_start)
+            self.column = 1 + self.source.count_characters(line_start, index)
+        else:
+            self.column += self.source.count_characters(self.counted, index)
+        self.counted = index
+        return self.line, self.column
+
+    def tokens(self):
+        content = self.content
+        position = 0
+        text_start = 0
+        text_line, text_column = self.position(0)
+
+        while True:
+            match = TAG_START_PATTERN.search(content, position)
+            if match is None:
+                break
+
+            token = self.match_tag(match)
+            if token is None:
+                position = match.start() + 1
+                continue
+
+            if text_start < token.start:
+                yield Token(TEXT, text_start, token.start, text_line, text_column)
+            yield token
+            position = text_start = token.end
+            text_line, text_column = self.position(text_start)
+
+        if text_start < self.length:
+            yield Token(TEXT, text_start, self.length, text_line, text_column)
+        line, column = self.position(self.length)
+        yield Token(EOF, self.length, self.length, line, column)
+
+    def match_tag(self, match):
+        content = self.content
+        start = match.start()
+
+        if match.group(1):
+            line, column = self.position(start)
+            return Token(CLOSE, start, match.end(), line, column, name=match.group(1).decode("ascii"))
+
+        name = match.group(2).decode("ascii")
+        style = {}
+        attributes = {}
+        src = None
+        position = match.end()
+
+        while True:
+            match = PARAMETER_PATTERN.match(content, position)
+            if not match:
+                break
+            if match.group(1) == b"style":
+                position = self.read_block(match.end(), style, name, "style")
+            elif match.group(1) == b"attributes":
+                position = self.read_block(match.end(), attributes, name, "attributes")
+            else:
+                src = match.group(2).decode("utf-8")
+                position = match.end()
+
+        match = OPEN_END_PATTERN.match(content, position)
+        if not match:
+            return None
+
+        line, column = self.position(start)
+        return Token(
+            OPEN, start, match.end(), line, column,
+            name=name, style=style, attributes=attributes, src=src,
+        )
+
+    def read_block(self, position, entries, name, kind):
+        match = BLOCK_PATTERN.match(self.content, position)
+        if not match:
+            line, column = self.position(position - 1)
+            raise SdTeXUnclosedBracketError(
+                f"Error: Unclosed '{{' in {kind} of {name} at line {line}, column {column}"
+            )
+
+        for entry in ENTRY_PATTERN.finditer(match.group(1)):
+            if entry.group(1):
+                entries[entry.group(1).decode("ascii")] = entry.group(2).strip().decode("utf-8")
+        return match.end()
+
+
+class Frame:
+    __slots__ = ("token", "children")
+
+    def __init__(self, token):
+        self.token = token
+        self.children = []
+
+
+class Parser:
+    def __init__(self, content):
+        # Either a Source or the document as a string
+        self.source = content if isinstance(content, Source) else Source.from_text(content)
+        self.lexer = Lexer(self.source)
+        self.variables = self.source.variables
+        self.styles = {}
+        self.imports = []
+
+    def parse(self):
+        # Variables are substituted when the tree is converted to nodes
+        return Document(list(self.items()), self.variables, self.styles)
+
+    def iter_parse(self):
+        # Nodes are handed out as soon as they close at the top level. A
+        # variable may be defined after its first use, so the definitions are
+        # collected in a separate pass over the tokens first.
+        self.prescan()
+        yield from self.items(collect=False)
+
+    def prescan(self):
+        for token in Lexer(self.source).tokens():
+            self.collect(token)
+
+    def items(self, collect=True):
+        # Descent keeps an explicit stack of open tags rather than recursing, so
+        # deep nesting or thousands of unclosed openings cannot exhaust the stack.
+        root = Frame(None)
+        stack = [root]
+        open_counts = {}
+
+        for token in self.lexer.tokens():
+            if collect:
+                self.collect(token)
+            if token.kind == TEXT:
+                stack[-1].children.append(self.text(token))
+            elif token.kind == OPEN:
+                stack.append(Frame(token))
+                open_counts[token.name] = open_counts.get(token.name, 0) + 1
+            elif token.kind == CLOSE and open_counts.get(token.name):
+                while stack[-1].token.name != token.name:
+                    self.demote(stack, open_counts)
+                frame = stack.pop()
+                open_counts[token.name] -= 1
+                stack[-1].children.append(self.close(frame, token))
+            elif token.kind == CLOSE:
+                stack[-1].children.append(self.text(token))
+
+            # Nothing is open, so everything at the top level is final
+            if len(stack) == 1 and root.children:
+                yield from flatten(root.children)
+                root.children = []
+
+        while len(stack) > 1:
+            self.demote(stack, open_counts)
+        yield from flatten(root.children)
+
+    def demote(self, stack, open_counts):
+        # An opening with no matching close is ordinary text, as it always was.
+        # Its children are spliced into the parent lazily to keep this linear.
+        frame = stack.pop()
+        open_counts[frame.token.name] -= 1
+        parent = stack[-1].children
+        parent.append(self.text(frame.token))
+        parent.append(frame.children)
+
+    def close(self, frame, closing):
+        token = frame.token
+        tag = Tag(token.name, token.style, token.attributes, token.src, token.line, token.column)
+        tag.content = Slice(self.source, token.end, closing.start)
+        children = flatten(frame.children)
+        if any(isinstance(child, Tag) for child in children):
+            tag.children = [
+                child for child in children
+                if isinstance(child, Tag) or not child.value.is_blank()
+            ]
+        if tag.style:
+            self.styles.setdefault(tag.name, tag.style)
+        return tag
+
+    def text(self, token):
+        return Text(Slice(self.source, token.start, token.end), token.line, token.column)
+
+    def collect(self, token):
+        if token.kind == TEXT:
+            self.collect_variables(token)
+        elif token.kind == OPEN and token.name == IMPORT_TAG and token.src:
+            self.imports.append((token.src, token.line))
+
+    def collect_variables(self, token):
+        content = self.source.buffer
+        for match in VARIABLE_PATTERN.finditer(content, token.start, token.end):
+            if match.start() > 0 and content[match.start() - 1:match.start()] != b"\n":
+                continue
+            if match.end() < len(content) and content[match.end():match.end() + 1] != b"\n":
+                continue
+            self.variables[match.group(1).decode("utf-8")] = match.group(2).decode("utf-8")
+
+def flatten(children):
+    flat = []
+    pending = [iter(children)]
+    while pending:
+        for child in pending[-1]:
+            if isinstance(child, list):
+                pending.append(iter(child))
+                break
+            flat.append(child)
+        else:
+            pending.pop()
+    return flat
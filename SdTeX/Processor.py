@@ -1,101 +1,243 @@
+import os
 import re
+import sys
+from types import MappingProxyType
 from Errors import *
+import Profile
+from Parser import Parser, Tag, Text, IMPORT_TAG, INCLUDE_TAG
+from Source import Scope
+from Modules import ModuleCache, merge_styles, resolve
+
+
+EMPTY = MappingProxyType({})
+
+
+FIELDS = frozenset(("type", "content", "style", "attributes", "children", "line_number", "column"))
+
+
+class Node:
+    __slots__ = ("type", "body", "style", "attributes", "children", "line_number", "column")
+
+    def __init__(self, type, content, style, attributes, children, line_number, column):
+        self.type = type
+        self.body = content
+        self.style = style
+        self.attributes = attributes
+        self.children = children
+        self.line_number = line_number
+        self.column = column
+
+    @property
+    def content(self):
+        # Contents stay a Slice of the source until they are read, and are
+        # decoded again each time rather than kept
+        body = self.body
+        return body if body is None or isinstance(body, str) else str(body)
+
+    # Nodes used to be plain dicts; renderers still read them that way
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in FIELDS
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in FIELDS else default
+
+    def __repr__(self):
+        return f"Node({self.type!r}, line {self.line_number}, column {self.column})"
+
+
+class Interner:
+    def __init__(self):
+        self.mappings = {}
+
+    def intern(self, mapping):
+        if not mapping:
+            return EMPTY
+        key = frozenset(mapping.items())
+        shared = self.mappings.get(key)
+        if shared is None:
+            shared = MappingProxyType(
+                {sys.intern(name): value for name, value in mapping.items()}
+            )
+            self.mappings[key] = shared
+        return shared
+
+
+class Context:
+    """
+    What converting a tree depends on besides the tree: the variables and
+    stylesheet in effect, the directory includes are resolved against and
+    the files that are including each other, for cycle detection.
+    """
+
+    __slots__ = ("scope", "stylesheet", "directory", "chain")
+
+    def __init__(self, scope, stylesheet, directory, chain):
+        self.scope = scope
+        self.stylesheet = stylesheet
+        self.directory = directory
+        self.chain = chain
+
 
 class Processor:
-    def __init__(self, content):
+    def __init__(self, content, path=None, modules=None, trees=None):
         self.content = content
+        self.path = path
+        self.modules = modules if modules is not None else ModuleCache()
+        self.trees = trees
+        # Every file included or imported, with the stamp it had when read
+        self.dependencies = {}
         self.styles = {}
-        self.tags = {}
+        self.nodes = []
         self.variables = {}
-        self.line_number = 0
-
-    def parse_variables(self):
-        pattern = r'^(\w+)\s*:\s*"([^"]+)"$'
-        matches = re.findall(pattern, self.content, flags=re.MULTILINE)
-        self.variables = {name: value for name, value in matches}
-
-    def replace_variables(self):
-        for key, value in self.variables.items():
-            self.content = self.content.replace(f"${key}", value)
-
-    def parse_stylesheet(self):
-        pattern = r"\((.*?)\s*style=\s*\{(.*?)\}\)"
-        match = re.search(pattern, self.content, flags=re.DOTALL)
-        if match:
-            tag_type = match.group(1).strip()
-            style_string = match.group(2).strip()
-            styles = {}
-            for line in style_string.split(","):
-                parts = line.strip().split(":")
-                if len(parts) == 2:
-                    key, value = parts
-                    styles[key.strip()] = value.strip()
-            self.styles[tag_type] = styles
-        return self.styles
-
-    def parse_tags(self):
-        tag_pattern = re.compile(
-            r"\((\w+)"
-            r"(?:\s+style\s*=\s*\{([^}]*)\})?"
-            r"(?:\s+attributes\s*=\s*\{([^}]*)\})?"
-            r'(?:\s+src\s*=\s*"([^"]*)")?'
-            r"\)(.*?)\(!\1\)",
-            re.DOTALL,
+        self.interner = Interner()
+        self.context = None
+
+    def tag_fields(self, node, context):
+        # Everything a Node needs from its tag besides its children
+        substitute = context.scope.substitute
+        style = {key: substitute(value) for key, value in node.style.items()}
+        sheet = context.stylesheet.get(node.name)
+        if sheet:
+            # A tag's own style wins over the imported one
+            style = {**{key: substitute(value) for key, value in sheet.items()}, **style}
+        return (
+            sys.intern(node.name),
+            substitute(node.src) if node.src else node.content.bind(context.scope),
+            self.interner.intern(style),
+            self.interner.intern({key: substitute(value) for key, value in node.attributes.items()}),
         )
 
-        self.line_number = 0
-        for match in re.finditer(tag_pattern, self.content):
-            self.line_number += 1
-            tag_type = match.group(1).strip()
-            style_string = match.group(2)
-            attributes_string = match.group(3)
-            src = match.group(4)
-            tag_content = match.group(5).strip()
-
-            styles = {}
-            if style_string:
-                for line in style_string.split(","):
-                    parts = line.strip().split(":")
-                    if len(parts) == 2:
-                        key, value = parts
-                        styles[key.strip()] = value.strip()
-
-            attributes = {}
-            if attributes_string:
-                for line in attributes_string.split(","):
-                    parts = line.strip().split(":")
-                    if line.strip().startswith('//'):
-                        continue
-                    if len(parts) == 2:
-                        key, value = parts
-                        attributes[key.strip()] = value.strip()
-
-            if src:
-                self.tags[tag_type] = {
-                    "type": tag_type,
-                    "content": src,
-                    "style": styles,
-                    "attributes": attributes,
-                    "line_number": self.line_number
-                }
+    def nodes_from_ast(self, nodes, context):
+        # Walked with an explicit stack, like Parser.items, so how deeply tags
+        # nest is not limited by Python's recursion limit. Each frame holds
+        # the tags left to convert, the list their nodes go into and, for a
+        # tag's children, the tag to finish once they are all converted.
+        converted = []
+        stack = [(iter(nodes), context, converted, None)]
+        while stack:
+            remaining, context, siblings, parent = stack[-1]
+            node = next(remaining, None)
+            if node is None:
+                stack.pop()
+                if parent is not None:
+                    fields, ast_node, parent_siblings = parent
+                    parent_siblings.append(Node(*fields, tuple(siblings), ast_node.line, ast_node.column))
+                continue
+
+            if isinstance(node, Text):
+                siblings.append(
+                    Node("text", node.value.bind(context.scope), EMPTY, EMPTY, (), node.line, node.column)
+                )
+            elif node.name == INCLUDE_TAG:
+                # Included tags become siblings of the include
+                included, tags = self.include(node, context)
+                stack.append((tags, included, siblings, None))
+            elif node.name == IMPORT_TAG:
+                # Already applied to the whole document
+                continue
             else:
-                self.tags[tag_type] = {
-                    "type": tag_type,
-                    "content": tag_content,
-                    "style": styles,
-                    "attributes": attributes,
-                    "line_number": self.line_number
-                }
+                fields = self.tag_fields(node, context)
+                stack.append((iter(node.children), context, [], (fields, node, siblings)))
+        return converted
+
+    def include(self, node, context):
+        if not node.src:
+            raise SdTeXIncludeError(f"Error: {INCLUDE_TAG} on line {node.line} has no src")
+        path = resolve(context.directory, context.scope.substitute(node.src))
+        try:
+            module = self.modules.load(path, context.chain)
+        except SdTeXIncludeError as e:
+            raise SdTeXIncludeError(f"{e.message}, included on line {node.line} of {context.chain[-1]}")
+        self.dependencies[module.path] = module.stamp
+        self.dependencies.update(module.imports)
+
+        # The module's variables come first, then those of whoever includes it
+        included = Context(
+            Scope(module.variables, context.scope),
+            merge_styles(context.stylesheet, module.stylesheet),
+            module.directory,
+            context.chain + (module.path,),
+        )
+        tags = (child for child in module.document.children if isinstance(child, Tag))
+        return included, tags
+
+    @property
+    def directory(self):
+        return os.getcwd() if self.path is None else os.path.dirname(os.path.abspath(self.path))
+
+    def start(self, parser):
+        # Imports are applied before any node is converted, wherever they
+        # appear in the document
+        directory = self.directory
+        chain = ("<document>",) if self.path is None else (os.path.abspath(self.path),)
+        scope = parser.source.scope
+        stylesheet, imported = self.modules.apply_imports(parser.imports, scope, directory, chain)
+        self.dependencies.update(imported)
+        self.context = Context(scope, stylesheet, directory, chain)
+        self.variables = parser.variables
+        self.styles = parser.styles
+
+    def parse_tags(self, document):
+        tags = (node for node in document.children if isinstance(node, Tag))
+        self.nodes = list(self.nodes_from_ast(tags, self.context))
 
     def process_content(self):
+        key = None
+        if self.trees is not None:
+            with Profile.span("Processor.load_tree"):
+                key = self.trees.key(self.content.buffer)
+                nodes = self.trees.load(key, self.directory)
+            if nodes is not None:
+                self.nodes = nodes
+                return nodes
+
         try:
-            self.parse_variables()
-            self.replace_variables()
-            self.parse_stylesheet()
-            self.parse_tags()
+            with Profile.span("Parser.parse"):
+                parser = Parser(self.content)
+                document = parser.parse()
+            with Profile.span("Processor.imports"):
+                self.start(parser)
+            with Profile.span("Processor.parse_tags"):
+                self.parse_tags(document)
+        except SdTeXError as e:
+            raise e
         except re.error as e:
             raise SdTeXSyntaxError(f"Syntax error in regular expression: {e}")
         except Exception as e:
             raise SdTeXProcessingError(f"Error processing content: {e}")
 
-        return list(self.tags.values())
\ No newline at end of file
+        if key is not None:
+            with Profile.span("Processor.save_tree"):
+                try:
+                    self.trees.save(key, self.nodes, self.directory, self.dependencies)
+                except OSError as e:
+                    print(f"Warning: Could not cache the parsed document: {e}")
+        return self.nodes
+
+    def iter_content(self):
+        # Yields top level nodes one at a time instead of building the list,
+        # so a streamed build never holds the whole tree
+        parser = Parser(self.content)
+        nodes = parser.iter_parse()
+        while True:
+            try:
+                node = next(nodes, None)
+                if self.context is None:
+                    self.start(parser)
+            except SdTeXError as e:
+                raise e
+            except re.error as e:
+                raise SdTeXSyntaxError(f"Syntax error in regular expression: {e}")
+            except Exception as e:
+                raise SdTeXProcessingError(f"Error processing content: {e}")
+
+            if node is None:
+                break
+            if isinstance(node, Tag):
+                yield from self.nodes_from_ast((node,), self.context)
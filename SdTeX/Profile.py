@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+
+
+DEFAULT_TOP = 15
+
+# The profiler for this process, or None when profiling is off
+active = None
+
+
+class Span:
+    __slots__ = ("profiler", "name", "category", "args", "wall", "cpu", "memory")
+
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.memory = tracemalloc.get_traced_memory()[0] if self.profiler.memory else 0
+        self.cpu = time.thread_time_ns()
+        self.wall = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter_ns() - self.wall
+        cpu = time.thread_time_ns() - self.cpu
+        memory = tracemalloc.get_traced_memory()[0] - self.memory if self.profiler.memory else 0
+        self.profiler.record(self, wall, cpu, memory)
+        return False
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Profiler:
+    """
+    Records nested spans of wall time, CPU time and net allocated bytes.
+
+    Spans are kept as Chrome trace events ("X" phase, microseconds), so the
+    export loads directly in chrome://tracing or Perfetto. Allocations are
+    measured with tracemalloc, which slows the build down noticeably; pass
+    memory=False to time without it.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter_ns()
+        self.pid = os.getpid()
+
+    def start(self):
+        global active
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        active = self
+        return self
+
+    def stop(self):
+        global active
+        if active is self:
+            active = None
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def span(self, name, category="stage", **args):
+        return Span(self, name, category, args)
+
+    def record(self, span, wall, cpu, memory):
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": (span.wall - self.origin) / 1000,
+            "dur": wall / 1000,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": dict(span.args, cpu_ms=cpu / 1e6, alloc_bytes=memory),
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def export(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def summary(self):
+        totals = {}
+        for event in self.events:
+            key = (event["cat"], event["name"])
+            total = totals.setdefault(key, [0, 0.0, 0.0, 0])
+            total[0] += 1
+            total[1] += event["dur"] / 1000
+            total[2] += event["args"]["cpu_ms"]
+            total[3] += event["args"]["alloc_bytes"]
+        return sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+
+    def print_summary(self, top=DEFAULT_TOP):
+        rows = self.summary()[:top]
+        if not rows:
+            return
+        width = max(len(f"{category}:{name}") for (category, name), _ in rows)
+        print()
+        print(f"  {'span':<{width}}  {'calls':>6}  {'wall ms':>9}  {'cpu ms':>9}  {'alloc KB':>9}")
+        for (category, name), (calls, wall, cpu, memory) in rows:
+            print(
+                f"  {f'{category}:{name}':<{width}}  {calls:>6}  {wall:>9.1f}  {cpu:>9.1f}  {memory / 1024:>9.1f}"
+            )
+
+
+def span(name, category="stage", **args):
+    if active is None:
+        return NULL_SPAN
+    return active.span(name, category, **args)
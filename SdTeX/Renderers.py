@@ -0,0 +1,129 @@
+from collections import namedtuple
+from Errors import *
+
+
+ResolvedStyle = namedtuple("ResolvedStyle", ["family", "size", "style", "color"])
+StyleDefaults = namedtuple("StyleDefaults", ["family", "size", "style", "color"])
+
+FOOTER_STYLE = StyleDefaults("Arial", "10", "", "#000000")
+COPYRIGHT_STYLE = StyleDefaults("Arial", "10", "", "#000000")
+TITLE_STYLE = StyleDefaults("Arial", "12", "", "#000000")
+LINK_STYLE = StyleDefaults("Arial", "12", "U", "#0000FF")
+BULLET_STYLE = StyleDefaults("Arial", "12", "", "#000000")
+QUOTE_STYLE = StyleDefaults("Arial", "12", "I", "#888888")
+AUTHOR_STYLE = StyleDefaults("Arial", "12", "I", "#555555")
+CODE_STYLE = StyleDefaults("Courier", "12", "", "#FF0000")
+
+
+def parse_color(font_color):
+    if font_color.startswith("#") and len(font_color) == 7:
+        try:
+            return (
+                int(font_color[1:3], 16),
+                int(font_color[3:5], 16),
+                int(font_color[5:7], 16),
+            )
+        except ValueError:
+            print(f"Warning: Color value {font_color} was not defined! Defaulting to #000000")
+    return (0, 0, 0)
+
+
+class StyleResolver:
+    def __init__(self):
+        # Style mappings are interned by the Processor, so identity is a safe
+        # key; the mapping is kept alongside to pin it while it is cached.
+        self.resolved = {}
+
+    def resolve(self, style, defaults):
+        key = (id(style), defaults)
+        entry = self.resolved.get(key)
+        if entry is not None and entry[0] is style:
+            return entry[1]
+
+        resolved = self.parse(style, defaults)
+        self.resolved[key] = (style, resolved)
+        return resolved
+
+    def parse(self, style, defaults):
+        raw_size = style.get("font_size", defaults.size).strip('"').replace("dp", "").strip()
+        try:
+            font_size = int(raw_size)
+        except ValueError:
+            raise SdTeXStyleError(f"Error: Invalid font_size {raw_size!r}")
+
+        font_style = defaults.style
+        if style.get("font_weight", "normal").strip('"') == "bold" and "B" not in font_style:
+            font_style = "B" + font_style
+
+        # A core font name, or a .ttf or .otf file relative to the document
+        font_family = style.get("font_family", defaults.family).strip('"').strip() or defaults.family
+        font_color = style.get("font_color", defaults.color).strip('"')
+        return ResolvedStyle(font_family, font_size, font_style, parse_color(font_color))
+
+
+class Renderer:
+    def render(self, sdtex, pdf, attribute):
+        raise NotImplementedError
+
+
+class MethodRenderer(Renderer):
+    def __init__(self, method_name):
+        self.method_name = method_name
+
+    def render(self, sdtex, pdf, attribute):
+        getattr(sdtex, self.method_name)(pdf, attribute)
+
+
+class ContainerRenderer(Renderer):
+    def render(self, sdtex, pdf, attribute):
+        # Containers inside containers are walked here rather than rendered
+        # recursively, so deep nesting does not hit the recursion limit
+        pending = [iter(attribute["children"])]
+        while pending:
+            child_attribute = next(pending[-1], None)
+            if child_attribute is None:
+                pending.pop()
+            elif isinstance(sdtex.renderers.get(child_attribute["type"]), ContainerRenderer):
+                pending.append(iter(child_attribute["children"]))
+            else:
+                sdtex.add_attribute_to_pdf(pdf, child_attribute)
+
+
+class FunctionRenderer(Renderer):
+    def __init__(self, function):
+        self.function = function
+
+    def render(self, sdtex, pdf, attribute):
+        self.function(sdtex, pdf, attribute)
+
+
+RENDERERS = {
+    "sdtitle": MethodRenderer("add_title"),
+    "sdgraph": MethodRenderer("add_graph"),
+    "sdimage": MethodRenderer("add_image"),
+    "sdtex": ContainerRenderer(),
+    "text": MethodRenderer("add_text"),
+    "sdbullet": MethodRenderer("add_bullet"),
+    "sdquote": MethodRenderer("add_quote"),
+    "sdauthor": MethodRenderer("add_author"),
+    "sdcode": MethodRenderer("add_code"),
+    "sdlink": MethodRenderer("add_link"),
+    "sdnline": MethodRenderer("add_newline"),
+    "sdfooter": MethodRenderer("add_footer"),
+    "attribution": MethodRenderer("add_copyright"),
+}
+
+
+def register_renderer(tag_type, renderer):
+    """
+    Register a handler for a tag type in every SdTeX instance created afterwards.
+
+    renderer is either a Renderer with a render(sdtex, pdf, attribute) method or
+    a plain function with that signature.
+    """
+    if not hasattr(renderer, "render"):
+        if not callable(renderer):
+            raise SdTeXProcessingError(f"Error: Renderer for {tag_type} is not callable")
+        renderer = FunctionRenderer(renderer)
+    RENDERERS[tag_type] = renderer
+    return renderer
@@ -1,45 +1,81 @@
+import io
 import os
-import requests
-from io import BytesIO
-from PIL import Image as PILImage
-from fpdf import FPDF
-import matplotlib.pyplot as plt
-import matplotlib.colors
-import numpy as np
-import math
 from Processor import Processor
-import re
+from Source import Source
+from Modules import ModuleCache
+from Trees import TreeCache
+from Cache import RenderCache
+from Fetcher import ImageFetcher, DOWNLOADED, NOT_MODIFIED, FAILED
+from Images import ImageOptimizer, ImageBuffer, image_file
+from Manifest import Manifest
+from Assets import AssetPrefetcher, DEFAULT_GRAPH_WORKERS, DEFAULT_IMAGE_WORKERS
+import Graph
+import Fonts
+import Profile
+from Renderers import *
+from Layout import LayoutEngine
 from Errors import *
 
+# fpdf, PIL, numpy and matplotlib are imported where they are first needed, so
+# that parsing, syntax checks and text-only documents start quickly.
 
-import os
-import requests
-from io import BytesIO
-from PIL import Image as PILImage
-from fpdf import FPDF
-import matplotlib.pyplot as plt
-import matplotlib.colors
-import numpy as np
-import math
-from Processor import Processor
-import re
-from Errors import *
 
+# Width in millimetres at which images are placed on the page
+IMAGE_WIDTH = 180
 
 class SdTeX:
-    def __init__(self, input_file):
+    def __init__(
+        self,
+        input_file,
+        output_file=None,
+        cache=None,
+        graph_workers=DEFAULT_GRAPH_WORKERS,
+        image_workers=DEFAULT_IMAGE_WORKERS,
+        fetcher=None,
+        optimizer=None,
+        incremental=True,
+        stream=False,
+        graph_output=Graph.DEFAULT_GRAPH_OUTPUT,
+        modules=None,
+        source=None,
+        output_format="pdf",
+        asset_url=None,
+    ):
+        # Given the document's text, build() compiles it in memory; input_file
+        # is then only where its relative paths are resolved from
         self.input_file = input_file
+        self.source = source
+        self.in_memory = source is not None
+        self.output_file = output_file
+        # pdf, or one of the text formats in Emitters.EMITTERS
+        self.output_format = output_format
+        self.asset_url = asset_url
+        self.cache = cache
+        self.fetcher = fetcher if fetcher is not None else ImageFetcher()
+        self.graph_workers = graph_workers
+        self.image_workers = image_workers
+        self.incremental = incremental
+        self.stream = stream
+        self.graph_output = graph_output
+        self.modules = modules if modules is not None else ModuleCache()
+        self.assets = {}
         self.script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.current_y = 0
+        self.optimizer = (
+            optimizer
+            if optimizer is not None
+            else ImageOptimizer(os.path.join(self.script_dir, "Output"), cache)
+        )
+        self.layout = LayoutEngine()
         self.variables = {}
+        self.renderers = dict(RENDERERS)
+        self.styles = StyleResolver()
+        self.sources = []
 
     def process_sdtex_file(self):
         try:
-            with open(self.input_file, "r") as file:
-                content = file.read()
-                processor = Processor(content)
-                processed_content = processor.process_content()
-                return processed_content
+            trees = TreeCache(self.cache) if self.cache is not None else None
+            processor = Processor(self.open_source(), self.input_file, self.modules, trees)
+            return processor.process_content()
         except FileNotFoundError:
             raise SdTeXProcessingError(f"File not found: {self.input_file}")
         except SdTeXSyntaxError as e:
@@ -56,9 +92,37 @@ class SdTeX:
             raise SdTeXProcessingError(str(e))
         except SdTeXAttributeError as e:
             raise SdTeXProcessingError(str(e))
+        except SdTeXIncludeError as e:
+            raise SdTeXProcessingError(str(e))
         except Exception as e:
             raise SdTeXProcessingError(f"Unexpected error: {e}")
 
+    def stream_sdtex_file(self):
+        try:
+            source = self.open_source()
+        except FileNotFoundError:
+            raise SdTeXProcessingError(f"File not found: {self.input_file}")
+
+        try:
+            yield from Processor(source, self.input_file, self.modules).iter_content()
+        except SdTeXProcessingError as e:
+            raise e
+        except SdTeXError as e:
+            raise SdTeXProcessingError(str(e))
+
+    def open_source(self):
+        if self.in_memory:
+            return Source.from_text(self.source)
+        source = Source.open(self.input_file)
+        # Node contents are read from the map until the build is done
+        self.sources.append(source)
+        return source
+
+    def close_sources(self):
+        for source in self.sources:
+            source.close()
+        self.sources = []
+
     def set_variable(self, name, value):
         self.variables[name] = value
 
@@ -67,50 +131,256 @@ class SdTeX:
         os.makedirs(output_dir, exist_ok=True)
         return output_dir
 
-    def download_image(self, url, output_path):
+    def download_image(self, url, output_path, etag=None, last_modified=None):
+        # output_path may also be a file object, for builds kept in memory
+        fetch = self.fetcher.download if hasattr(output_path, "write") else self.fetcher.fetch
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                with open(output_path, "wb") as f:
-                    f.write(response.content)
-                return True
-            else:
-                print(
-                    f"Failed to download image from {url}. Status code: {response.status_code}"
-                )
-                return False
-        except requests.exceptions.RequestException as e:
-            raise SdTeXSrcError(f"Error downloading image from {url}: {e}")
+            with Profile.span("download_image", "asset", url=url):
+                result = fetch(url, output_path, etag, last_modified)
+        except SdTeXSrcError as e:
+            raise e
         except Exception as e:
             raise SdTeXSrcError(f"Error finding image at address {url}: {e}")
 
+        if result.status == FAILED:
+            print(
+                f"Failed to download image from {url}. Status code: {result.status_code}"
+            )
+        return result
+
+    def fetch_image(self, url, output_path):
+        if self.cache is None and self.in_memory:
+            buffer = io.BytesIO()
+            result = self.download_image(url, buffer)
+            if result.status != DOWNLOADED:
+                return None
+            name = f"download_{RenderCache.key('sdimage', url)[:16]}{os.path.splitext(output_path)[1]}"
+            return ImageBuffer(name, buffer.getvalue())
+
+        if self.cache is None:
+            result = self.download_image(url, output_path)
+            return output_path if result.status == DOWNLOADED else None
+
+        extension = os.path.splitext(output_path)[1]
+        key = self.cache.key("sdimage", url)
+        cached_path = self.cache.get(key, extension)
+        metadata = self.cache.get_metadata(key) if cached_path else {}
+
+        temporary_path = self.cache.temporary_path(extension)
+        try:
+            result = self.download_image(
+                url,
+                temporary_path,
+                metadata.get("etag"),
+                metadata.get("last_modified"),
+            )
+            if result.status == NOT_MODIFIED:
+                return cached_path
+            if result.status == DOWNLOADED:
+                self.cache.put_metadata(
+                    key, {"etag": result.etag, "last_modified": result.last_modified}
+                )
+                return self.cache.put(key, extension, temporary_path)
+            if cached_path:
+                print(f"Using the cached copy of {url}")
+            return cached_path
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
     def run(self):
         input_file_path = self.input_file
 
         if not os.path.isfile(input_file_path):
             raise SdTeXProcessingError(f"Error: {input_file_path} does not exist")
 
-        output_dir = self.create_output_directory()
-        processed_content = self.process_sdtex_file()
+        if self.output_file:
+            output_dir = os.path.dirname(os.path.abspath(self.output_file))
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            output_dir = self.create_output_directory()
+
+        try:
+            if self.output_format != "pdf":
+                attributes = self.stream_sdtex_file() if self.stream else self.process_sdtex_file()
+                self.emit_document(attributes, output_dir)
+                return
+
+            if self.stream:
+                self.stream_as_pdf(self.stream_sdtex_file(), output_dir)
+                return
 
-        self.save_as_pdf(processed_content, output_dir)
+            processed_content = self.process_sdtex_file()
+
+            self.save_as_pdf(processed_content, output_dir)
+        finally:
+            self.close_sources()
 
     def save_as_pdf(self, attributes, output_dir):
         try:
-            output_file_path = os.path.join(output_dir, "output.pdf")
-            pdf = FPDF()
+            output_file_path = self.output_file or os.path.join(output_dir, "output.pdf")
+            from Writer import DocumentFPDF
+
+            pdf = DocumentFPDF()
+            pdf.add_page()
+            pdf.set_auto_page_break(auto=True, margin=15)
+
+            # Checked before any asset is fetched or rendered, so an
+            # unchanged document costs no downloads; images that changed on
+            # their server are picked up by the next stale build or --force
+            with Profile.span("manifest"):
+                manifest = Manifest.for_output(output_file_path)
+                settings = dict(self.build_settings(), files=self.file_stamps(attributes))
+                record = manifest.record(self.input_file, attributes, settings)
+                up_to_date = self.incremental and manifest.is_current(record, output_file_path)
+            if up_to_date:
+                print(f"PDF file {output_file_path} is up to date")
+                return
+
+            with Profile.span("prefetch"):
+                self.assets = AssetPrefetcher(
+                    self, self.graph_workers, self.image_workers
+                ).prefetch(attributes)
+
+            with Profile.span("layout"):
+                for attribute in attributes:
+                    self.add_attribute_to_pdf(pdf, attribute)
+
+            with Profile.span("pdf.output"):
+                pdf.output(output_file_path)
+            manifest.save(record, output_file_path)
+            print(f"PDF file has been saved to {output_file_path}")
+        except SdTeXProcessingError as e:
+            raise e
+        except Exception as e:
+            raise SdTeXProcessingError(f"Error Saving File to {output_file_path}: {e}")
+
+    def build(self):
+        # Compiles the source given to the constructor and returns the PDF as
+        # bytes. There is no manifest; assets are prefetched as in save_as_pdf.
+        attributes = self.process_sdtex_file()
+        pdf = None
+        try:
+            from Writer import StreamingFPDF
+
+            pdf = StreamingFPDF()
             pdf.add_page()
             pdf.set_auto_page_break(auto=True, margin=15)
 
-            for attribute in attributes:
-                self.add_attribute_to_pdf(pdf, attribute)
+            with Profile.span("prefetch"):
+                self.assets = AssetPrefetcher(
+                    self, self.graph_workers, self.image_workers
+                ).prefetch(attributes)
+
+            with Profile.span("layout"):
+                for attribute in attributes:
+                    self.add_attribute_to_pdf(pdf, attribute)
+
+            with Profile.span("pdf.output"):
+                return pdf.output()
+        except SdTeXProcessingError as e:
+            raise e
+        except Exception as e:
+            raise SdTeXProcessingError(f"Error building PDF: {e}")
+        finally:
+            if pdf is not None:
+                pdf.abort()
+            self.close_sources()
+
+    def stream_as_pdf(self, attributes, output_dir):
+        # Pages and images go to disk as they are finished, and nodes come
+        # straight from the parser. Assets are fetched as they are reached and
+        # there is no manifest, which would need every node up front.
+        output_file_path = self.output_file or os.path.join(output_dir, "output.pdf")
+        pdf = None
+        try:
+            from Writer import StreamingFPDF
 
-            pdf.output(output_file_path)
+            pdf = StreamingFPDF(output_file_path)
+            pdf.add_page()
+            pdf.set_auto_page_break(auto=True, margin=15)
+
+            with Profile.span("layout"):
+                for attribute in attributes:
+                    self.add_attribute_to_pdf(pdf, attribute)
+
+            with Profile.span("pdf.output"):
+                pdf.output(output_file_path)
             print(f"PDF file has been saved to {output_file_path}")
         except SdTeXProcessingError as e:
             raise e
         except Exception as e:
             raise SdTeXProcessingError(f"Error Saving File to {output_file_path}: {e}")
+        finally:
+            if pdf is not None:
+                pdf.abort()
+
+    def emit_document(self, attributes, output_dir):
+        # HTML and Markdown skip layout entirely. Graphs still render ahead of
+        # time unless streaming; images are linked where they are.
+        from Emitters import EMITTERS
+
+        emitter_class = EMITTERS[self.output_format]
+        output_file_path = self.output_file or os.path.join(output_dir, f"output{emitter_class.extension}")
+        partial_path = f"{output_file_path}.part"
+        try:
+            if not self.stream:
+                with Profile.span("prefetch"):
+                    prefetcher = AssetPrefetcher(self, self.graph_workers, self.image_workers)
+                    graphs, _ = prefetcher.collect(attributes)
+                    self.assets = prefetcher.render_graphs(graphs)
+
+            directory = os.path.dirname(os.path.abspath(output_file_path))
+            with Profile.span("emit"):
+                with open(partial_path, "w", encoding="utf-8") as output:
+                    emitter_class(self, output, directory, self.asset_url).emit(attributes)
+            os.replace(partial_path, output_file_path)
+            print(f"{emitter_class.name} file has been saved to {output_file_path}")
+        except SdTeXProcessingError as e:
+            raise e
+        except SdTeXError as e:
+            raise SdTeXProcessingError(str(e))
+        except Exception as e:
+            raise SdTeXProcessingError(f"Error Saving File to {output_file_path}: {e}")
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def build_settings(self):
+        # Anything besides the source and its assets that changes the PDF bytes
+        settings = {"image_width": IMAGE_WIDTH, "graph_output": self.graph_output}
+        if self.optimizer is not None:
+            settings.update(
+                dpi=self.optimizer.dpi,
+                jpeg_quality=self.optimizer.jpeg_quality,
+                palette_colors=self.optimizer.palette_colors,
+            )
+        return settings
+
+    def file_stamps(self, attributes):
+        # Font files and the data of vector graphs are not assets, but editing
+        # one still changes the PDF
+        stamps = {}
+        pending = list(attributes)
+        while pending:
+            attribute = pending.pop()
+            if attribute["type"] == "sdgraph":
+                for path in Graph.split_list(attribute["attributes"].get("data", "")):
+                    path, mtime_ns, size = self.data_file(path)
+                    stamps[path] = [mtime_ns, size]
+            family = attribute.get("style", {}).get("font_family", "").strip('"').strip()
+            if Fonts.is_font_file(family):
+                path = self.font_path(family)
+                try:
+                    stat = os.stat(path)
+                    stamps[path] = [stat.st_mtime_ns, stat.st_size]
+                except OSError:
+                    stamps[path] = None
+            pending.extend(attribute.get("children", ()))
+        return stamps
+
+    def font_path(self, family):
+        return os.path.join(os.path.dirname(os.path.abspath(self.input_file)), family)
 
     def add_attribute_to_pdf(self, pdf, attribute):
         try:
@@ -119,35 +389,11 @@ class SdTeX:
                     link_id=pdf.add_link(), y=pdf.y + pdf.font_size, page=pdf.page_no()
                 )
 
-            if attribute["type"] == "sdtitle":
-                self.add_title(pdf, attribute)
-            elif attribute["type"] == "sdgraph":
-                self.add_graph(pdf, attribute)
-            elif attribute["type"] == "sdimage":
-                self.add_image(pdf, attribute)
-            elif attribute["type"] == "sdtex":
-                for child_attribute in attribute["children"]:
-                    self.add_attribute_to_pdf(pdf, child_attribute)
-            elif attribute["type"] == "text":
-                self.add_text(pdf, attribute)
-            elif attribute["type"] == "sdbullet":
-                self.add_bullet(pdf, attribute)
-            elif attribute["type"] == "sdquote":
-                self.add_quote(pdf, attribute)
-            elif attribute["type"] == "sdauthor":
-                self.add_author(pdf, attribute)
-            elif attribute["type"] == "sdcode":
-                self.add_code(pdf, attribute)
-            elif attribute["type"] == "sdlink":
-                self.add_link(pdf, attribute)
-            elif attribute["type"] == "sdnline":
-                self.add_newline(pdf, attribute)
-            elif attribute["type"] == "sdfooter":
-                self.add_footer(pdf, attribute)
-            elif attribute["type"] == "attribution":
-                self.add_copyright(pdf, attribute)
-            else:
+            renderer = self.renderers.get(attribute["type"])
+            if renderer is None:
                 raise SdTeXTagNotFoundError(f"Error: Tag {attribute['type']} not found")
+            with Profile.span(attribute["type"], "node", line=attribute["line_number"]):
+                renderer.render(self, pdf, attribute)
 
         except SdTeXProcessingError as e:
             raise e
@@ -164,33 +410,28 @@ class SdTeX:
         except Exception as e:
             raise SdTeXProcessingError(f"Error adding attribute to PDF: {e}")
 
+    def register_renderer(self, tag_type, renderer):
+        if not hasattr(renderer, "render"):
+            renderer = FunctionRenderer(renderer)
+        self.renderers[tag_type] = renderer
+
+    def apply_style(self, pdf, attribute, defaults):
+        resolved = self.styles.resolve(attribute["style"], defaults)
+        family = resolved.family
+        if Fonts.is_font_file(family):
+            family = pdf.add_font_file(self.font_path(family))
+        pdf.set_font(family, style=resolved.style, size=resolved.size)
+        pdf.set_text_color(*resolved.color)
+        return resolved
+
     def add_footer(self, pdf, attribute):
         try:
             content = attribute["content"]
-            style = attribute["style"]
-            font_size = int(
-                style.get("font_size", "10").strip('"').replace("dp", "").strip()
-            )
-            font_color = style.get("font_color", "#000000").strip('"')
-
-            if font_color.startswith("#") and len(font_color) == 7:
-                try:
-                    r = int(font_color[1:3], 16)
-                    g = int(font_color[3:5], 16)
-                    b = int(font_color[5:7], 16)
-                except ValueError:
-                    r, g, b = 0, 0, 0
-                    print(f"Warning: Color value {font_color} was not defined! Defaulting to #000000")
-            else:
-                r, g, b = 0, 0, 0
-
-            pdf.set_font("Arial", size=font_size)
-            pdf.set_text_color(r, g, b)
-            pdf.set_y(-pdf.h + 20)
-            pdf.set_x(-pdf.get_string_width(content) - 10)
-            pdf.cell(0, -10, content, 0, 0, "R", link=attribute.get("src"))
-            pdf.set_x(0)
-            pdf.set_y(0)
+            self.apply_style(pdf, attribute, FOOTER_STYLE)
+            with self.layout.fixed(pdf):
+                pdf.set_y(-pdf.h + 20)
+                pdf.set_x(-pdf.get_string_width(content) - 10)
+                pdf.cell(0, -10, content, 0, 0, "R", link=attribute.get("src"))
 
         except SdTeXProcessingError as e:
             raise e
@@ -200,32 +441,11 @@ class SdTeX:
     def add_copyright(self, pdf, attribute):
         try:
             content = attribute["content"]
-            style = attribute["style"]
-            font_size = int(
-                style.get("font_size", "10").strip('"').replace("dp", "").strip()
-            )
-            font_color = style.get("font_color", "#000000").strip('"')
-
-            if font_color.startswith("#") and len(font_color) == 7:
-                try:
-                    r = int(font_color[1:3], 16)
-                    g = int(font_color[3:5], 16)
-                    b = int(font_color[5:7], 16)
-                except ValueError:
-                    r, g, b = 0, 0, 0
-                    print(f"Warning: Color value {font_color} was not defined! Defaulting to #000000")
-            else:
-                r, g, b = 0, 0, 0
-
-            pdf.set_font("Arial", size=font_size)
-            pdf.set_text_color(r, g, b)
-
-            pdf.set_x(-pdf.get_string_width(content) - 10)
-            pdf.set_y(-pdf.h + 8)
-            pdf.cell(0, 0, content, 0, 0, "R", link=attribute.get("src"))
-
-            pdf.set_x(0)
-            pdf.set_y(0)
+            self.apply_style(pdf, attribute, COPYRIGHT_STYLE)
+            with self.layout.fixed(pdf):
+                pdf.set_x(-pdf.get_string_width(content) - 10)
+                pdf.set_y(-pdf.h + 8)
+                pdf.cell(0, 0, content, 0, 0, "R", link=attribute.get("src"))
 
         except SdTeXProcessingError as e:
             raise e
@@ -243,293 +463,192 @@ class SdTeX:
 
 
     def add_title(self, pdf, attribute):
-        content = attribute["content"]
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#000000").strip('"')
-        font_weight = style.get("font_weight", "normal").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
+        self.apply_style(pdf, attribute, TITLE_STYLE)
+        self.layout.paragraph(pdf, attribute["content"])
 
-        if font_weight == "bold":
-            pdf.set_font("Arial", size=font_size, style="B")
-        else:
-            pdf.set_font("Arial", size=font_size)
-
-        pdf.set_text_color(r, g, b)
-
-        self.apply_text_formatting(pdf, content)
-
-        cell_height = pdf.font_size + 8
-
-        text_width = pdf.get_string_width(content)
-        page_width = pdf.w - 2 * pdf.l_margin
-        num_lines = 1
-        if text_width > page_width:
-            num_lines = math.ceil(text_width / page_width)
-            cell_height *= num_lines
+    def add_text(self, pdf, attribute):
+        self.layout.paragraph(pdf, attribute["content"])
 
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
-        self.current_y += cell_height
+    def image_output_path(self, src):
+        output_dir = os.path.join(self.script_dir, "Output")
+        return os.path.join(output_dir, os.path.basename(src))
 
-    def add_text(self, pdf, attribute):
-        content = attribute["content"]
-        self.apply_text_formatting(pdf, content)
+    def prepare_image(self, src):
+        image_file_path = self.fetch_image(src, self.image_output_path(src))
+        if image_file_path and self.optimizer is not None:
+            with Profile.span("optimize_image", "asset", src=src):
+                image_file_path = self.optimizer.optimize(image_file_path, IMAGE_WIDTH)
+        return image_file_path
 
     def add_image(self, pdf, attribute):
         src = attribute["content"]
-        image_file_name = os.path.basename(src)
-        output_dir = os.path.join(self.script_dir, "Output")
-        image_file_path = os.path.join(output_dir, image_file_name)
-
-        if self.download_image(src, image_file_path):
-            with PILImage.open(image_file_path) as img:
-                width, height = img.size
-                resized_height = 180 * height / width
-
-            if self.current_y + resized_height + 10 > pdf.page_break_trigger:
-                pdf.add_page()
-                self.current_y = 0
-
-            pdf.image(
-                image_file_path,
-                x=10,
-                y=self.current_y + 10,
-                w=180,
-                h=resized_height,
-                link=attribute.get("src"),
-            )
-            self.current_y += resized_height
+        if ("sdimage", src) in self.assets:
+            image_file_path = self.assets[("sdimage", src)]
+        else:
+            image_file_path = self.prepare_image(src)
 
+        if image_file_path:
+            self.place_image(pdf, image_file_path, attribute.get("src"))
         else:
             print(f"Failed to download and embed image from {src}.")
 
+    def place_image(self, pdf, image_file_path, link=None):
+        from PIL import Image as PILImage
+
+        with PILImage.open(image_file(image_file_path)) as img:
+            width, height = img.size
+        self.layout.place_image(
+            pdf, image_file_path, IMAGE_WIDTH, IMAGE_WIDTH * height / width, link
+        )
+
     def add_link(self, pdf, attribute):
         content = attribute["content"]
         link_url = attribute.get("url", content)
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#0000FF").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
-
-        pdf.set_font("Arial", size=font_size, style="U")
-        pdf.set_text_color(r, g, b)
+        self.apply_style(pdf, attribute, LINK_STYLE)
+        self.layout.paragraph(pdf, content, link=link_url)
 
-        words = content.split()
-        line = ""
-        for word in words:
-            if pdf.get_string_width(line + word) < pdf.w - 2 * pdf.l_margin:
-                line += f"{word} "
-            else:
-                pdf.cell(0, 10, line, ln=True, link=link_url)
-                line = f"{word} "
-
-        if line:
-            pdf.cell(0, 10, line, ln=True, link=link_url)
-
-        cell_height = pdf.font_size + 2
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
-        self.current_y += cell_height
-
-    def add_graph(self, pdf, attribute):
+    def graph_settings(self, attribute):
+        # function, parametric, data and graph_color take several entries
+        # separated by ";", all drawn in one chart
         attributes = attribute["attributes"]
-        function = attributes.get("function", "x")
+        functions = Graph.split_list(attributes.get("function", ""))
+        parametric = [Graph.parse_pair(pair) for pair in Graph.split_list(attributes.get("parametric", ""))]
+        data = [self.data_file(path) for path in Graph.split_list(attributes.get("data", ""))]
+        if not functions and not parametric and not data:
+            functions = ["x"]
         first_point = int(attributes.get("first_point", -10))
         last_point = int(attributes.get("last_point", 10))
+        first_t = Graph.constant_value(attributes.get("first_t", Graph.DEFAULT_FIRST_T))
+        last_t = Graph.constant_value(attributes.get("last_t", Graph.DEFAULT_LAST_T))
         quality = int(attributes.get("quality", 10))
-        graph_color = attributes.get("graph_color", "#00ff00").strip('"').strip("'")
-
-        output_dir = os.path.join(self.script_dir, "Output")
-        graph_file_path = os.path.join(output_dir, "graph.png")
-        self.save_as_graph(
-            function, first_point, last_point, quality, graph_color, graph_file_path
+        colors = Graph.split_list(attributes.get("graph_color", ""))
+        return Graph.GraphSettings(
+            tuple(functions), tuple(parametric), tuple(data),
+            first_point, last_point, first_t, last_t, quality, tuple(colors),
         )
 
-        with PILImage.open(graph_file_path) as img:
-            width, height = img.size
-            resized_height = 180 * height / width
-
-        if self.current_y + resized_height + 10 > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
-
-        pdf.image(
-            graph_file_path,
-            x=10,
-            y=self.current_y + 10,
-            w=180,
-            h=resized_height,
-            link=attribute.get("src"),
-        )
-        self.current_y += resized_height
-
-    def save_as_graph(
-        self, function, first_point, last_point, quality, graph_color, graph_file_path
-    ):
-        x_values = np.linspace(
-            first_point, last_point, int((last_point - first_point) * quality)
-        )
-        y_values = self.evaluate_function(function, x_values)
+    def data_file(self, path):
+        # Relative to the document; size and mtime are part of the settings so
+        # a changed file is not served from the cache
+        path = os.path.join(os.path.dirname(os.path.abspath(self.input_file)), path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise SdTeXAttributeError(f"Error: Graph data file {path} does not exist")
+        return path, stat.st_mtime_ns, stat.st_size
 
-        rgb_color = matplotlib.colors.to_rgb(graph_color)
+    def graph_mode(self, attribute):
+        attributes = attribute["attributes"]
+        mode = attributes.get("output", self.graph_output).strip('"').strip("'")
+        if mode not in Graph.GRAPH_OUTPUTS:
+            raise SdTeXAttributeError(
+                f"Error: Invalid graph output '{mode}', expected one of {', '.join(Graph.GRAPH_OUTPUTS)}"
+            )
+        try:
+            simplify = float(attributes.get("simplify", Graph.DEFAULT_SIMPLIFY))
+        except ValueError:
+            raise SdTeXAttributeError(f"Error: Invalid simplify value {attributes['simplify']}")
+        return mode, simplify
 
-        plt.figure()
-        plt.plot(x_values, y_values, color=rgb_color)
-        plt.savefig(graph_file_path)
-        plt.close()
+    def add_graph(self, pdf, attribute):
+        settings = self.graph_settings(attribute)
+        mode, simplify = self.graph_mode(attribute)
+        if mode == "vector":
+            self.draw_graph(pdf, settings, simplify, attribute.get("src"))
+            return
+
+        graph_file_path = self.assets.get(("sdgraph", settings))
+        if graph_file_path is None:
+            graph_file_path = self.render_graph(settings)
+
+        self.place_image(pdf, graph_file_path, attribute.get("src"))
+
+    def draw_graph(self, pdf, settings, simplify, link=None):
+        height = IMAGE_WIDTH * Graph.GRAPH_ASPECT
+        top = self.layout.reserve(pdf, height)
+        with Profile.span("draw_graph", "asset", function=settings.label, quality=settings.quality):
+            Graph.draw_graph(pdf, settings, pdf.l_margin, top, IMAGE_WIDTH, height, simplify)
+        if link:
+            pdf.link(pdf.l_margin, top, IMAGE_WIDTH, height, link)
+
+    def graph_target(self, settings):
+        key = RenderCache.key("sdgraph", Graph.GRAPH_VERSION, *settings)
+        if self.cache is None and self.in_memory:
+            return None, key, None
+        if self.cache is None:
+            output_dir = os.path.join(self.script_dir, "Output")
+            return None, key, os.path.join(output_dir, f"graph_{key[:16]}.png")
+
+        cached_path = self.cache.get(key, ".png")
+        if cached_path:
+            return cached_path, key, None
+        return None, key, self.cache.temporary_path(".png")
+
+    def finish_graph(self, key, graph_file_path, data=None):
+        # Without a path the graph was rendered to data, a PNG in memory
+        if graph_file_path is None:
+            return ImageBuffer(f"graph_{key[:16]}.png", data)
+        if self.cache is not None:
+            graph_file_path = self.cache.put(key, ".png", graph_file_path)
         print(f"Graph image has been saved to {graph_file_path}")
+        return graph_file_path
 
-    def evaluate_function(self, function, x_values):
-        return [eval(eval(function.replace("x", str(x)))) for x in x_values]
-
-    def add_bullet(self, pdf, attribute):
-        content = attribute["content"]
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#000000").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
-
-        pdf.set_font("Arial", size=font_size)
-        pdf.set_text_color(r, g, b)
+    def discard_graph(self, graph_file_path):
+        if self.cache is not None and graph_file_path and os.path.exists(graph_file_path):
+            os.remove(graph_file_path)
 
-        self.apply_text_formatting(pdf, f"- {content}")
+    def render_graph(self, settings):
+        cached_path, key, graph_file_path = self.graph_target(settings)
+        if cached_path:
+            return cached_path
 
-        cell_height = pdf.font_size + 2
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
+        try:
+            with Profile.span("save_as_graph", "asset", function=settings.label, quality=settings.quality):
+                data = self.save_as_graph(settings, graph_file_path)
+            return self.finish_graph(key, graph_file_path, data)
+        except Exception:
+            self.discard_graph(graph_file_path)
+            raise
 
-        self.current_y += cell_height
+    def save_as_graph(self, settings, graph_file_path):
+        return Graph.save_as_graph(settings, graph_file_path)
 
-    def add_quote(self, pdf, attribute):
-        content = attribute["content"]
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#888888").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
-
-        pdf.set_font("Arial", size=font_size, style="I")
-        pdf.set_text_color(r, g, b)
+    def evaluate_function(self, function, x_values):
+        from Expression import compile_expression
 
-        self.apply_text_formatting(pdf, content)
+        return compile_expression(function).evaluate(x_values)
 
-        cell_height = pdf.font_size + 6
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
+    def add_bullet(self, pdf, attribute):
+        self.apply_style(pdf, attribute, BULLET_STYLE)
+        self.layout.paragraph(pdf, f"- {attribute['content']}")
 
-        self.current_y += cell_height
+    def add_quote(self, pdf, attribute):
+        self.apply_style(pdf, attribute, QUOTE_STYLE)
+        self.layout.paragraph(pdf, attribute["content"])
 
     def add_author(self, pdf, attribute):
-        content = attribute["content"]
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#555555").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
-
-        pdf.set_font("Arial", size=font_size, style="I")
-        pdf.set_text_color(r, g, b)
-
-        self.apply_text_formatting(pdf, content)
-
-        cell_height = pdf.font_size + 6
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
-        self.current_y += cell_height
+        self.apply_style(pdf, attribute, AUTHOR_STYLE)
+        self.layout.paragraph(pdf, attribute["content"])
 
     def add_code(self, pdf, attribute):
-        content = attribute["content"]
-        style = attribute["style"]
-        font_size = int(
-            style.get("font_size", "12").strip('"').replace("dp", "").strip()
-        )
-        font_color = style.get("font_color", "#FF0000").strip('"')
-
-        if font_color.startswith("#") and len(font_color) == 7:
-            try:
-                r = int(font_color[1:3], 16)
-                g = int(font_color[3:5], 16)
-                b = int(font_color[5:7], 16)
-            except ValueError:
-                r, g, b = 0, 0, 0
-        else:
-            r, g, b = 0, 0, 0
-
-        pdf.set_font("Courier", size=font_size)
-        pdf.set_text_color(r, g, b)
-
-        self.apply_text_formatting(pdf, content)
-
-        cell_height = pdf.font_size + 4
-        if self.current_y + cell_height > pdf.page_break_trigger:
-            pdf.add_page()
-            self.current_y = 0
-
-        self.current_y += cell_height
-
-    def apply_text_formatting(self, pdf, text):
-        try:
-            for line in text.split("\n"):
-                pdf.cell(0, 10, line, ln=True)
-        except Exception as e:
-            raise SdTeXProcessingError(f"Error evaluating function: {e}")
-
+        self.apply_style(pdf, attribute, CODE_STYLE)
+        # Code keeps its own line breaks and indentation
+        self.layout.paragraph(pdf, attribute["content"], wrap=False)
+
+
+def compile(source, path=None, options=None):
+    """
+    Compiles a document from its text and returns the PDF as bytes.
+
+    Graphs and downloaded images stay in memory and go straight into the PDF,
+    and every call has its own state, so compiles can run on several threads
+    at once. path, which need not exist, is where includes, imports and data
+    files are looked up from; it defaults to the working directory. The
+    render cache is off unless options turn it on.
+    """
+    from Options import BuildOptions
+
+    if options is None:
+        options = BuildOptions(use_cache=False)
+    input_file = os.path.abspath(path or "document.sdtex")
+    return options.create(input_file, source=source).build()
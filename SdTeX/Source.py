@@ -0,0 +1,139 @@
+import re
+import os
+import mmap
+
+
+# Long stretches of the buffer are scanned this much at a time, so counting
+# lines never copies more than a chunk of a large document
+CHUNK_SIZE = 1 << 20
+# Bytes 0x80-0xBF continue a UTF-8 character rather than start one
+CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+NONBLANK_PATTERN = re.compile(rb"\S")
+
+
+class Scope:
+    """
+    Variables for substitution. Names missing here are looked up in the
+    parent, so included documents see the variables of whoever includes them.
+    """
+
+    def __init__(self, variables=None, parent=None):
+        self.variables = {} if variables is None else variables
+        self.parent = parent
+        self.merged = {}
+        self.pattern = None
+        self.sizes = None
+
+    def chain(self):
+        scope = self
+        while scope is not None:
+            yield scope.variables
+            scope = scope.parent
+
+    def substitute(self, value):
+        if value is None or "$" not in value:
+            return value
+
+        # Compiled on first use, once every variable has been collected
+        sizes = tuple(len(variables) for variables in self.chain())
+        if sizes != self.sizes:
+            self.merged = {}
+            for variables in reversed(list(self.chain())):
+                self.merged.update(variables)
+            names = sorted(self.merged, key=len, reverse=True)
+            self.pattern = re.compile(r"\$(" + "|".join(re.escape(name) for name in names) + ")")
+            self.sizes = sizes
+        if not self.merged:
+            return value
+        return self.pattern.sub(lambda match: self.merged[match.group(1)], value)
+
+
+class Source:
+    """
+    The bytes of a document, memory-mapped from its file, and the variables
+    defined in it.
+
+    The parser works on byte offsets into the buffer. Text is only decoded,
+    and has variables substituted, when a node's content is read, so the
+    document is never held as one big string or copied once per variable.
+    Whoever opens a mapped source closes it once nothing built from it is
+    read again: a file truncated while still mapped would crash the process
+    on the next read. Sources kept between builds are read instead.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.scope = Scope()
+        self.variables = self.scope.variables
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            # An empty file cannot be mapped; the map outlives the descriptor
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b"")
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def read(cls, path):
+        # For sources that are kept after parsing, such as modules
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(text.encode("utf-8"))
+
+    def is_mapped(self):
+        return isinstance(self.buffer, mmap.mmap)
+
+    def close(self):
+        if self.is_mapped():
+            self.buffer.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def text(self, start, end):
+        return self.buffer[start:end].decode("utf-8")
+
+    def chunks(self, start, end):
+        for offset in range(start, end, CHUNK_SIZE):
+            yield self.buffer[offset:min(offset + CHUNK_SIZE, end)]
+
+    def count_newlines(self, start, end):
+        return sum(chunk.count(b"\n") for chunk in self.chunks(start, end))
+
+    def count_characters(self, start, end):
+        return sum(
+            len(chunk) if chunk.isascii() else len(chunk.translate(None, CONTINUATION_BYTES))
+            for chunk in self.chunks(start, end)
+        )
+
+
+class Slice:
+    """
+    A stretch of a Source, decoded, stripped and substituted when read. The
+    source's own variables are used unless the slice is bound to another scope.
+    """
+
+    __slots__ = ("source", "start", "end", "scope")
+
+    def __init__(self, source, start, end, scope=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.scope = scope
+
+    def __str__(self):
+        scope = self.scope or self.source.scope
+        return scope.substitute(self.source.text(self.start, self.end).strip())
+
+    def __repr__(self):
+        return f"Slice({self.start}, {self.end})"
+
+    def bind(self, scope):
+        return self if scope is self.source.scope else Slice(self.source, self.start, self.end, scope)
+
+    def is_blank(self):
+        return NONBLANK_PATTERN.search(self.source.buffer, self.start, self.end) is None
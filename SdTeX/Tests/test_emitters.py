@@ -0,0 +1,56 @@
+import os
+import re
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SdTeX import SdTeX
+
+
+DOCUMENT = """(sdlink)http://x>)<img src=x onerror=alert(1)>(!sdlink)
+(sdimage)a.png>)<b>x</b>(!sdimage)
+(sdlink)javascript:alert(1)(!sdlink)
+(sdlink)https://example.com/a b(!sdlink)
+"""
+
+
+class MarkdownUrlTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="sdtex-test-")
+        self.source = os.path.join(self.directory, "document.sdtex")
+        with open(self.source, "w") as f:
+            f.write(DOCUMENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def build(self):
+        output = os.path.join(self.directory, "document.md")
+        with contextlib.redirect_stdout(io.StringIO()):
+            SdTeX(self.source, output_file=output, output_format="md").run()
+        with open(output, encoding="utf-8") as f:
+            return f.read()
+
+    def test_urls_stay_inside_their_destination(self):
+        markdown = self.build()
+        # Every destination closes at the end of its block, and no tag
+        # escapes into the text around it
+        for destination in re.findall(r"\]\(<(.*)>\)$", markdown, re.MULTILINE):
+            self.assertNotRegex(destination, r"[<>\s]")
+        # Link text is escaped as Markdown, which leaves \<img as text
+        self.assertNotRegex(markdown, r"(?<!\\)<(img|b)\b")
+        self.assertIn("](<http://x%3E)%3Cimg%20src=x%20onerror=alert(1)%3E>)", markdown)
+        self.assertIn("](<a.png%3E)%3Cb%3Ex%3C/b%3E>)", markdown)
+        self.assertIn("](<https://example.com/a%20b>)", markdown)
+
+    def test_unsafe_scheme_is_text(self):
+        self.assertNotIn("](<javascript:", self.build())
+
+
+if __name__ == "__main__":
+    unittest.main()
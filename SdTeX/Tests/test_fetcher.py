@@ -0,0 +1,138 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import io
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SdTeX import SdTeX
+from Cache import RenderCache
+from Errors import SdTeXSrcError
+from Fetcher import ImageFetcher, DOWNLOADED, NOT_MODIFIED, FAILED
+
+
+IMAGE = b"\xff\xd8\xff\xe0 not really a jpeg"
+ETAG = '"v1"'
+SLOW_SECONDS = 1.0
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """
+    /image.jpg answers conditional requests for ETAG with 304, /broken always
+    fails with 503, /flaky fails twice before answering and /slow waits
+    longer than the fetcher's timeout.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            count = self.server.requests.count(self.path)
+
+        if self.path == "/slow":
+            time.sleep(SLOW_SECONDS)
+        if self.path == "/broken" or (self.path == "/flaky" and count <= 2):
+            self.reply(503)
+        elif self.path == "/image.jpg" and self.headers.get("If-None-Match") == ETAG:
+            self.reply(304)
+        elif self.path in ("/image.jpg", "/flaky", "/slow"):
+            self.reply(200, IMAGE)
+        else:
+            self.reply(404)
+
+    def reply(self, status, body=b""):
+        with self.server.lock:
+            self.server.statuses.append(status)
+        self.send_response(status)
+        if status == 200:
+            self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="sdtex-test-")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address[:2]
+        self.url = f"http://{host}:{port}"
+        self.fetcher = ImageFetcher(timeout=0.2, retries=2, backoff=0)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def download(self, path):
+        output = io.BytesIO()
+        return self.fetcher.download(f"{self.url}{path}", output), output.getvalue()
+
+    def test_retries_until_success(self):
+        result, body = self.download("/flaky")
+        self.assertEqual(result.status, DOWNLOADED)
+        self.assertEqual(body, IMAGE)
+        self.assertEqual(self.server.requests.count("/flaky"), 3)
+
+    def test_gives_up_after_retries(self):
+        result, _ = self.download("/broken")
+        self.assertEqual(result.status, FAILED)
+        self.assertEqual(result.status_code, 503)
+        # The first request and one per retry
+        self.assertEqual(self.server.requests.count("/broken"), 3)
+
+    def test_conditional_request(self):
+        output = io.BytesIO()
+        result = self.fetcher.download(f"{self.url}/image.jpg", output, etag=ETAG)
+        self.assertEqual(result.status, NOT_MODIFIED)
+        self.assertEqual(output.getvalue(), b"")
+
+    def test_not_modified_is_served_from_cache(self):
+        sdtex = SdTeX(
+            os.path.join(self.directory, "document.sdtex"),
+            cache=RenderCache(os.path.join(self.directory, "cache")),
+            fetcher=self.fetcher,
+        )
+        output_path = os.path.join(self.directory, "image.jpg")
+        first = sdtex.fetch_image(f"{self.url}/image.jpg", output_path)
+        second = sdtex.fetch_image(f"{self.url}/image.jpg", output_path)
+
+        self.assertEqual(self.server.statuses, [200, 304])
+        self.assertEqual(first, second)
+        with open(second, "rb") as f:
+            self.assertEqual(f.read(), IMAGE)
+
+    def test_timeout(self):
+        fetcher = ImageFetcher(timeout=0.2, retries=0, backoff=0)
+        started = time.monotonic()
+        try:
+            with self.assertRaises(SdTeXSrcError):
+                fetcher.download(f"{self.url}/slow", io.BytesIO())
+        finally:
+            fetcher.close()
+        self.assertLess(time.monotonic() - started, SLOW_SECONDS)
+        self.assertEqual(self.server.requests.count("/slow"), 1)
+
+    def test_timeout_is_retried(self):
+        started = time.monotonic()
+        with self.assertRaises(SdTeXSrcError):
+            self.fetcher.download(f"{self.url}/slow", io.BytesIO())
+        # Each attempt gives up after the timeout, not when the server answers
+        self.assertLess(time.monotonic() - started, SLOW_SECONDS)
+        self.assertEqual(self.server.requests.count("/slow"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import contextlib
+import io
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SdTeX import SdTeX
+from Assets import AssetPrefetcher
+
+
+DOCUMENT = """(sdgraph attributes={
+    data: "data.csv",
+    output: "vector"
+})(!sdgraph)
+"""
+
+
+class VectorGraphDataTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="sdtex-test-")
+        self.source = os.path.join(self.directory, "document.sdtex")
+        self.output = os.path.join(self.directory, "document.pdf")
+        with open(self.source, "w") as f:
+            f.write(DOCUMENT)
+        self.write_data("0,1\n1,2\n2,3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_data(self, text):
+        with open(os.path.join(self.directory, "data.csv"), "w") as f:
+            f.write(text)
+
+    def build(self):
+        printed = io.StringIO()
+        with contextlib.redirect_stdout(printed):
+            SdTeX(self.source, output_file=self.output, graph_workers=1).run()
+        return printed.getvalue()
+
+    def test_editing_data_rebuilds(self):
+        self.build()
+        self.assertIn("is up to date", self.build())
+
+        with open(self.output, "rb") as f:
+            before = f.read()
+        self.write_data("0,5\n1,-4\n2,9\n3,0\n")
+        self.assertNotIn("is up to date", self.build())
+        with open(self.output, "rb") as f:
+            self.assertNotEqual(before.split(b"/CreationDate")[0], f.read().split(b"/CreationDate")[0])
+
+    def test_up_to_date_build_fetches_nothing(self):
+        self.build()
+        with mock.patch.object(AssetPrefetcher, "prefetch", side_effect=AssertionError("prefetched")):
+            self.assertIn("is up to date", self.build())
+
+
+if __name__ == "__main__":
+    unittest.main()
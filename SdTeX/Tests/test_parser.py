@@ -0,0 +1,131 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Parser import Parser, Tag, Text
+from Processor import Processor
+from Source import Source
+
+
+THEME = """accent: "#336699"
+company: "Acme"
+"""
+
+HEADER = """section: "Intro"
+(sdtitle)$title by $company in $section(!sdtitle)
+"""
+
+DOCUMENT = """(sdimport src="parts/theme.sdtex")(!sdimport)
+title: "Report"
+company: "Globex"
+(sdinclude src="parts/header.sdtex")(!sdinclude)
+(sdquote style={ font_color: "$accent" })$company $accent – ünïcode(!sdquote)
+(sdtex)(sdbullet)one(!sdbullet)
+(sdbullet)two(!sdbullet)(!sdtex)
+(sdtitle)Never closed
+"""
+
+
+def describe(nodes):
+    # Every field of every node, in document order, without recursing
+    described = []
+    pending = list(reversed(nodes))
+    while pending:
+        node = pending.pop()
+        described.append(
+            (
+                node.type,
+                node.content,
+                dict(node.style),
+                dict(node.attributes),
+                len(node.children),
+                node.line_number,
+                node.column,
+            )
+        )
+        pending.extend(reversed(node.children))
+    return described
+
+
+class ParserTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="sdtex-test-")
+        self.path = self.write("document.sdtex", DOCUMENT)
+        self.write("parts/theme.sdtex", THEME)
+        self.write("parts/header.sdtex", HEADER)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def process(self, source, stream=False):
+        # Contents are read before the source is closed, as a build does
+        processor = Processor(source, self.path)
+        try:
+            return describe(list(processor.iter_content()) if stream else processor.process_content())
+        finally:
+            source.close()
+
+    def test_nesting_past_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 5
+        text = "(sdtex)" * depth + "(sdtitle)Deep(!sdtitle)" + "(!sdtex)" * depth
+
+        tag = Parser(text).parse().children[0]
+        for _ in range(depth - 1):
+            tag = tag.children[0]
+        self.assertEqual(tag.children[0].name, "sdtitle")
+
+        node = Processor(Source.from_text(text)).process_content()[0]
+        for _ in range(depth):
+            node = node.children[0]
+        self.assertEqual((node.type, node.content), ("sdtitle", "Deep"))
+
+    def test_unclosed_tags_are_text(self):
+        children = Parser("(sdtitle)Open (sdquote)inner(!sdquote) tail").parse().children
+        self.assertEqual(
+            [(type(child).__name__, str(child.value) if isinstance(child, Text) else child.name) for child in children],
+            [("Text", "(sdtitle)"), ("Text", "Open"), ("Tag", "sdquote"), ("Text", "tail")],
+        )
+
+        # An opening left unclosed inside a closed tag stays part of its content
+        tag = Parser("(sdtex)(sdtitle)Unclosed(!sdtex)").parse().children[0]
+        self.assertIsInstance(tag, Tag)
+        self.assertEqual(str(tag.content), "(sdtitle)Unclosed")
+        self.assertEqual(tag.children, [])
+
+        # Thousands of unclosed openings are demoted without recursing
+        children = Parser("(sdtitle)" * 5000 + "end").parse().children
+        self.assertTrue(all(isinstance(child, Text) for child in children))
+
+    def test_variables_across_include_and_import(self):
+        title, quote = self.process(Source.open(self.path))[:2]
+        # The included file sees the includer's variables and its own; an
+        # imported variable only fills names the document leaves undefined
+        self.assertEqual(title[:2], ("sdtitle", "Report by Globex in Intro"))
+        self.assertEqual(quote[:2], ("sdquote", "Globex #336699 – ünïcode"))
+        self.assertEqual(quote[2]["font_color"], '"#336699"')
+
+    def test_mapped_and_read_sources_agree(self):
+        with open(self.path, encoding="utf-8") as f:
+            text = f.read()
+        mapped = Source.open(self.path)
+        self.assertTrue(mapped.is_mapped())
+
+        expected = self.process(mapped)
+        self.assertEqual(self.process(Source.read(self.path)), expected)
+        self.assertEqual(self.process(Source.from_text(text)), expected)
+        self.assertEqual(self.process(Source.open(self.path), stream=True), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import sys
+import pickle
+import hashlib
+from Parser import PARSER_VERSION
+from Processor import Node, Interner
+from Modules import file_stamp
+
+
+TREE_EXTENSION = ".tree"
+
+
+class TreeCache:
+    """
+    Processed node lists, pickled into the render cache and keyed by the
+    source's bytes and the parser version, so a source that has not changed
+    is never parsed again.
+
+    Contents are stored as the text they read as, with variables already
+    substituted, and styles and attributes as one table the nodes index
+    into. Each entry records the files the source includes or imports with
+    their mtime and size; a change to any of them, or to the directory they
+    were resolved from, makes the entry stale.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def key(self, buffer):
+        digest = hashlib.sha256(buffer).hexdigest()
+        return self.cache.key("tree", PARSER_VERSION, digest)
+
+    def load(self, key, directory):
+        path = self.cache.get(key, TREE_EXTENSION)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+            if entry["version"] != PARSER_VERSION or not self.is_current(entry, directory):
+                return None
+            interner = Interner()
+            mappings = [interner.intern(mapping) for mapping in entry["mappings"]]
+            return load_nodes(entry["nodes"], entry["roots"], mappings)
+        except Exception:
+            # A damaged or foreign entry is parsed again and replaced
+            return None
+
+    def is_current(self, entry, directory):
+        # Only the files a source pulls in depend on where it is
+        if not entry["dependencies"]:
+            return True
+        if entry["directory"] != directory:
+            return False
+        try:
+            return all(file_stamp(path) == stamp for path, stamp in entry["dependencies"].items())
+        except OSError:
+            return False
+
+    def save(self, key, nodes, directory, dependencies):
+        mappings = {}
+        table, roots = dump_nodes(nodes, mappings)
+        entry = {
+            "version": PARSER_VERSION,
+            "directory": directory,
+            "dependencies": dependencies,
+            "nodes": table,
+            "roots": roots,
+            # Interned mappings are shared between nodes; each is stored once
+            "mappings": [dict(mapping) for mapping, _ in sorted(mappings.values(), key=lambda item: item[1])],
+        }
+        temporary_path = self.cache.temporary_path(TREE_EXTENSION)
+        try:
+            with open(temporary_path, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.cache.put(key, TREE_EXTENSION, temporary_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+
+def mapping_index(mapping, mappings):
+    found = mappings.get(id(mapping))
+    if found is None:
+        found = mappings[id(mapping)] = (mapping, len(mappings))
+    return found[1]
+
+
+def dump_nodes(nodes, mappings):
+    # Nodes are stored as one flat table, children before their parent and
+    # referenced by index, so neither this nor pickle recurses per level
+    table = []
+    indices = {}
+    stack = [(node, False) for node in reversed(nodes)]
+    while stack:
+        node, children_done = stack.pop()
+        if not children_done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.children))
+            continue
+        indices[id(node)] = len(table)
+        table.append(
+            (
+                node.type,
+                node.content,
+                mapping_index(node.style, mappings),
+                mapping_index(node.attributes, mappings),
+                tuple(indices[id(child)] for child in node.children),
+                node.line_number,
+                node.column,
+            )
+        )
+    return table, [indices[id(node)] for node in nodes]
+
+
+def load_nodes(table, roots, mappings):
+    loaded = []
+    for type, content, style, attributes, children, line_number, column in table:
+        loaded.append(
+            Node(
+                sys.intern(type),
+                content,
+                mappings[style],
+                mappings[attributes],
+                tuple(loaded[index] for index in children),
+                line_number,
+                column,
+            )
+        )
+    return [loaded[index] for index in roots]
@@ -0,0 +1,76 @@
+import os
+import time
+from Errors import *
+
+
+DEFAULT_WATCH_INTERVAL = 0.25
+
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Watcher:
+    def __init__(self, find_sources, build, interval=DEFAULT_WATCH_INTERVAL, dependencies=None):
+        self.find_sources = find_sources
+        self.build = build
+        self.interval = interval
+        # Maps a source to the files it includes, so changing one rebuilds it
+        self.dependencies = dependencies
+        self.known = {}
+
+    def snapshot(self):
+        stamps = {}
+        for source in self.find_sources():
+            stamp = modified_time(source)
+            if stamp is not None:
+                stamps[source] = self.watched_stamps(source, stamp)
+        return stamps
+
+    def watched_stamps(self, source, stamp):
+        if self.dependencies is None:
+            return (stamp,)
+
+        # Dependencies are only looked up again once something changed
+        cached = self.known.get(source)
+        if cached is not None:
+            paths, stamps = cached
+            current = (stamp,) + tuple(modified_time(path) for path in paths)
+            if current == stamps:
+                return current
+        paths = self.dependencies(source)
+        current = (stamp,) + tuple(modified_time(path) for path in paths)
+        self.known[source] = (paths, current)
+        return current
+
+    def rebuild(self, sources):
+        started = time.perf_counter()
+        try:
+            self.build(sources)
+        except SdTeXError as e:
+            print(e.message)
+            return
+        print(f"Rebuilt in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+    def run(self):
+        # Polling keeps this dependency-free and portable; a stat per source
+        # every interval is cheap next to a rebuild.
+        stamps = self.snapshot()
+        self.rebuild(sorted(stamps))
+        print(f"Watching {len(stamps)} file(s) for changes. Press Ctrl+C to stop.")
+
+        try:
+            while True:
+                time.sleep(self.interval)
+                current = self.snapshot()
+                changed = sorted(
+                    source for source, stamp in current.items() if stamps.get(source) != stamp
+                )
+                stamps = current
+                if changed:
+                    self.rebuild(changed)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
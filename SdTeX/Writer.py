@@ -0,0 +1,485 @@
+import io
+import os
+import zlib
+import struct
+import hashlib
+from fpdf import FPDF
+from Images import ImageBuffer
+from Fonts import FONTS, MAX_CODE
+from Errors import *
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Maps each 16-bit character code to the same Unicode value, for text
+# extraction and search
+IDENTITY_CMAP = """/CIDInit /ProcSet findresource begin
+12 dict begin
+begincmap
+/CIDSystemInfo <</Registry (Adobe) /Ordering (UCS) /Supplement 0>> def
+/CMapName /Adobe-Identity-UCS def
+/CMapType 2 def
+1 begincodespacerange
+<0000> <FFFF>
+endcodespacerange
+1 beginbfrange
+<0000> <FFFF> <0000>
+endbfrange
+endcmap
+CMapName currentdict /CMap defineresource pop
+end
+end"""
+
+
+class CharacterSet(set):
+    # fpdf appends every character it draws to a font's subset
+    append = set.add
+
+
+class DocumentFPDF(FPDF):
+    """
+    FPDF that can also draw with TrueType and OpenType font files.
+
+    Font files are parsed once per process and shared between documents; each
+    document embeds a subset holding only the characters it drew, cut once
+    per distinct set of characters.
+    """
+
+    def add_font_file(self, path):
+        family = os.path.abspath(path).lower()
+        if family not in self.fonts:
+            face = FONTS.load(path)
+            self.fonts[family] = {
+                "i": len(self.fonts) + 1,
+                "type": "TTF",
+                "name": face.name,
+                "desc": face.desc,
+                "up": face.underline_position,
+                "ut": face.underline_thickness,
+                "cw": face.widths,
+                "face": face,
+                "subset": CharacterSet(),
+            }
+        return family
+
+    def set_font(self, family, style="", size=0):
+        # A font file is one face; bold and italic come from choosing another
+        # file, so only underlining is kept
+        if family.lower() in self.fonts and "face" in self.fonts[family.lower()]:
+            style = "U" if "U" in style.upper() else ""
+        super().set_font(family, style, size)
+
+    def normalize_text(self, txt):
+        if not self.unifontsubset and not txt.isascii():
+            try:
+                txt.encode("latin1")
+            except UnicodeEncodeError:
+                raise SdTeXStyleError(
+                    f"Error: {self.current_font['name']} can only draw Latin-1 text, "
+                    f"set font_family to a .ttf or .otf file to draw {txt!r}"
+                )
+        return txt
+
+    def _putfonts(self):
+        fonts = self.fonts
+        self.fonts = {key: font for key, font in fonts.items() if "face" not in font}
+        try:
+            super()._putfonts()
+        finally:
+            self.fonts = fonts
+        for font in sorted((font for font in fonts.values() if "face" in font), key=lambda font: font["i"]):
+            self.put_font_file(font)
+
+    def put_font_file(self, font):
+        face = font["face"]
+        codes = sorted(code for code in font["subset"] if 0 < code <= MAX_CODE)
+        data, glyphs = FONTS.subset(face, codes)
+        # Subsets are named with a tag of six capitals drawn from what they hold
+        digest = hashlib.md5(repr(codes).encode("ascii")).digest()
+        tag = "".join(chr(ord("A") + byte % 26) for byte in digest[:6])
+        name = f"{tag}+{face.name}"
+
+        font["n"] = self.n + 1
+        self._newobj()
+        self._out("<</Type /Font /Subtype /Type0")
+        self._out(f"/BaseFont /{name}")
+        self._out("/Encoding /Identity-H")
+        self._out(f"/DescendantFonts [{self.n + 1} 0 R]")
+        self._out(f"/ToUnicode {self.n + 2} 0 R")
+        self._out(">>")
+        self._out("endobj")
+
+        self._newobj()
+        self._out("<</Type /Font /Subtype /CIDFontType2")
+        self._out(f"/BaseFont /{name}")
+        self._out(f"/CIDSystemInfo {self.n + 2} 0 R")
+        self._out(f"/FontDescriptor {self.n + 3} 0 R")
+        self._out(f"/DW {face.desc['MissingWidth']}")
+        self._out(f"/W {width_array(codes, face.widths)}")
+        self._out(f"/CIDToGIDMap {self.n + 4} 0 R")
+        self._out(">>")
+        self._out("endobj")
+
+        self.put_stream_object(IDENTITY_CMAP.encode("ascii"))
+
+        self._newobj()
+        self._out("<</Registry (Adobe) /Ordering (UCS) /Supplement 0>>")
+        self._out("endobj")
+
+        self._newobj()
+        descriptor = f"<</Type /FontDescriptor /FontName /{name}"
+        for key in ("Ascent", "Descent", "CapHeight", "Flags", "FontBBox", "ItalicAngle", "StemV", "MissingWidth"):
+            descriptor += f" /{key} {face.desc[key]}"
+        self._out(f"{descriptor} /FontFile2 {self.n + 2} 0 R>>")
+        self._out("endobj")
+
+        gid_map = bytearray(2 * (codes[-1] + 1 if codes else 1))
+        for code, glyph in glyphs.items():
+            gid_map[2 * code:2 * code + 2] = glyph.to_bytes(2, "big")
+        self.put_stream_object(bytes(gid_map))
+        self.put_stream_object(data, f" /Length1 {len(data)}")
+
+    def put_stream_object(self, data, entries=""):
+        compressed = zlib.compress(data)
+        self._newobj()
+        self._out(f"<</Length {len(compressed)} /Filter /FlateDecode{entries}>>")
+        self._putstream(compressed)
+        self._out("endobj")
+
+
+def width_array(codes, widths):
+    # Consecutive codes share one run: [first [w1 w2 ...] first [...] ...]
+    runs = []
+    for code in codes:
+        if runs and runs[-1][0] + len(runs[-1][1]) == code:
+            runs[-1][1].append(widths[code])
+        else:
+            runs.append((code, [widths[code]]))
+    return "[" + " ".join(f"{first} [{' '.join(map(str, run))}]" for first, run in runs) + "]"
+
+
+class StreamingFPDF(DocumentFPDF):
+    """
+    FPDF that writes to its output file while the document is being laid out.
+
+    Each page's content stream is written as soon as the page is finished and
+    each image is written the first time it is placed, so memory use does not
+    grow with the number of pages. Only the small page dictionaries, which may
+    carry links to pages that do not exist yet, are held until the end.
+
+    With no output file the PDF is written to memory and output() returns
+    its bytes. Either way it is written once, in order, rather than built up
+    by concatenating to one string as FPDF does.
+    """
+
+    def __init__(self, output_file=None, orientation="P", unit="mm", format="A4"):
+        super().__init__(orientation, unit, format)
+        self.output_file = output_file
+        if output_file is None:
+            self.partial_path = None
+            self.stream = io.BytesIO()
+        else:
+            self.partial_path = f"{output_file}.part"
+            self.stream = open(self.partial_path, "wb")
+        self.offset = 0
+        self.page_objects = {}
+        self.content_objects = {}
+
+    def alias_nb_pages(self, alias="{nb}"):
+        raise SdTeXProcessingError(
+            "Error: Page count aliases are not supported when streaming, pages are written before the count is known"
+        )
+
+    def open(self):
+        super().open()
+        self._putheader()
+
+    def _out(self, s):
+        if self.state == 2:
+            super()._out(s)
+            return
+        if isinstance(s, str):
+            s = s.encode("latin1")
+        elif not isinstance(s, bytes):
+            s = str(s).encode("latin1")
+        self.stream.write(s)
+        self.stream.write(b"\n")
+        self.offset += len(s) + 1
+
+    def _newobj(self):
+        self.n += 1
+        self.offsets[self.n] = self.offset
+        self._out(f"{self.n} 0 obj")
+
+    def _endpage(self):
+        super()._endpage()
+        self.flush_page(self.page)
+
+    def flush_page(self, page):
+        if page in self.content_objects:
+            return
+
+        # The page dictionary is written at the end, its number is reserved now
+        self.n += 1
+        self.page_objects[page] = self.n
+
+        content = self.pages[page].encode("latin1")
+        self.pages[page] = ""
+        if self.compress:
+            content = zlib.compress(content)
+            filter = "/Filter /FlateDecode "
+        else:
+            filter = ""
+
+        self._newobj()
+        self.content_objects[page] = self.n
+        self._out(f"<<{filter}/Length {len(content)}>>")
+        self._putstream(content)
+        self._out("endobj")
+
+    def image(self, name, x=None, y=None, w=0, h=0, type="", link=""):
+        if isinstance(name, ImageBuffer):
+            if name.name not in self.images:
+                info = buffer_image_info(name)
+                info["i"] = len(self.images) + 1
+                self.images[name.name] = info
+            name = name.name
+        super().image(name, x, y, w, h, type, link)
+        info = self.images[name]
+        if "data" in info:
+            state = self.state
+            self.state = 1
+            try:
+                self._putimage(info)
+            finally:
+                self.state = state
+            del info["data"]
+            info.pop("smask", None)
+
+    def _putimages(self):
+        # Images were written when first placed
+        pass
+
+    def _putpages(self):
+        if self.def_orientation == "P":
+            w_pt, h_pt = self.fw_pt, self.fh_pt
+        else:
+            w_pt, h_pt = self.fh_pt, self.fw_pt
+
+        for page in range(1, self.page + 1):
+            self.offsets[self.page_objects[page]] = self.offset
+            self._out(f"{self.page_objects[page]} 0 obj")
+            self._out("<</Type /Page")
+            self._out("/Parent 1 0 R")
+            if page in self.orientation_changes:
+                self._out("/MediaBox [0 0 %.2f %.2f]" % (h_pt, w_pt))
+            self._out("/Resources 2 0 R")
+            if page in self.page_links:
+                self._out(self.annotations(page, w_pt, h_pt) + "]")
+            if self.pdf_version > "1.3":
+                self._out("/Group <</Type /Group /S /Transparency /CS /DeviceRGB>>")
+            self._out(f"/Contents {self.content_objects[page]} 0 R>>")
+            self._out("endobj")
+
+        self.offsets[1] = self.offset
+        self._out("1 0 obj")
+        self._out("<</Type /Pages")
+        kids = " ".join(f"{self.page_objects[page]} 0 R" for page in range(1, self.page + 1))
+        self._out(f"/Kids [{kids} ]")
+        self._out(f"/Count {self.page}")
+        self._out("/MediaBox [0 0 %.2f %.2f]" % (w_pt, h_pt))
+        self._out(">>")
+        self._out("endobj")
+
+    def annotations(self, page, w_pt, h_pt):
+        annots = "/Annots ["
+        for pl in self.page_links[page]:
+            rect = "%.2f %.2f %.2f %.2f" % (pl[0], pl[1], pl[0] + pl[2], pl[1] - pl[3])
+            annots += "<</Type /Annot /Subtype /Link /Rect [" + rect + "] /Border [0 0 0] "
+            if isinstance(pl[4], str):
+                annots += "/A <</S /URI /URI " + self._textstring(pl[4]) + ">>>>"
+            else:
+                target_page, y = self.links[pl[4]]
+                h = w_pt if target_page in self.orientation_changes else h_pt
+                annots += "/Dest [%d 0 R /XYZ 0 %.2f null]>>" % (
+                    self.page_objects[target_page],
+                    h - y * self.k,
+                )
+        return annots
+
+    def _putresources(self):
+        self._putfonts()
+        self.offsets[2] = self.offset
+        self._out("2 0 obj")
+        self._out("<<")
+        self._putresourcedict()
+        self._out(">>")
+        self._out("endobj")
+
+    def _putcatalog(self):
+        first_page = f"{self.page_objects[1]} 0 R"
+        self._out("/Type /Catalog")
+        self._out("/Pages 1 0 R")
+        if self.zoom_mode == "fullpage":
+            self._out(f"/OpenAction [{first_page} /Fit]")
+        elif self.zoom_mode == "fullwidth":
+            self._out(f"/OpenAction [{first_page} /FitH null]")
+        elif self.zoom_mode == "real":
+            self._out(f"/OpenAction [{first_page} /XYZ null null 1]")
+        elif not isinstance(self.zoom_mode, str):
+            self._out(f"/OpenAction [{first_page} /XYZ null null {self.zoom_mode / 100}]")
+        if self.layout_mode == "single":
+            self._out("/PageLayout /SinglePage")
+        elif self.layout_mode == "continuous":
+            self._out("/PageLayout /OneColumn")
+        elif self.layout_mode == "two":
+            self._out("/PageLayout /TwoColumnLeft")
+
+    def _enddoc(self):
+        self._putpages()
+        self._putresources()
+        self._newobj()
+        self._out("<<")
+        self._putinfo()
+        self._out(">>")
+        self._out("endobj")
+        self._newobj()
+        self._out("<<")
+        self._putcatalog()
+        self._out(">>")
+        self._out("endobj")
+
+        xref = self.offset
+        self._out("xref")
+        self._out(f"0 {self.n + 1}")
+        self._out("0000000000 65535 f ")
+        for i in range(1, self.n + 1):
+            self._out("%010d 00000 n " % self.offsets[i])
+        self._out("trailer")
+        self._out("<<")
+        self._puttrailer()
+        self._out(">>")
+        self._out("startxref")
+        self._out(xref)
+        self._out("%%EOF")
+        self.state = 3
+
+    def output(self, name="", dest=""):
+        if self.state < 3:
+            self.close()
+        if self.partial_path is None:
+            return self.stream.getvalue()
+        self.stream.close()
+        os.replace(self.partial_path, name or self.output_file)
+        return ""
+
+    def abort(self):
+        if not self.stream.closed:
+            self.stream.close()
+        if self.partial_path is not None and os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def buffer_image_info(image):
+    # The image entry FPDF's parsers would make from a file
+    if image.data.startswith(PNG_SIGNATURE):
+        info = png_info(image.data)
+        if info is not None:
+            return info
+
+    from PIL import Image as PILImage
+
+    try:
+        with PILImage.open(image.open()) as img:
+            if img.format == "JPEG":
+                colorspace = {"L": "DeviceGray", "CMYK": "DeviceCMYK"}.get(img.mode, "DeviceRGB")
+                return {"w": img.width, "h": img.height, "cs": colorspace, "bpc": 8, "f": "DCTDecode", "data": image.data}
+            return decoded_image_info(img)
+    except OSError as e:
+        raise SdTeXSrcError(f"Error reading image {image.name}: {e}")
+
+
+def png_chunks(data):
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack_from(">I4s", data, offset)
+        yield kind, data[offset + 8:offset + 8 + length]
+        offset += length + 12
+
+
+def png_info(data):
+    # PNGs without an alpha channel are embedded as they are, their
+    # compressed rows copied straight into the PDF; None for the others
+    chunks = png_chunks(data)
+    kind, header = next(chunks, (None, b""))
+    if kind != b"IHDR" or len(header) < 13:
+        return None
+    width, height, bpc, color_type, _, _, interlace = struct.unpack(">IIBBBBB", header[:13])
+    if color_type not in (0, 2, 3) or bpc > 8 or interlace:
+        return None
+
+    palette = b""
+    transparency = ""
+    parts = []
+    for kind, body in chunks:
+        if kind == b"PLTE":
+            palette = body
+        elif kind == b"tRNS":
+            if color_type == 0:
+                transparency = [body[1]]
+            elif color_type == 2:
+                transparency = [body[1], body[3], body[5]]
+            elif body.find(b"\x00") != -1:
+                transparency = [body.find(b"\x00")]
+        elif kind == b"IDAT":
+            parts.append(body)
+        elif kind == b"IEND":
+            break
+    if color_type == 3 and not palette:
+        return None
+
+    colors = 3 if color_type == 2 else 1
+    return {
+        "w": width,
+        "h": height,
+        "cs": {0: "DeviceGray", 2: "DeviceRGB", 3: "Indexed"}[color_type],
+        "bpc": bpc,
+        "f": "FlateDecode",
+        "dp": f"/Predictor 15 /Colors {colors} /BitsPerComponent {bpc} /Columns {width}",
+        "pal": palette,
+        "trns": transparency,
+        "data": b"".join(parts),
+    }
+
+
+def decoded_image_info(img):
+    # Anything else is decoded and written as plain rows, with its alpha
+    # channel, if any, as a soft mask
+    gray = img.mode in ("1", "L", "LA", "I", "I;16", "F")
+    mode = "L" if gray else "RGB"
+    alpha = None
+    if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+        img = img.convert("LA" if gray else "RGBA")
+        alpha = img.getchannel("A")
+    color = img.convert(mode)
+    colors = 1 if gray else 3
+
+    info = {
+        "w": img.width,
+        "h": img.height,
+        "cs": "DeviceGray" if gray else "DeviceRGB",
+        "bpc": 8,
+        "f": "FlateDecode",
+        "dp": f"/Predictor 15 /Colors {colors} /BitsPerComponent 8 /Columns {img.width}",
+        "pal": "",
+        "trns": "",
+        "data": zlib.compress(png_rows(color.tobytes(), img.width * colors)),
+    }
+    if alpha is not None:
+        info["smask"] = zlib.compress(png_rows(alpha.tobytes(), img.width))
+    return info
+
+
+def png_rows(pixels, stride):
+    # Each row starts with its PNG filter type, 0 for none, as the Predictor
+    # 15 decode parameters that FPDF writes for soft masks expect
+    return b"".join(b"\x00" + pixels[start:start + stride] for start in range(0, len(pixels), stride))
@@ -1,26 +1,170 @@
+import os
 import argparse
-from SdTeX import SdTeX
+from Cache import RenderCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+from Assets import DEFAULT_GRAPH_WORKERS, DEFAULT_IMAGE_WORKERS
+from Fetcher import DEFAULT_TIMEOUT, DEFAULT_RETRIES, DEFAULT_CONNECTIONS_PER_HOST
+from Images import DEFAULT_IMAGE_DPI, DEFAULT_JPEG_QUALITY, DEFAULT_PALETTE_COLORS
+from Graph import GRAPH_OUTPUTS, DEFAULT_GRAPH_OUTPUT
+from Options import BuildOptions, OUTPUT_DIR
+from Batch import BatchCompiler, find_sources
+from Watch import Watcher, DEFAULT_WATCH_INTERVAL
+import Profile
+import Modules
 
 def main():
     """
     Command-line arguments:
-    - input_file: The .sdtex file to process.
+    - input_file: The .sdtex file to process, or a directory or glob of files to compile in one batch.
     - -pdf: Optional flag to export as PDF.
+    - -html: Write an HTML page instead of a PDF, skipping page layout; graphs and images are linked, not embedded.
+    - -md: Write Markdown instead of a PDF, linking graphs and images the same way.
+    - --asset-url: Base URL graphs are linked under in HTML and Markdown output, for a server publishing the cache directory; paths relative to the output file are used otherwise.
+    - --output-dir: Where batch builds write their PDFs, each named after its source.
+    - --jobs: Number of documents a batch build compiles in parallel.
+    - --cache-dir: Directory holding rendered graphs and downloaded images.
+    - --cache-size: Maximum size of the cache in megabytes.
+    - --no-cache: Render every asset from scratch and leave the cache untouched.
+    - --clear-cache: Empty the cache before processing.
+    - --graph-workers: Number of processes rendering graphs in parallel.
+    - --image-workers: Number of threads downloading images in parallel.
+    - --timeout: Seconds to wait on an image host before giving up.
+    - --retries: Attempts per image after a connection error or 5xx response.
+    - --connections-per-host: Maximum simultaneous connections to one image host.
+    - --image-dpi: Resolution images are downsampled to for their placed size (0 keeps full size).
+    - --jpeg-quality: JPEG quality used when recompressing photos.
+    - --palette-colors: Palette size for PNG images with transparency (0 keeps full colour).
+    - --graph-output: Default output of graphs: raster (PNG via matplotlib) or vector (paths drawn into the PDF).
+    - --stream: Write pages to the PDF as they are laid out, keeping memory flat for very long documents.
+    - --force: Rebuild even when the build manifest says the PDF is up to date.
+    - --watch: Keep running and rebuild whenever a source file, or a file it includes or imports, changes.
+    - --watch-interval: Seconds between checks for changed files in watch mode.
+    - --serve: Run a render daemon instead of building: POST a source to /render (or /render?path=file.sdtex) to get the PDF back, GET /stats for throughput and latency. --jobs sets the number of warm workers.
+    - --port: Localhost port the daemon listens on.
+    - --socket: Listen on this Unix socket instead of a port.
+    - --max-queue: Jobs the daemon lets wait for a worker before answering 503.
+    - --job-timeout: Seconds a job may run before the daemon answers 504 and replaces its worker.
+    - --check: Only parse the input and report syntax errors; nothing is rendered.
+    - --profile: Time every stage and node, write a Chrome trace (default Output/profile.json) and print the slowest spans.
+    - --profile-top: Number of spans listed in the profile summary.
+    - --profile-no-memory: Profile without tracking allocations, which otherwise slows the build down several times.
 
     Usage example:
     python main.py main.sdtex -pdf
+    python main.py main.sdtex -html --watch
+    python main.py "reports/*.sdtex" --output-dir build --jobs 4
+    python main.py main.sdtex --watch
+    python main.py --serve --jobs 4
+    curl --data-binary @main.sdtex http://127.0.0.1:8765/render -o main.pdf
     """
     parser = argparse.ArgumentParser(description='SdTeX - A magical alternative to modern typesetting systems (I\'m looking at you, LaTeX), made in two days, by a high schooler😉')
-    parser.add_argument('input_file', help='The .sdtex file to process')
-    parser.add_argument('-pdf', action='store_true', help='Export as PDF (default)')
+    parser.add_argument('input_file', nargs='?', help='The .sdtex file to process, or a directory or glob for a batch build')
+    formats = parser.add_mutually_exclusive_group()
+    formats.add_argument('-pdf', action='store_true', help='Export as PDF (default)')
+    formats.add_argument('-html', action='store_true', help='Export as HTML, without laying out pages')
+    formats.add_argument('-md', action='store_true', help='Export as Markdown, without laying out pages')
+    parser.add_argument('--asset-url', help='Base URL for graphs linked from HTML and Markdown output')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help='Output directory for batch builds')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_GRAPH_WORKERS, help='Documents compiled in parallel in a batch build')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Directory for cached graphs and images')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_SIZE // (1024 * 1024), help='Maximum cache size in megabytes')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the render cache')
+    parser.add_argument('--clear-cache', action='store_true', help='Clear the render cache before processing')
+    parser.add_argument('--graph-workers', type=int, default=DEFAULT_GRAPH_WORKERS, help='Processes used to render graphs (1 renders serially)')
+    parser.add_argument('--image-workers', type=int, default=DEFAULT_IMAGE_WORKERS, help='Threads used to download images (1 downloads serially)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help='Image download timeout in seconds')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='Retries per image download')
+    parser.add_argument('--connections-per-host', type=int, default=DEFAULT_CONNECTIONS_PER_HOST, help='Maximum connections to a single image host')
+    parser.add_argument('--image-dpi', type=int, default=DEFAULT_IMAGE_DPI, help='Target resolution for embedded images (0 disables downsampling)')
+    parser.add_argument('--jpeg-quality', type=int, default=DEFAULT_JPEG_QUALITY, help='JPEG quality for recompressed images')
+    parser.add_argument('--palette-colors', type=int, default=DEFAULT_PALETTE_COLORS, help='Palette size for transparent PNG images (0 disables quantization)')
+    parser.add_argument('--check', action='store_true', help='Parse the input and report errors without rendering')
+    parser.add_argument('--graph-output', choices=GRAPH_OUTPUTS, default=DEFAULT_GRAPH_OUTPUT, help='How graphs without an output attribute are drawn')
+    parser.add_argument('--stream', action='store_true', help='Stream pages to the output file instead of building the PDF in memory')
+    parser.add_argument('--force', action='store_true', help='Ignore the build manifest and always write the PDF')
+    parser.add_argument('--watch', action='store_true', help='Rebuild whenever a source file changes')
+    parser.add_argument('--profile', nargs='?', const=os.path.join(OUTPUT_DIR, 'profile.json'), help='Write a Chrome trace of the build to this path and print a summary')
+    parser.add_argument('--profile-no-memory', action='store_true', help='Skip allocation tracking so profiled timings are not inflated')
+    parser.add_argument('--profile-top', type=int, default=Profile.DEFAULT_TOP, help='Spans shown in the profile summary')
+    parser.add_argument('--serve', action='store_true', help='Run a render daemon with a pool of warm workers')
+    parser.add_argument('--port', type=int, help='Port the render daemon listens on')
+    parser.add_argument('--socket', help='Unix socket the render daemon listens on instead of a port')
+    parser.add_argument('--max-queue', type=int, help='Jobs waiting for a worker before the daemon turns new ones away')
+    parser.add_argument('--job-timeout', type=float, help='Seconds a daemon job may run')
+    parser.add_argument('--watch-interval', type=float, default=DEFAULT_WATCH_INTERVAL, help='Polling interval in seconds for --watch')
 
     args = parser.parse_args()
+    if args.input_file is None and not args.serve:
+        parser.error('the following arguments are required: input_file')
+    output_format = 'html' if args.html else 'md' if args.md else 'pdf'
+    if args.serve and output_format != 'pdf':
+        parser.error('the render daemon only produces PDFs')
 
-    # Initialize SdTeX processor with input file
-    sdtex = SdTeX(args.input_file)
+    if args.clear_cache:
+        RenderCache(args.cache_dir).clear()
 
-    # Run the SdTeX processing
-    sdtex.run()
+    options = BuildOptions(
+        use_cache=not args.no_cache,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size * 1024 * 1024,
+        graph_workers=args.graph_workers,
+        image_workers=args.image_workers,
+        timeout=args.timeout,
+        retries=args.retries,
+        connections_per_host=args.connections_per_host,
+        image_dpi=args.image_dpi,
+        jpeg_quality=args.jpeg_quality,
+        palette_colors=args.palette_colors,
+        # Daemon jobs are written to a fresh file each time, so never up to date
+        incremental=not (args.force or args.serve),
+        stream=args.stream,
+        graph_output=args.graph_output,
+        output_format=output_format,
+        asset_url=args.asset_url,
+    )
+
+    if args.serve:
+        # Imported here so ordinary builds do not pay for the HTTP server
+        import Daemon
+
+        settings = dict(port=args.port, socket_path=args.socket, max_queue=args.max_queue, job_timeout=args.job_timeout)
+        Daemon.RenderServer(
+            options, workers=args.jobs, **{name: value for name, value in settings.items() if value is not None}
+        ).serve_forever()
+        return
+
+    if args.check:
+        for source in find_sources(args.input_file):
+            nodes = options.create(source).process_sdtex_file()
+            print(f"{source}: OK ({len(nodes)} nodes)")
+        return
+
+    batch = find_sources(args.input_file) != [args.input_file]
+    # Spans are recorded per process, so a profiled batch compiles in this one
+    jobs = 1 if args.profile else args.jobs
+
+    def build(sources):
+        if batch:
+            # Batch build: every document gets its own PDF in the output directory
+            BatchCompiler(options, args.output_dir, jobs).run(sources)
+        else:
+            # Initialize SdTeX processor with input file and run it
+            options.create(args.input_file).run()
+
+    profiler = Profile.Profiler(memory=not args.profile_no_memory).start() if args.profile else None
+    try:
+        if args.watch:
+            Watcher(
+                lambda: find_sources(args.input_file), build, args.watch_interval, Modules.dependencies
+            ).run()
+        else:
+            with Profile.span("build"):
+                build(find_sources(args.input_file))
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.export(args.profile)
+            profiler.print_summary(args.profile_top)
+            print(f"Profile written to {args.profile}")
 
 if __name__ == "__main__":
     main()